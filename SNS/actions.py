@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.db import transaction
+
+from .models import CustomUser, Post
+
+# Batched follow, like and repost actions.
+#
+# A batch maps action names to lists of target ids, e.g.
+#
+#     {"follow": [3, 4], "like": [10, 11, 12], "unrepost": [7]}
+#
+# Each action becomes one add() or remove() on the viewer's m2m relation,
+# which writes every row with a single INSERT or DELETE and fires one
+# m2m_changed signal for the whole set.  Actions are idempotent: adding an
+# existing row or removing a missing one changes nothing.
+
+ACTIONS = {
+    # name: (relation, target model, add)
+    'follow': ('followers', CustomUser, True),
+    'unfollow': ('followers', CustomUser, False),
+    'like': ('likes', Post, True),
+    'unlike': ('likes', Post, False),
+    'repost': ('reposts', Post, True),
+    'unrepost': ('reposts', Post, False),
+}
+
+INVERSE = {
+    'follow': 'unfollow',
+    'like': 'unlike',
+    'repost': 'unrepost',
+}
+
+
+class ActionError(ValueError):
+    pass
+
+
+def max_targets():
+    return getattr(settings, 'SNS_BULK_ACTION_LIMIT', 500)
+
+
+def parse(batch):
+    # Validate a decoded batch and return {name: set of ids}.
+    if not isinstance(batch, dict):
+        raise ActionError("Expected an object of action lists.")
+    actions = {}
+    for name, ids in batch.items():
+        if name not in ACTIONS:
+            raise ActionError("Unknown action %r." % name)
+        if not isinstance(ids, list) or not all(
+                isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise ActionError("%r must be a list of ids." % name)
+        actions[name] = set(ids)
+    if sum(len(ids) for ids in actions.values()) > max_targets():
+        raise ActionError("At most %d ids per request." % max_targets())
+    for name, inverse in INVERSE.items():
+        both = actions.get(name, set()) & actions.get(inverse, set())
+        if both:
+            raise ActionError("%r and %r both contain %s."
+                              % (name, inverse, sorted(both)))
+    return actions
+
+
+def apply(customuser, actions):
+    # Apply parsed actions for customuser in one transaction and return
+    # {name: {'ok': ids, 'missing': ids}}.
+    result = {}
+    with transaction.atomic():
+        for name, ids in actions.items():
+            relation, model, add = ACTIONS[name]
+            found = set(model.objects.filter(
+                pk__in=ids
+            ).values_list('pk', flat=True))
+            if found:
+                manager = getattr(customuser, relation)
+                if add:
+                    manager.add(*found)
+                else:
+                    manager.remove(*found)
+            result[name] = {'ok': sorted(found),
+                            'missing': sorted(ids - found)}
+    return result
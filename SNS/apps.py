@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class SnsConfig(AppConfig):
     name = 'SNS'
+
+    def ready(self):
+        from . import database, retention, signals  # noqa: F401
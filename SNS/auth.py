@@ -0,0 +1,20 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+# Authentication for SNS.
+#
+# Every signed-in page needs request.user.customuser.  ModelBackend loads
+# the User on its own and the first access to .customuser costs a second
+# query; CustomUserBackend loads both with one join.
+
+UserModel = get_user_model()
+
+
+class CustomUserBackend(ModelBackend):
+    def get_user(self, user_id):
+        try:
+            user = UserModel._default_manager.select_related(
+                'customuser').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
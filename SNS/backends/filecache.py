@@ -0,0 +1,51 @@
+import contextlib
+import os
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.files import locks
+
+# A file-based cache for version numbers (SNS.caching), shared by every
+# process on the host.
+#
+# Django's FileBasedCache increments with a get followed by a set, so two
+# processes bumping the same version at once can both write the same
+# number, and the invalidation of one of them is lost.  Here incr() and
+# add() hold an exclusive lock for the read and the write.  The locks are
+# striped over 256 lock files, by the first two hex digits of the key's
+# file name, so that they do not double the number of files.
+#
+# Entries are never culled, and incremented ones never expire: a lost
+# version starts again from 0 and makes stale entries reachable, and
+# culling would list the whole directory on every set.
+
+
+class VersionFileCache(FileBasedCache):
+    lock_suffix = '.lock'
+
+    @contextlib.contextmanager
+    def _locked(self, key, version):
+        self._createdir()
+        stripe = os.path.basename(self._key_to_file(key, version))[:2]
+        with open(os.path.join(self._dir, stripe + self.lock_suffix),
+                  'ab') as f:
+            locks.lock(f, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(f)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        with self._locked(key, version):
+            return super().add(key, value, timeout, version)
+
+    def incr(self, key, delta=1, version=None):
+        with self._locked(key, version):
+            value = self.get(key, self._missing_key, version=version)
+            if value is self._missing_key:
+                raise ValueError("Key '%s' not found" % key)
+            self.set(key, value + delta, None, version=version)
+            return value + delta
+
+    def _cull(self):
+        pass
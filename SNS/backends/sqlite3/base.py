@@ -0,0 +1,32 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+# Django's SQLite backend plus the "transaction_mode" option that Django 5.1
+# adds.  Django starts transactions with a plain BEGIN, which takes the
+# write lock only at the first write.  If another connection committed
+# since the transaction's first read, SQLite cannot upgrade the lock and
+# fails at once with "database is locked" instead of waiting for
+# busy_timeout.  With transaction_mode IMMEDIATE every atomic block takes
+# the write lock when it begins, so concurrent writers queue up instead.
+
+TRANSACTION_MODES = ('DEFERRED', 'EXCLUSIVE', 'IMMEDIATE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    transactionMode = None
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        mode = kwargs.pop('transaction_mode', None)
+        if mode is not None and mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                "settings.DATABASES[%r]['OPTIONS']['transaction_mode'] must "
+                "be one of %s." % (self.alias, ', '.join(TRANSACTION_MODES)))
+        self.transactionMode = mode.upper() if mode else None
+        return kwargs
+
+    def _start_transaction_under_autocommit(self):
+        if self.transactionMode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute('BEGIN %s' % self.transactionMode)
@@ -0,0 +1,223 @@
+import hashlib
+import time
+import uuid
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.dispatch import Signal
+
+from .pagination import encode_cursor
+
+# Versioned caching for rendered post cards and home timeline pages.
+#
+# Cached values are never deleted.  Each post and each timeline owner has a
+# version number, and bumping it makes every key built from the old number
+# unreachable; stale entries simply expire.  The versions live in a cache
+# of their own that does not evict them, since a lost version would start
+# again from 0 and reach the stale entries.  Keys also carry an
+# "incarnation" (the post's pub_date or the owner's date_joined) so that a
+# primary key reused after a delete never sees the previous row's entries.
+#
+# The same versions make page validators: a user's "viewer" version moves
+# when their likes, reposts or follows change and their "user" version when
+# their profile counts do, so page_etag() can tell whether a page changed
+# with a few cache reads and no queries.  The viewer version also keys the
+# snapshot of a viewer's own likes, reposts and follows.
+
+stats = Counter()
+
+# Sent with the owner ids whenever timelines are invalidated.
+timelines_changed = Signal()
+
+
+def get_cache():
+    return caches[getattr(settings, 'SNS_CACHE', 'default')]
+
+
+def get_version_cache():
+    # The cache of version numbers, which must not evict them; see
+    # settings.CACHES.
+    return caches[getattr(settings, 'SNS_VERSION_CACHE',
+                          getattr(settings, 'SNS_CACHE', 'default'))]
+
+
+def timeout():
+    return getattr(settings, 'SNS_CACHE_TIMEOUT', 300)
+
+
+def _incarnation(date):
+    return encode_cursor(date, 0)
+
+
+def _version(kind, pk):
+    return get_version_cache().get('sns:%s:v:%d' % (kind, pk), 0)
+
+
+def _bump(kind, pks):
+    # Returns the new version of each pk.
+    cache = get_version_cache()
+    versions = {}
+    for pk in set(pks):
+        key = 'sns:%s:v:%d' % (kind, pk)
+        try:
+            versions[pk] = cache.incr(key)
+        except ValueError:
+            # Another process may create the key first.
+            if cache.add(key, 1, None):
+                versions[pk] = 1
+            else:
+                versions[pk] = cache.incr(key)
+    return versions
+
+
+def bump_posts(postIds):
+    _bump('post', postIds)
+
+
+def bump_timelines(ownerIds):
+    ownerIds = set(ownerIds)
+    _bump('timeline', ownerIds)
+    timelines_changed.send(sender=None, ownerIds=ownerIds)
+
+
+def timeline_version(ownerId):
+    return _version('timeline', ownerId)
+
+
+async def atimeline_version(ownerId):
+    # timeline_version() for coroutines.  The cache backends block, so the
+    # read runs on a pool thread: not on the event loop, and not on a
+    # thread-sensitive one (as cache.aget() would), which stays tied to the
+    # request for as long as a stream is open.
+    return await sync_to_async(timeline_version,
+                               thread_sensitive=False)(ownerId)
+
+
+def bump_viewers(customuserIds):
+    # The versions move again once the transaction commits, so that a
+    # snapshot read from the database before the commit is not kept under
+    # the new version.
+    customuserIds = set(customuserIds)
+    _bump('viewer', customuserIds)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump('viewer', customuserIds))
+
+
+def bump_users(customuserIds):
+    _bump('user', customuserIds)
+
+
+def bump_graph(customuserIds):
+    # The users' rows of the follow graph changed (SNS.graph); returns their
+    # new versions.
+    return _bump('graph', customuserIds)
+
+
+def graph_versions(customuserIds):
+    keys = {pk: 'sns:graph:v:%d' % pk for pk in customuserIds}
+    found = get_version_cache().get_many(keys.values())
+    return {pk: found.get(key, 0) for pk, key in keys.items()}
+
+
+def shared():
+    # Whether every process reads the same versions, so that a version
+    # bumped in one process is seen by all of them.
+    return not isinstance(get_version_cache(), LocMemCache)
+
+
+def max_stale():
+    # Seconds a page validator may stay unchanged while other users'
+    # engagement changes the counts on it.
+    return getattr(settings, 'SNS_ETAG_MAX_STALE', 60)
+
+
+def _generation():
+    # A token that changes whenever the cache loses its version numbers, so
+    # that restarted versions cannot repeat an old validator.
+    cache = get_version_cache()
+    cache.add('sns:generation', uuid.uuid4().hex, None)
+    return cache.get('sns:generation', '')
+
+
+def page_etag(kind, path, customuser, timelines=(), viewers=(), users=()):
+    # An ETag for the page `path` of view kind as customuser sees it, built
+    # from the versions of the given timeline owners, viewers and users.
+    parts = [kind, path, str(customuser.pk),
+             _incarnation(customuser.user.date_joined), _generation(),
+             str(int(time.time() // max_stale()))]
+    for versionKind, pks in (('timeline', timelines), ('viewer', viewers),
+                             ('user', users)):
+        parts.extend('%s%d:%d' % (versionKind, pk, _version(versionKind, pk))
+                     for pk in pks)
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+def _get_or_set(kind, key, compute):
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        stats[kind + '_misses'] += 1
+        value = compute()
+        cache.set(key, value, timeout())
+    else:
+        stats[kind + '_hits'] += 1
+    return value
+
+
+def _card_key(post, version, liked, reposted):
+    return 'sns:card:%d:%s:%d:%d%d' % (
+        post.pk, _incarnation(post.pub_date), version, liked, reposted)
+
+
+def post_card(post, liked, reposted, render):
+    # The rendered card of post as seen by a viewer with the given like and
+    # repost state; render() produces it on a miss.
+    key = _card_key(post, _version('post', post.pk), liked, reposted)
+    return _get_or_set('card', key, render)
+
+
+def post_cards(posts, likedIds, repostedIds, render):
+    # The rendered cards of posts, in order, with one cache read for their
+    # versions and one for the cards; render(post, liked, reposted)
+    # produces each miss.
+    cache = get_cache()
+    versionKeys = {p.pk: 'sns:post:v:%d' % p.pk for p in posts}
+    versions = get_version_cache().get_many(versionKeys.values())
+    keys = [_card_key(p, versions.get(versionKeys[p.pk], 0),
+                      p.pk in likedIds, p.pk in repostedIds) for p in posts]
+    found = cache.get_many(keys)
+    cards, missing = [], {}
+    for post, key in zip(posts, keys):
+        card = found.get(key)
+        if card is None:
+            stats['card_misses'] += 1
+            card = missing[key] = render(
+                post, post.pk in likedIds, post.pk in repostedIds)
+        else:
+            stats['card_hits'] += 1
+        cards.append(card)
+    if missing:
+        cache.set_many(missing, timeout())
+    return cards
+
+
+def viewer_snapshot(customuser, compute):
+    # customuser's viewer state snapshot (see viewer.snapshot); compute()
+    # produces it on a miss.
+    key = 'sns:viewerstate:%d:%s:%d' % (
+        customuser.pk, _incarnation(customuser.user.date_joined),
+        _version('viewer', customuser.pk))
+    return _get_or_set('viewer', key, compute)
+
+
+def timeline_keys(customuser, before, compute):
+    # The (post id, keyDate) pairs and next cursor of one page of
+    # customuser's home timeline; compute() produces them on a miss.
+    key = 'sns:timeline:%d:%s:%d:%s' % (
+        customuser.pk, _incarnation(customuser.user.date_joined),
+        _version('timeline', customuser.pk), before or '')
+    return _get_or_set('timeline', key, compute)
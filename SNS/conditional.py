@@ -0,0 +1,66 @@
+import functools
+import hashlib
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                quote_etag)
+
+# Conditional GET for per-viewer pages.
+#
+# A view decorated with conditional(etagFunc) computes the page's ETag from
+# cache versions (see caching.page_etag) before it runs.  A request whose
+# If-None-Match still matches gets a 304 without a single timeline query or
+# template render; other responses carry the ETag and "private, no-cache",
+# so browsers keep the page but revalidate it on every visit.
+#
+# Pages with a form carry a CSRF token made from the CSRF cookie, so the
+# cookie is part of the tag: a page kept from before the cookie changed
+# (a new sign-in rotates it) is never revalidated with its stale token.
+
+
+def _tag(etagFunc, request, args, kwargs):
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    user = request.user
+    if not user.is_authenticated:
+        return None
+    tag = etagFunc(request, user.customuser, *args, **kwargs)
+    csrfCookie = request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')
+    return hashlib.sha1(('%s|%s' % (tag, csrfCookie)).encode()).hexdigest()
+
+
+def _respond(request, tag, response):
+    if tag and response.status_code == 200 and not response.has_header('ETag'):
+        response['ETag'] = quote_etag(tag)
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional(etagFunc):
+    # etagFunc(request, customuser, *args, **kwargs) returns the ETag of the
+    # page the view would produce for the signed-in customuser.
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                tag = await sync_to_async(_tag)(etagFunc, request, args, kwargs)
+                if tag:
+                    notModified = get_conditional_response(
+                        request, etag=quote_etag(tag))
+                    if notModified is not None:
+                        return notModified
+                return _respond(request, tag,
+                                await view(request, *args, **kwargs))
+        else:
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                tag = _tag(etagFunc, request, args, kwargs)
+                if tag:
+                    notModified = get_conditional_response(
+                        request, etag=quote_etag(tag))
+                    if notModified is not None:
+                        return notModified
+                return _respond(request, tag, view(request, *args, **kwargs))
+        return wrapper
+    return decorator
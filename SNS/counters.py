@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from . import ranking
+from .models import CustomUser, Post, Repost
+
+# Denormalized engagement counters on Post.
+#
+# likeCount, repostCount and replyCount are adjusted with F() expressions in
+# the same statement that writes the change, so concurrent writers never
+# lose an update, and rebuild() recomputes them when they drift.  Every
+# change also refreshes the posts' hotScore in the same transaction, which
+# holds the posts' rows (or, on SQLite, the write lock) until it commits, so
+# a concurrent change cannot score the posts from older counters after it.
+
+Like = CustomUser.likes.through
+
+
+def bump(postIds, field, delta):
+    postIds = list(postIds)
+    if postIds and delta:
+        with transaction.atomic():
+            Post.objects.filter(pk__in=postIds).update(
+                **{field: F(field) + delta})
+            ranking.refresh(postIds)
+
+
+def _count(queryset, column):
+    return Coalesce(Subquery(
+        queryset.filter(
+            **{column: OuterRef('pk')}
+        ).order_by().values(column).annotate(n=Count('*')).values('n')
+    ), 0)
+
+
+def expected_counts():
+    return {
+        'likeCount': _count(Like.objects.all(), 'post_id'),
+        'repostCount': _count(Repost.objects.all(), 'post_id'),
+        'replyCount': _count(Post.objects.all(), 'replyTo_id'),
+    }
+
+
+def rebuild():
+    # Recompute every counter from the source tables and return the number
+    # of posts whose counters had drifted.
+    expected = expected_counts()
+    drifted = list(Post.objects.annotate(
+        expectedLikes=expected['likeCount'],
+        expectedReposts=expected['repostCount'],
+        expectedReplies=expected['replyCount'],
+    ).exclude(
+        likeCount=F('expectedLikes'),
+        repostCount=F('expectedReposts'),
+        replyCount=F('expectedReplies'),
+    ).values_list('pk', flat=True))
+
+    for i in range(0, len(drifted), 500):
+        Post.objects.filter(pk__in=drifted[i:i + 500]).update(
+            **expected_counts())
+    ranking.refresh(drifted)
+    return len(drifted)
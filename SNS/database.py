@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Database connection tuning and read/write routing.
+#
+# Every new SQLite connection gets the pragmas of SNS_SQLITE_PRAGMAS.  In
+# WAL mode readers work from a snapshot and are not blocked by a writer, and
+# a writer waits up to busy_timeout for another writer instead of failing at
+# once with "database is locked".
+#
+# When DATABASES has a 'replica' alias, ReadReplicaRouter sends reads there
+# and writes to 'default'.  Reads inside a transaction on 'default' stay on
+# it, so a transaction sees its own writes.
+
+REPLICA = 'replica'
+
+
+def sqlite_pragmas():
+    return getattr(settings, 'SNS_SQLITE_PRAGMAS', {})
+
+
+def apply_pragmas(connection, pragmas):
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+def pragma_values(connection, names):
+    # The current values of the named pragmas on connection.
+    values = {}
+    with connection.cursor() as cursor:
+        for name in names:
+            cursor.execute('PRAGMA %s' % name)
+            row = cursor.fetchone()
+            values[name] = row[0] if row else None
+    return values
+
+
+@receiver(connection_created)
+def _tune_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+        return
+    pragmas = sqlite_pragmas()
+    if connection.alias == REPLICA:
+        # The journal mode belongs to the database file and the read-only
+        # replica connection cannot change it; the writer sets it.
+        pragmas = {k: v for k, v in pragmas.items() if k != 'journal_mode'}
+    apply_pragmas(connection, pragmas)
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if REPLICA not in settings.DATABASES:
+            return None
+        if connections['default'].in_atomic_block:
+            return 'default'
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data.
+        aliases = {'default', REPLICA}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == 'default'
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import threading
+import time
+
+
+from django.conf import settings
+from django.db.models import Q
+from django.dispatch import receiver
+
+from . import caching, viewer
+from .models import Post, TimelineEntry
+from .pagination import EPOCH, decode_cursor, encode_cursor
+
+# Incremental home timeline feed.
+#
+# A client that already shows the timeline up to some (keyDate, post id)
+# cursor only needs the TimelineEntry rows after it, which is a short range
+# scan of the owner's timeline index rather than a timeline rebuild.  Rows
+# whose keyDate moves forward because a followed user reposted the post come
+# back as new items too.
+#
+# Waiting for changes costs no queries: a waiter re-reads the owner's
+# timeline version in the cache, and is woken at once when this process
+# bumps any timeline.  Changes made by other processes (such as run_jobs
+# workers) are seen within SNS_FEED_CHECK_INTERVAL seconds.  Async waiters
+# are an asyncio.Event each, so an idle stream under ASGI costs a coroutine
+# rather than a thread.
+
+_changed = threading.Condition()
+
+_asyncWaiters = set()
+_asyncLock = threading.Lock()
+
+
+def check_interval():
+    return getattr(settings, 'SNS_FEED_CHECK_INTERVAL', 1.0)
+
+
+def max_items():
+    return getattr(settings, 'SNS_FEED_MAX_ITEMS', 50)
+
+
+def stream_seconds():
+    return getattr(settings, 'SNS_STREAM_SECONDS', 300)
+
+
+def heartbeat_seconds():
+    return getattr(settings, 'SNS_STREAM_HEARTBEAT', 15)
+
+
+@receiver(caching.timelines_changed)
+def _wake_waiters(sender, ownerIds, **kwargs):
+    with _changed:
+        _changed.notify_all()
+    with _asyncLock:
+        waiters = list(_asyncWaiters)
+    for loop, event in waiters:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # The loop has been closed.
+            pass
+
+
+def wait(ownerId, version, timeout):
+    # Block until ownerId's timeline version differs from version or timeout
+    # seconds pass, and return the current version.
+    deadline = time.monotonic() + timeout
+    while True:
+        current = caching.timeline_version(ownerId)
+        remaining = deadline - time.monotonic()
+        if current != version or remaining <= 0:
+            return current
+        with _changed:
+            _changed.wait(min(remaining, check_interval()))
+
+
+async def await_change(ownerId, version, timeout):
+    # wait() for coroutines.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    waiter = (loop, asyncio.Event())
+    with _asyncLock:
+        _asyncWaiters.add(waiter)
+    try:
+        while True:
+            current = await caching.atimeline_version(ownerId)
+            remaining = deadline - loop.time()
+            if current != version or remaining <= 0:
+                return current
+            waiter[1].clear()
+            try:
+                await asyncio.wait_for(waiter[1].wait(),
+                                       min(remaining, check_interval()))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        with _asyncLock:
+            _asyncWaiters.discard(waiter)
+
+
+def newer(ownerId, cursor):
+    # The timeline posts of ownerId after cursor, oldest first, with keyDate
+    # set, and the cursor of the last one (or cursor itself if none).
+    # Without a cursor there is nothing yet, only the cursor of the newest
+    # entry to continue from.
+    entries = TimelineEntry.objects.filter(owner_id=ownerId)
+    if not cursor:
+        latest = entries.order_by('-keyDate', '-post_id').values_list(
+            'keyDate', 'post_id').first()
+        return [], encode_cursor(*latest) if latest else encode_cursor(EPOCH, 0)
+    date, pk = decode_cursor(cursor)
+    entries = entries.filter(Q(keyDate__gt=date) |
+                             Q(keyDate=date, post_id__gt=pk))
+    keys = list(entries.order_by('keyDate', 'post_id').values_list(
+        'post_id', 'keyDate')[:max_items()])
+    if not keys:
+        return [], cursor
+
+    posts = Post.objects.select_related('author__user').in_bulk(
+        [postId for postId, _ in keys])
+    items = []
+    for postId, keyDate in keys:
+        post = posts.get(postId)
+        if post is not None:
+            post.keyDate = keyDate
+            items.append(post)
+    postId, keyDate = keys[-1]
+    return items, encode_cursor(keyDate, postId)
+
+
+def latest_cursor(posts):
+    # The cursor a client showing the first timeline page starts from.
+    if not posts:
+        return encode_cursor(EPOCH, 0)
+    return encode_cursor(posts[0].keyDate, posts[0].pk)
+
+
+def item(post):
+    return {
+        'id': post.pk,
+        'author': post.author.user.username,
+        'authorId': post.author_id,
+        'text': post.text,
+        'replyTo': post.replyTo_id,
+        'pub_date': post.pub_date.isoformat(),
+        'keyDate': post.keyDate.isoformat(),
+    }
+
+
+def _event(post):
+    return 'id: %s\ndata: %s\n\n' % (encode_cursor(post.keyDate, post.pk),
+                                      json.dumps(item(post)))
+
+
+def events(ownerId, cursor):
+    # The server-sent events of a stream of ownerId's timeline after cursor:
+    # new items as they arrive, keepalive comments in between, for
+    # stream_seconds().
+    deadline = time.monotonic() + stream_seconds()
+    seen = None
+    yield 'retry: 3000\n\n'
+    while True:
+        version = caching.timeline_version(ownerId)
+        if version != seen:
+            items, cursor = newer(ownerId, cursor)
+            for post in items:
+                yield _event(post)
+            # A full batch may have left more items behind.
+            seen = None if len(items) == max_items() else version
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if seen is not None and wait(
+                ownerId, seen, min(remaining, heartbeat_seconds())) == seen:
+            yield ': keepalive\n\n'
+
+
+async def aevents(ownerId, cursor):
+    # events() as an async iterator.
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + stream_seconds()
+    seen = None
+    yield 'retry: 3000\n\n'
+    while True:
+        version = await caching.atimeline_version(ownerId)
+        if version != seen:
+            items, cursor = await viewer.read(newer, ownerId, cursor)
+            for post in items:
+                yield _event(post)
+            seen = None if len(items) == max_items() else version
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return
+        if seen is not None and await await_change(
+                ownerId, seen, min(remaining, heartbeat_seconds())) == seen:
+            yield ': keepalive\n\n'
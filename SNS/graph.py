@@ -0,0 +1,237 @@
+import bisect
+import threading
+from array import array
+
+from django.db import connection, transaction
+
+from . import caching
+from .models import CustomUser
+
+# In-memory follow graph.
+#
+# Each process keeps both directions of the follow relation as sorted
+# arrays of 32-bit user ids, about 8 bytes per edge, so follow checks,
+# counts and set operations never touch the database.  Each of a user's two
+# arrays is loaded on first use, with one query.
+#
+# Every follow change bumps the versions of both users in the cache of
+# versions (caching.bump_graph) and records the changed edges under the new
+# version in the cache, as a delta.  A process holding a user's arrays at
+# an older version applies the deltas in between to them in place, with
+# bisect inserts and deletes.  The deltas only say which edges changed: the
+# process reads whether they exist now, with one query per array, which
+# keeps it right when a change is rolled back or two changes commit
+# in the opposite order to their versions.  The arrays are read again only
+# when a delta has expired or was never written, when the user was
+# created or deleted (the id may be reused), or when more than MAX_DELTAS
+# changes are missing.  reset() after a bulk load bumps a generation that
+# drops every process's graph.
+#
+# The versions are bumped when the change is made, and again when its
+# transaction commits, so that other processes see it once it is visible
+# to them.  They only reach other processes through a shared version cache
+# (mysite/settings.py); with a per-process one (caching.shared() is False)
+# follows() and following_among() ask the database instead.
+
+Follow = CustomUser.followers.through
+
+VERSION_KEY = 'sns:graph:v'
+
+MAX_DELTAS = 50
+
+EMPTY = array('i')
+
+# For each array: the Follow column holding the user, the column holding
+# the ids in the array, and the user's place in a (follower, followee) edge.
+DIRECTIONS = {
+    'following': ('from_customuser_id', 'to_customuser_id', 0),
+    'followers': ('to_customuser_id', 'from_customuser_id', 1),
+}
+
+_lock = threading.RLock()
+_graph = None
+_generation = None
+
+
+def _delta_key(pk, version):
+    return 'sns:graph:d:%d:%d' % (pk, version)
+
+
+def _place(ids, pk, present):
+    # Insert pk into or delete it from the sorted array ids.
+    i = bisect.bisect_left(ids, pk)
+    found = i < len(ids) and ids[i] == pk
+    if present and not found:
+        ids.insert(i, pk)
+    elif found and not present:
+        del ids[i]
+
+
+def _existing(column, pk, other, ids):
+    # The ids among `ids` in column `other` of the Follow rows whose column
+    # is pk.  Plain SQL: building the ORM query costs more than running it.
+    qn = connection.ops.quote_name
+    ids = list(ids)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT %s FROM %s WHERE %s = %%s AND %s IN (%s)' % (
+            qn(other), qn(Follow._meta.db_table), qn(column), qn(other),
+            ', '.join(['%s'] * len(ids))), [pk] + ids)
+        return {row[0] for row in cursor.fetchall()}
+
+
+class Graph:
+    def __init__(self):
+        self.following = {}
+        self.followers = {}
+        # The version each user's loaded arrays are current at.
+        self.versions = {}
+
+    def load(self, direction, pk, version):
+        # The version is read before the rows, so the rows are at least as
+        # new as the version they are kept under.
+        column, other, _ = DIRECTIONS[direction]
+        getattr(self, direction)[pk] = array('i', Follow.objects.filter(
+            **{column: pk}).order_by(other).values_list(other, flat=True))
+        self.versions[pk] = version
+
+    def forget(self, pk):
+        self.following.pop(pk, None)
+        self.followers.pop(pk, None)
+        self.versions.pop(pk, None)
+
+    def catch_up(self, pk, version):
+        # Apply the deltas of pk up to version to its loaded arrays; returns
+        # False when they are not all available.
+        held = self.versions[pk]
+        if not held < version <= held + MAX_DELTAS:
+            return False
+        keys = [_delta_key(pk, v) for v in range(held + 1, version + 1)]
+        deltas = caching.get_cache().get_many(keys)
+        if len(deltas) < len(keys) or None in deltas.values():
+            return False
+        edges = {tuple(edge) for delta in deltas.values() for edge in delta}
+        for direction, (column, other, side) in DIRECTIONS.items():
+            ids = getattr(self, direction).get(pk)
+            changed = {edge[1 - side] for edge in edges if edge[side] == pk}
+            if ids is None or not changed:
+                continue
+            existing = _existing(column, pk, other, changed)
+            for otherId in changed:
+                _place(ids, otherId, otherId in existing)
+        self.versions[pk] = version
+        return True
+
+    def follows(self, a, b):
+        ids = self.following.get(a, EMPTY)
+        i = bisect.bisect_left(ids, b)
+        return i < len(ids) and ids[i] == b
+
+    def following_of(self, a):
+        return self.following.get(a, EMPTY)
+
+    def followers_of(self, b):
+        return self.followers.get(b, EMPTY)
+
+    def following_count(self, a):
+        return len(self.following.get(a, EMPTY))
+
+    def follower_count(self, b):
+        return len(self.followers.get(b, EMPTY))
+
+    def following_among(self, a, ids):
+        # The ids among `ids` that a follows.
+        return set(ids).intersection(self.following.get(a, EMPTY))
+
+    def mutuals(self, a):
+        # Users that a follows and who follow a back, in id order.
+        return sorted(set(self.following.get(a, EMPTY)).intersection(
+            self.followers.get(a, EMPTY)))
+
+    def size(self):
+        # Bytes held by the adjacency arrays.
+        return sum(ids.itemsize * len(ids)
+                   for index in (self.following, self.followers)
+                   for ids in index.values())
+
+
+def get(following=(), followers=()):
+    # The graph of this process, with the following arrays of the users in
+    # `following` and the follower arrays of those in `followers` current.
+    # Only those arrays may be read from it.
+    global _graph, _generation
+    needed = [('following', pk) for pk in following]
+    needed += [('followers', pk) for pk in followers]
+    generation = caching.get_version_cache().get(VERSION_KEY, 0)
+    versions = caching.graph_versions({pk for _, pk in needed})
+    with _lock:
+        if _graph is None or generation != _generation:
+            _graph = Graph()
+            _generation = generation
+        for pk, version in versions.items():
+            held = _graph.versions.get(pk)
+            if held is not None and held != version and \
+                    not _graph.catch_up(pk, version):
+                _graph.forget(pk)
+        for direction, pk in needed:
+            if pk not in getattr(_graph, direction):
+                _graph.load(direction, pk, versions[pk])
+        return _graph
+
+
+def follows(a, b):
+    # Whether a follows b.
+    if not caching.shared():
+        return Follow.objects.filter(
+            from_customuser_id=a, to_customuser_id=b).exists()
+    return get(following=[a]).follows(a, b)
+
+
+def following_among(a, ids):
+    # The ids among `ids` that a follows.
+    if not caching.shared():
+        return set(Follow.objects.filter(
+            from_customuser_id=a, to_customuser_id__in=list(ids)
+        ).values_list('to_customuser_id', flat=True))
+    return get(following=[a]).following_among(a, ids)
+
+
+def reset():
+    # Drop the graph of every process, e.g. after a bulk load.
+    global _graph
+    with _lock:
+        _graph = None
+    cache = caching.get_version_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        if not cache.add(VERSION_KEY, 1, None):
+            cache.incr(VERSION_KEY)
+
+
+def _publish(deltas):
+    # deltas maps user ids to the edges of theirs that changed, or to None
+    # when their arrays must be read again.
+    versions = caching.bump_graph(deltas)
+    caching.get_cache().set_many(
+        {_delta_key(pk, version): deltas[pk]
+         for pk, version in versions.items()}, caching.timeout())
+
+
+def _changed(deltas):
+    _publish(deltas)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _publish(deltas))
+
+
+def changed(customuserIds):
+    # customuserIds were created or deleted.
+    _changed(dict.fromkeys(customuserIds))
+
+
+def edges_changed(edges):
+    # The (follower, followee) pairs in edges were added or removed.
+    deltas = {}
+    for a, b in edges:
+        deltas.setdefault(a, []).append((a, b))
+        deltas.setdefault(b, []).append((a, b))
+    _changed(deltas)
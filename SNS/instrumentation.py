@@ -0,0 +1,151 @@
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from django.conf import settings
+
+# Per-request performance records.
+#
+# A sampled request gets a Recorder that wraps every database call (via
+# connection.execute_wrapper) and notes wall time, query count and time,
+# template render time and response size.  Queries whose SQL text repeats
+# with different parameters are reported as duplicates, which is what an
+# N+1 access pattern looks like.  Each record is logged as one JSON line on
+# the "SNS.instrumentation" logger and folded into in-process aggregates.
+
+logger = logging.getLogger('SNS.instrumentation')
+
+HISTORY = 1000
+
+_lock = threading.Lock()
+_aggregates = defaultdict(lambda: {
+    'requests': 0,
+    'queries': 0,
+    'db_ms': 0.0,
+    'n_plus_one': 0,
+    'wall_ms': deque(maxlen=HISTORY),
+})
+
+
+def sample_rate():
+    return getattr(settings, 'SNS_INSTRUMENTATION_SAMPLE_RATE', 0.0)
+
+
+def duplicate_threshold():
+    return getattr(settings, 'SNS_INSTRUMENTATION_DUPLICATE_THRESHOLD', 3)
+
+
+def sampled():
+    rate = sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of a non-empty list.
+    ordered = sorted(values)
+    rank = max(0, math.ceil(p * len(ordered) / 100) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Recorder:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.dbTime = 0.0
+        self.statements = Counter()
+        self.renderStart = None
+        self.renderTime = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.dbTime += time.perf_counter() - start
+            self.queries += 1
+            self.statements[sql] += 1
+
+    def render_started(self):
+        self.renderStart = time.perf_counter()
+
+    def render_finished(self, response):
+        self.renderTime = time.perf_counter() - self.renderStart
+
+    def record(self, request, response):
+        match = getattr(request, 'resolver_match', None)
+        threshold = duplicate_threshold()
+        duplicates = [
+            {'sql': sql[:300], 'count': n}
+            for sql, n in self.statements.most_common()
+            if n >= threshold
+        ]
+        return {
+            'view': match.view_name if match else None,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'wall_ms': round((time.perf_counter() - self.start) * 1000, 3),
+            'queries': self.queries,
+            'db_ms': round(self.dbTime * 1000, 3),
+            'render_ms': (round(self.renderTime * 1000, 3)
+                          if self.renderTime is not None else None),
+            'bytes': (None if response.streaming
+                      else len(response.content)),
+            'duplicates': duplicates,
+        }
+
+
+def publish(record):
+    logger.info(json.dumps(record, sort_keys=True))
+    with _lock:
+        stats = _aggregates[record['view'] or record['path']]
+        stats['requests'] += 1
+        stats['queries'] += record['queries']
+        stats['db_ms'] += record['db_ms']
+        stats['n_plus_one'] += bool(record['duplicates'])
+        stats['wall_ms'].append(record['wall_ms'])
+
+
+def summarize(records):
+    # Aggregate records (as produced by Recorder.record) per view.
+    byView = defaultdict(list)
+    for r in records:
+        byView[r['view'] or r['path']].append(r)
+    return {
+        view: {
+            'requests': len(rs),
+            'p50_ms': percentile([r['wall_ms'] for r in rs], 50),
+            'p95_ms': percentile([r['wall_ms'] for r in rs], 95),
+            'p99_ms': percentile([r['wall_ms'] for r in rs], 99),
+            'avg_queries': round(sum(r['queries'] for r in rs) / len(rs), 2),
+            'avg_db_ms': round(sum(r['db_ms'] for r in rs) / len(rs), 3),
+            'n_plus_one': sum(bool(r['duplicates']) for r in rs),
+        }
+        for view, rs in byView.items()
+    }
+
+
+def snapshot():
+    # The aggregates of this process since it started.
+    with _lock:
+        return {
+            view: {
+                'requests': s['requests'],
+                'p50_ms': percentile(s['wall_ms'], 50),
+                'p95_ms': percentile(s['wall_ms'], 95),
+                'p99_ms': percentile(s['wall_ms'], 99),
+                'avg_queries': round(s['queries'] / s['requests'], 2),
+                'avg_db_ms': round(s['db_ms'] / s['requests'], 3),
+                'n_plus_one': s['n_plus_one'],
+            }
+            for view, s in _aggregates.items()
+        }
+
+
+def reset():
+    with _lock:
+        _aggregates.clear()
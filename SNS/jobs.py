@@ -0,0 +1,192 @@
+import datetime
+import json
+import logging
+import os
+import random
+import time
+import traceback
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import caching, timeline
+from .models import Job, Post
+
+# Deferred write-time work.
+#
+# Timeline fan-out is the expensive part of creating a post, a repost or a
+# follow.  With SNS_ASYNC_FANOUT enabled the signal receivers only insert a
+# Job row and "manage.py run_jobs" executes the jobs in worker processes.
+# The Job row has to commit with the write itself, or a crash in between
+# loses the fan-out for good: the views that create posts wrap the write in
+# transaction.atomic(), and the related managers do the same for follows,
+# likes and reposts.  Otherwise enqueue() runs
+# the handler right away, which is what the tests and a plain runserver use.
+#
+# Workers claim jobs by leasing them: an UPDATE that only matches rows which
+# are still claimable stamps them with the worker's token and a lease expiry,
+# so two workers never run the same job, and a job whose worker died is
+# picked up again once its lease runs out.  This needs nothing beyond what
+# SQLite offers.  Failed jobs are retried with exponential backoff.  Every
+# handler recomputes its result from the source tables, so running a job
+# twice is harmless.
+
+logger = logging.getLogger('SNS.jobs')
+
+HANDLERS = {}
+
+
+def handler(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def async_enabled():
+    return getattr(settings, 'SNS_ASYNC_FANOUT', False)
+
+
+def lease_seconds():
+    return getattr(settings, 'SNS_JOB_LEASE', 60)
+
+
+def max_attempts():
+    return getattr(settings, 'SNS_JOB_MAX_ATTEMPTS', 5)
+
+
+def backoff_seconds():
+    return getattr(settings, 'SNS_JOB_BACKOFF', 2)
+
+
+def retention_seconds():
+    return getattr(settings, 'SNS_JOB_RETENTION', 3600)
+
+
+def enqueue(kind, **payload):
+    if not async_enabled():
+        HANDLERS[kind](**payload)
+        return None
+    return Job.objects.create(kind=kind, payload=json.dumps(payload))
+
+
+def _claimable(now):
+    return (Q(status=Job.PENDING, runAt__lte=now) |
+            Q(status=Job.RUNNING, leasedUntil__lt=now))
+
+
+def claim(token, limit):
+    # Lease up to limit runnable jobs to token and return them.
+    now = timezone.now()
+    ids = list(Job.objects.filter(
+        _claimable(now)
+    ).order_by('runAt', 'id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+    # The conditions are repeated so a job claimed by someone else between
+    # the two statements is left alone.
+    Job.objects.filter(_claimable(now), id__in=ids).update(
+        status=Job.RUNNING,
+        leasedBy=token,
+        leasedUntil=now + datetime.timedelta(seconds=lease_seconds()),
+    )
+    return list(Job.objects.filter(
+        id__in=ids, leasedBy=token, status=Job.RUNNING
+    ).order_by('runAt', 'id'))
+
+
+def run(job):
+    # Run one claimed job; returns True if it succeeded.
+    attempts = job.attempts + 1
+    try:
+        with transaction.atomic():
+            HANDLERS[job.kind](**json.loads(job.payload))
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning("%s failed (attempt %d)\n%s", job, attempts, error)
+        if attempts >= max_attempts():
+            changes = {'status': Job.FAILED, 'finished': timezone.now()}
+        else:
+            delay = backoff_seconds() * 2 ** (attempts - 1)
+            delay *= random.uniform(1, 1.5)
+            changes = {
+                'status': Job.PENDING,
+                'runAt': timezone.now() + datetime.timedelta(seconds=delay),
+            }
+        Job.objects.filter(id=job.id, leasedBy=job.leasedBy).update(
+            attempts=attempts, lastError=error, leasedUntil=None, **changes)
+        return False
+
+    Job.objects.filter(id=job.id, leasedBy=job.leasedBy).update(
+        status=Job.DONE, attempts=attempts, leasedUntil=None,
+        finished=timezone.now())
+    return True
+
+
+def purge():
+    # Forget jobs that finished successfully a while ago.
+    cutoff = timezone.now() - datetime.timedelta(seconds=retention_seconds())
+    return Job.objects.filter(status=Job.DONE, finished__lt=cutoff).delete()[0]
+
+
+def work(batch=20, poll=1.0, once=False, maxJobs=None):
+    # Claim and run jobs until the queue is empty (once) or forever, and
+    # return {'done': n, 'failed': n, 'seconds': s}.
+    token = '%d-%s' % (os.getpid(), uuid.uuid4().hex[:12])
+    stats = {'done': 0, 'failed': 0}
+    start = time.perf_counter()
+    while maxJobs is None or stats['done'] + stats['failed'] < maxJobs:
+        limit = batch
+        if maxJobs is not None:
+            limit = min(batch, maxJobs - stats['done'] - stats['failed'])
+        jobs = claim(token, limit)
+        if not jobs:
+            if once:
+                break
+            purge()
+            time.sleep(poll)
+            continue
+        for job in jobs:
+            stats['done' if run(job) else 'failed'] += 1
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    return stats
+
+
+def metrics(window=60):
+    # Queue depth per status and throughput over the last window seconds.
+    now = timezone.now()
+    counts = {status: 0 for status, _ in Job.STATUSES}
+    counts.update(Job.objects.values_list('status').annotate(
+        n=Count('id')).order_by())
+    finished = Job.objects.filter(
+        status=Job.DONE,
+        finished__gte=now - datetime.timedelta(seconds=window)
+    ).count()
+    return {
+        'counts': counts,
+        'ready': Job.objects.filter(status=Job.PENDING,
+                                    runAt__lte=now).count(),
+        'window': window,
+        'finished': finished,
+        'per_second': round(finished / window, 3),
+    }
+
+
+@handler('deliver_post')
+def deliver_post(postId):
+    post = Post.objects.filter(pk=postId).first()
+    if post is not None:
+        caching.bump_timelines(timeline.deliver_post(post))
+
+
+@handler('deliver_repost')
+def deliver_repost(repostedById, postIds):
+    caching.bump_timelines(timeline.deliver_repost(repostedById, postIds))
+
+
+@handler('follow_changed')
+def follow_changed(ownerId, followeeIds):
+    caching.bump_timelines(timeline.follow_changed(ownerId, followeeIds))
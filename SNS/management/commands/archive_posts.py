@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from SNS import retention
+
+
+class Command(BaseCommand):
+    help = ("Move the threads whose posts are all older than SNS_ARCHIVE_AFTER "
+            "into the archive; run it periodically.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float,
+                            help="Archive threads older than this instead.")
+        parser.add_argument('--batch', type=int, default=retention.BATCH_SIZE,
+                            help="Top-level posts examined per transaction.")
+
+    def handle(self, *args, **options):
+        seconds = None
+        if options['days'] is not None:
+            seconds = options['days'] * 24 * 3600
+        count = retention.archive(seconds, options['batch'])
+        self.stdout.write("Archived %d post(s)." % count)
@@ -0,0 +1,101 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Context, Engine, engines
+from django.test import RequestFactory, override_settings
+
+from SNS.instrumentation import percentile
+from SNS.models import Post
+
+# The per-card paths the single-pass renderer replaced, as the list pages
+# used to render them.
+INCLUDE = ('{% for post in posts %}{% include "SNS/post_part.html" %}<hr>'
+           '{% endfor %}')
+POST_CARD = ('{% load sns_tags %}{% for post in posts %}{% post_card post %}'
+             '<hr>{% endfor %}')
+POST_CARDS = '{% load sns_tags %}{% post_cards posts %}'
+
+LOADERS = ['django.template.loaders.filesystem.Loader',
+           'django.template.loaders.app_directories.Loader']
+
+
+class Command(BaseCommand):
+    help = ("Time rendering a list of post cards with {% include %} per "
+            "card, with the {% post_card %} tag per card and with the "
+            "single-pass {% post_cards %} tag, each with an empty and a warm "
+            "card cache.  Prints JSON.  Run seed_sns first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=200,
+                            help="Cards per rendered list.")
+        parser.add_argument('--rounds', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        posts = list(Post.objects.select_related(
+            'author__user').order_by('-pk')[:options['posts']])
+        if not posts:
+            raise CommandError("Nothing to benchmark; run seed_sns first.")
+        rng = random.Random(options['seed'])
+        context = {
+            'posts': posts,
+            'likedIds': {p.pk for p in posts if rng.random() < 0.3},
+            'repostedIds': {p.pk for p in posts if rng.random() < 0.1},
+        }
+
+        engine = engines['django'].engine
+        plain = Engine(loaders=LOADERS, libraries=engine.libraries)
+        cached = Engine(loaders=[('django.template.loaders.cached.Loader',
+                                  LOADERS)],
+                        libraries=engine.libraries)
+        variants = [
+            ('include', plain, INCLUDE),
+            ('include_cached_loader', cached, INCLUDE),
+            ('post_card', cached, POST_CARD),
+            ('post_cards', cached, POST_CARDS),
+        ]
+        caches = {
+            'cold': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+            'warm': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                     'LOCATION': 'bench_cards'},
+            'versions': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'bench_cards_versions'},
+        }
+
+        report = {'posts': len(posts), 'rounds': options['rounds'],
+                  'variants': {}}
+        with override_settings(CACHES=caches):
+            for name, templateEngine, source in variants:
+                template = templateEngine.from_string(source)
+                result = report['variants'][name] = {}
+                for cache in ('cold', 'warm'):
+                    with override_settings(SNS_CACHE=cache):
+                        # The first round fills the warm cache and the
+                        # loader's cache.
+                        template.render(Context(context))
+                        timings = []
+                        for _ in range(options['rounds']):
+                            # A new request each round, as each page view
+                            # reverses its URLs anew.
+                            requestContext = Context(dict(
+                                context, request=RequestFactory().get('/')))
+                            start = time.perf_counter()
+                            template.render(requestContext)
+                            timings.append(
+                                (time.perf_counter() - start) * 1000)
+                    result[cache] = {
+                        'p50_ms': round(percentile(timings, 50), 3),
+                        'p95_ms': round(percentile(timings, 95), 3),
+                        'per_card_us': round(
+                            percentile(timings, 50) * 1000 / len(posts), 2),
+                    }
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
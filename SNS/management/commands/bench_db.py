@@ -0,0 +1,158 @@
+import json
+import multiprocessing
+import random
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import Count
+
+from SNS import actions, database, timeline, viewer
+from SNS.instrumentation import percentile
+from SNS.models import CustomUser, Post
+
+# SQLite's defaults, as the project ran before SNS_SQLITE_PRAGMAS: rollback
+# journal, full fsync on every commit, Python's 5 second busy timeout and
+# deferred transactions.
+BASELINE = {
+    'journal_mode': 'delete',
+    'synchronous': 'full',
+    'busy_timeout': 5000,
+}
+
+
+def _init(pragmas, transactionMode):
+    # Pool initializer: new connections of this process get pragmas and
+    # start transactions in transactionMode.
+    django.setup()
+    settings.SNS_SQLITE_PRAGMAS = pragmas
+    connection.settings_dict['OPTIONS']['transaction_mode'] = transactionMode
+
+
+def _read(params):
+    # Render the data of home timelines for sampled users until the deadline;
+    # returns the latency of each page in milliseconds.
+    rng = random.Random(params['seed'])
+    customusers = list(CustomUser.objects.filter(pk__in=params['userIds']))
+    timings = []
+    errors = 0
+    while time.time() < params['deadline']:
+        customuser = rng.choice(customusers)
+        start = time.perf_counter()
+        try:
+            posts, _ = timeline.timeline_page(customuser)
+            viewer.post_state(customuser, posts)
+        except OperationalError:
+            errors += 1
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'timings': timings, 'errors': errors}
+
+
+def _write(params):
+    # Toggle likes and reposts of random posts, one transaction each, until
+    # the deadline.  Every action is undone, so the data ends as it began.
+    rng = random.Random(params['seed'])
+    customusers = list(CustomUser.objects.filter(pk__in=params['userIds']))
+    done = errors = 0
+    while time.time() < params['deadline']:
+        customuser = rng.choice(customusers)
+        postId = rng.choice(params['postIds'])
+        name = rng.choice(['like', 'repost'])
+        for action in (name, actions.INVERSE[name]):
+            try:
+                actions.apply(customuser, {action: {postId}})
+                done += 1
+            except OperationalError:
+                errors += 1
+    return {'writes': done, 'errors': errors}
+
+
+def _call(func, params):
+    return func(params)
+
+
+class Command(BaseCommand):
+    help = ("Measure home timeline read latency on the configured SQLite "
+            "database while writer processes toggle likes and reposts, once "
+            "with SQLite's default settings and once with "
+            "SNS_SQLITE_PRAGMAS and the configured transaction_mode.  Prints "
+            "JSON.  Run seed_sns first; the "
+            "database is left in the last profile's journal mode.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--seconds', type=float, default=5.0,
+                            help="Length of each phase.")
+        parser.add_argument('--profiles', nargs='+',
+                            default=['baseline', 'tuned'],
+                            choices=['baseline', 'tuned'])
+        parser.add_argument('--output', help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            raise CommandError("bench_db needs a file-backed SQLite database.")
+        userIds = list(CustomUser.objects.annotate(
+            n=Count('followers')).order_by('-n').values_list('pk', flat=True)[:50])
+        postIds = list(Post.objects.order_by('-pk').values_list(
+            'pk', flat=True)[:1000])
+        if not userIds or not postIds:
+            raise CommandError("Nothing to benchmark; run seed_sns first.")
+
+        profiles = {
+            'baseline': (BASELINE, 'DEFERRED'),
+            'tuned': (database.sqlite_pragmas(),
+                      connection.settings_dict['OPTIONS'].get(
+                          'transaction_mode', 'DEFERRED')),
+        }
+        report = {'readers': options['readers'], 'writers': options['writers'],
+                  'seconds': options['seconds'], 'profiles': {}}
+        for name in options['profiles']:
+            report['profiles'][name] = self.run_profile(
+                *profiles[name], userIds, postIds, options)
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
+
+    def run_profile(self, pragmas, transactionMode, userIds, postIds, options):
+        # The journal mode can only change while no other connection is open.
+        connections.close_all()
+        database.apply_pragmas(connection, pragmas)
+        result = {'pragmas': database.pragma_values(connection, list(pragmas)),
+                  'transaction_mode': transactionMode}
+        connections.close_all()
+
+        for phase, writers in (('reads_only', 0),
+                               ('during_writes', options['writers'])):
+            deadline = time.time() + options['seconds']
+            tasks = [(_read, {'seed': i, 'userIds': userIds,
+                              'deadline': deadline})
+                     for i in range(options['readers'])]
+            tasks += [(_write, {'seed': 1000 + i, 'userIds': userIds,
+                                'postIds': postIds, 'deadline': deadline})
+                      for i in range(writers)]
+            with multiprocessing.Pool(len(tasks), initializer=_init,
+                                      initargs=(pragmas, transactionMode)) as pool:
+                results = pool.starmap(_call, tasks)
+            result[phase] = self.summarize(results, options['seconds'])
+        return result
+
+    def summarize(self, results, seconds):
+        timings = [t for r in results for t in r.get('timings', [])]
+        return {
+            'reads': len(timings),
+            'reads_per_second': round(len(timings) / seconds, 1),
+            'read_p50_ms': round(percentile(timings, 50), 3),
+            'read_p95_ms': round(percentile(timings, 95), 3),
+            'read_p99_ms': round(percentile(timings, 99), 3),
+            'read_max_ms': round(max(timings, default=0), 3),
+            'read_errors': sum(r['errors'] for r in results if 'timings' in r),
+            'writes': sum(r.get('writes', 0) for r in results),
+            'write_errors': sum(r['errors'] for r in results
+                                if 'writes' in r),
+        }
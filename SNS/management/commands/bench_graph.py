@@ -0,0 +1,130 @@
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from SNS import graph, seed
+from SNS.models import CustomUser
+
+Follow = CustomUser.followers.through
+
+
+def orm_queries():
+    # The follow-graph questions answered with SQL, as before SNS.graph.
+    def follows(a, b):
+        return Follow.objects.filter(from_customuser_id=a,
+                                     to_customuser_id=b).exists()
+
+    def following_of(a):
+        return list(Follow.objects.filter(
+            from_customuser_id=a).values_list('to_customuser_id', flat=True))
+
+    def follower_count(b):
+        return Follow.objects.filter(to_customuser_id=b).count()
+
+    def mutuals(a):
+        return list(Follow.objects.filter(
+            from_customuser_id=a,
+            to_customuser_id__in=Follow.objects.filter(
+                to_customuser_id=a).values('from_customuser_id')
+        ).values_list('to_customuser_id', flat=True))
+
+    return {'follows': follows, 'following_of': following_of,
+            'follower_count': follower_count, 'mutuals': mutuals}
+
+
+def graph_queries():
+    def follows(a, b):
+        return graph.get(following=[a]).follows(a, b)
+
+    def following_of(a):
+        return graph.get(following=[a]).following_of(a)
+
+    def follower_count(b):
+        return graph.get(followers=[b]).follower_count(b)
+
+    def mutuals(a):
+        return graph.get(following=[a], followers=[a]).mutuals(a)
+
+    return {'follows': follows, 'following_of': following_of,
+            'follower_count': follower_count, 'mutuals': mutuals}
+
+
+class Command(BaseCommand):
+    help = ("Compare follow checks, following lists, follower counts and "
+            "mutual follows answered by SQL with SNS.graph, and the time "
+            "the graph takes to apply a follow change, and print the "
+            "median microseconds per call as JSON.  Seeding happens in a "
+            "transaction that is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=0,
+                            help="Seed this many users first.")
+        parser.add_argument('--follows', type=int, default=50)
+        parser.add_argument('--calls', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with transaction.atomic():
+            if options['users']:
+                seed.seed(users=options['users'], posts=0, reposts=0,
+                          likes=0, replies=0, follows=options['follows'],
+                          rng=rng)
+            userIds = list(CustomUser.objects.values_list('pk', flat=True))
+            if len(userIds) < 2:
+                raise CommandError("Need users; pass --users to seed some.")
+
+            graph.reset()
+            start = time.perf_counter()
+            loaded = graph.get(following=userIds, followers=userIds)
+            report = {
+                'users': len(userIds),
+                'edges': Follow.objects.count(),
+                'load_ms': round((time.perf_counter() - start) * 1000, 3),
+                'graph_bytes': loaded.size(),
+            }
+            pairs = [(rng.choice(userIds), rng.choice(userIds))
+                     for _ in range(options['calls'])]
+            for name, queries in (('orm', orm_queries()),
+                                  ('graph', graph_queries())):
+                report[name] = self.measure(queries, pairs)
+            report['graph']['update_us'] = self.measure_updates(pairs[:200])
+
+            transaction.set_rollback(True)
+        graph.reset()
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+
+    def measure(self, queries, pairs):
+        results = {}
+        for name, query in sorted(queries.items()):
+            timings = []
+            for a, b in pairs:
+                start = time.perf_counter()
+                if name == 'follows':
+                    query(a, b)
+                else:
+                    query(a)
+                timings.append((time.perf_counter() - start) * 1e6)
+            results[name + '_us'] = round(statistics.median(timings), 2)
+        return results
+
+    def measure_updates(self, pairs):
+        # A follow or unfollow made elsewhere, then the read that applies it
+        # to the loaded arrays.
+        timings = []
+        for a, b in pairs:
+            if a == b:
+                continue
+            graph.get(following=[a], followers=[b])
+            edge = {'from_customuser_id': a, 'to_customuser_id': b}
+            if not Follow.objects.filter(**edge).delete()[0]:
+                Follow.objects.create(**edge)
+            graph.edges_changed([(a, b)])
+            start = time.perf_counter()
+            graph.get(following=[a], followers=[b])
+            timings.append((time.perf_counter() - start) * 1e6)
+        return round(statistics.median(timings), 2)
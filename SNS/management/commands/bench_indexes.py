@@ -0,0 +1,144 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from SNS import seed
+from SNS.models import CustomUser, Post, Repost
+
+Follow = CustomUser.followers.through
+
+
+def timeline_queries(ownerId):
+    # The Post/Repost lookups behind the timeline, user post and repost
+    # maintenance code paths, for one timeline owner.
+    followeeIds = list(Follow.objects.filter(
+        from_customuser_id=ownerId
+    ).values_list('to_customuser_id', flat=True))
+    postIds = list(Post.objects.filter(
+        author_id__in=followeeIds
+    ).values_list('id', flat=True)[:20])
+
+    return [
+        ("user posts page",
+         Post.objects.filter(author_id=ownerId).order_by('-pub_date', '-id')[:20]),
+        ("followed users' posts",
+         Post.objects.filter(author_id__in=followeeIds).order_by('-pub_date', '-id')[:20]),
+        ("followed users' reposts",
+         Repost.objects.filter(repostedBy_id__in=followeeIds).order_by('-pub_date', '-id')[:20]),
+        ("reposts of one user",
+         Repost.objects.filter(repostedBy_id=ownerId).values_list('post_id', flat=True)),
+        ("reposters of a page",
+         Repost.objects.filter(post_id__in=postIds, repostedBy_id__in=followeeIds)),
+    ]
+
+
+def _schema(cursor, table):
+    cursor.execute(
+        "SELECT name, sql FROM sqlite_master WHERE tbl_name = %s AND "
+        "type = 'index' AND sql IS NOT NULL", [table])
+    indexes = dict(cursor.fetchall())
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name = %s", [table])
+    return cursor.fetchone()[0], indexes
+
+
+def _rebuild(cursor, table, createSql, indexSqls):
+    # Recreate table with createSql and indexSqls, keeping its rows.  This is
+    # the only way to drop the index of a UNIQUE table constraint in SQLite.
+    cursor.execute('ALTER TABLE "%s" RENAME TO "%s_bench"' % (table, table))
+    if createSql is None:
+        cursor.execute('CREATE TABLE "%s" AS SELECT * FROM "%s_bench"'
+                       % (table, table))
+    else:
+        cursor.execute(createSql)
+        cursor.execute('INSERT INTO "%s" SELECT * FROM "%s_bench"'
+                       % (table, table))
+    cursor.execute('DROP TABLE "%s_bench"' % table)
+    for sql in indexSqls:
+        cursor.execute(sql)
+
+
+class Command(BaseCommand):
+    help = ("Show query plans and timings of the timeline queries without "
+            "and with the Post/Repost indexes and the unique repost "
+            "constraint.  The state without them is measured first, and "
+            "each phase runs every query once untimed, so that neither gets "
+            "a warmer page cache.  Runs in a transaction that is rolled "
+            "back, so the database is left untouched.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=0,
+                            help="Seed this many users first.")
+        parser.add_argument('--posts', type=int, default=20000)
+        parser.add_argument('--reposts', type=int, default=5000)
+        parser.add_argument('--follows', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("This benchmark only supports SQLite.")
+
+        with transaction.atomic():
+            if options['users']:
+                seed.seed(users=options['users'], posts=options['posts'],
+                          follows=options['follows'],
+                          reposts=options['reposts'])
+
+            owner = CustomUser.objects.annotate(
+                n=Count('followers')).order_by('-n').first()
+            if owner is None:
+                raise CommandError("No users; pass --users to seed some.")
+
+            postTable = Post._meta.db_table
+            repostTable = Repost._meta.db_table
+            with connection.cursor() as cursor:
+                _, postIndexes = _schema(cursor, postTable)
+                repostSql, repostIndexes = _schema(cursor, repostTable)
+                # Without: only the foreign key indexes the tables had
+                # before the composite indexes and the constraint.
+                added = {i.name for m in (Post, Repost) for i in m._meta.indexes}
+                for index in Post._meta.indexes:
+                    cursor.execute('DROP INDEX "%s"' % index.name)
+                _rebuild(cursor, repostTable, None,
+                         [sql for name, sql in repostIndexes.items()
+                          if name not in added])
+            before = self.measure(owner.pk, options['repeat'], 'before')
+
+            with connection.cursor() as cursor:
+                for name, sql in postIndexes.items():
+                    if name in added:
+                        cursor.execute(sql)
+                _rebuild(cursor, repostTable, repostSql,
+                         repostIndexes.values())
+            after = self.measure(owner.pk, options['repeat'], 'after')
+
+            transaction.set_rollback(True)
+
+        for (name, plan, ms), (_, newPlan, newMs) in zip(before, after):
+            self.stdout.write("== %s: %.3f ms -> %.3f ms" % (name, ms, newMs))
+            self.stdout.write("   before: %s" % plan)
+            self.stdout.write("   after:  %s" % newPlan)
+
+    def explain(self, queryset, tag):
+        # The sqlite3 module caches prepared statements by SQL text and a
+        # cached EXPLAIN is not re-planned after DROP INDEX, so every phase
+        # gets its own statement text.
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN %s /* %s */" % (sql, tag), params)
+            return " | ".join(row[-1] for row in cursor.fetchall())
+
+    def measure(self, ownerId, repeat, tag):
+        results = []
+        for name, queryset in timeline_queries(ownerId):
+            plan = self.explain(queryset, tag)
+            list(queryset.all())
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - start) * 1000)
+            results.append((name, plan, statistics.median(timings)))
+        return results
@@ -0,0 +1,227 @@
+import asyncio
+import importlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth import (BACKEND_SESSION_KEY, HASH_SESSION_KEY,
+                                 SESSION_KEY)
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from SNS.instrumentation import percentile
+from SNS.models import CustomUser
+
+SERVERS = {
+    # One process each.  gunicorn's threaded worker serves one request per
+    # thread, so every open stream takes a thread from a fixed pool.
+    'wsgi': ['{python}', '-m', 'gunicorn', 'mysite.wsgi:application',
+             '--bind', '127.0.0.1:{port}', '--workers', '1',
+             '--threads', '{threads}'],
+    'asgi': ['{python}', '-m', 'uvicorn', 'mysite.asgi:application',
+             '--host', '127.0.0.1', '--port', '{port}',
+             '--log-level', 'warning'],
+}
+
+MODULES = {'wsgi': 'gunicorn', 'asgi': 'uvicorn'}
+
+TIMEOUT = 10
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_stats(pid):
+    # Resident memory (kB) and thread count of a Linux process and its
+    # children, such as gunicorn's worker.
+    stats = {'VmRSS': 0, 'Threads': 0}
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in stats:
+                        stats[key] += int(value.split()[0])
+            with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return {'rss_kb': stats['VmRSS'], 'threads': stats['Threads']}
+
+
+async def request(port, path, cookie):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                  'Cookie: %s=%s\r\nConnection: close\r\n\r\n'
+                  % (path, settings.SESSION_COOKIE_NAME, cookie)).encode())
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    return int(data.split(b' ', 2)[1])
+
+
+async def open_stream(port, cookie):
+    # An idle server-sent events connection.  Returns the writer and whether
+    # the response headers arrived in time; a server with no free worker
+    # leaves the connection queued.
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET /timeline/stream HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                  'Cookie: %s=%s\r\n\r\n'
+                  % (settings.SESSION_COOKIE_NAME, cookie)).encode())
+    await writer.drain()
+    try:
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), TIMEOUT)
+    except asyncio.TimeoutError:
+        return writer, False
+    return writer, True
+
+
+async def load(port, paths, cookie, concurrency, total):
+    timings = []
+    errors = 0
+    queue = list(reversed(paths * (total // len(paths) + 1)))[:total]
+
+    async def client():
+        nonlocal errors
+        while queue:
+            path = queue.pop()
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(request(port, path, cookie),
+                                                TIMEOUT)
+            except (OSError, IndexError, ValueError, asyncio.TimeoutError):
+                status = None
+            timings.append((time.perf_counter() - start) * 1000)
+            errors += status != 200
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {
+        'requests': total,
+        'errors': errors,
+        'requests_per_second': round(total / seconds, 1),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Start the project under gunicorn (WSGI, threaded worker) and "
+            "uvicorn (ASGI), hold idle timeline streams open against each "
+            "and measure the throughput of the read-heavy pages as JSON.  "
+            "Requests taking over %d seconds count as errors.  Uses the "
+            "configured database; run seed_sns first." % TIMEOUT)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', default=['wsgi', 'asgi'],
+                            choices=sorted(SERVERS))
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--idle', type=int, default=100,
+                            help="Idle timeline streams held open meanwhile.")
+        parser.add_argument('--threads', type=int, default=32,
+                            help="Threads of the WSGI worker.")
+        parser.add_argument('--output', help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        for name in options['servers']:
+            try:
+                importlib.import_module(MODULES[name])
+            except ImportError:
+                raise CommandError("The %s run needs %s installed."
+                                   % (name, MODULES[name]))
+
+        viewer = CustomUser.objects.annotate(
+            n=Count('followers')).order_by('-n').select_related('user').first()
+        if viewer is None:
+            raise CommandError("Nothing to benchmark; run seed_sns first.")
+        other = CustomUser.objects.exclude(pk=viewer.pk).first() or viewer
+        paths = ['/', '/user/%d' % other.pk, '/timeline/poll']
+
+        session = SessionStore()
+        session[SESSION_KEY] = str(viewer.user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = viewer.user.get_session_auth_hash()
+        session.create()
+
+        report = {'viewer': viewer.pk, 'paths': paths,
+                  'concurrency': options['concurrency'],
+                  'wsgi_threads': options['threads'],
+                  'idle_streams': options['idle'], 'servers': {}}
+        try:
+            for name in options['servers']:
+                report['servers'][name] = self.run_server(
+                    name, session.session_key, paths, options)
+        finally:
+            session.delete()
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
+
+    def run_server(self, name, cookie, paths, options):
+        port = free_port()
+        command = [arg.format(python=sys.executable, port=port,
+                              threads=options['threads'])
+                   for arg in SERVERS[name]]
+        env = dict(os.environ, DJANGO_DEBUG='0',
+                   SNS_INSTRUMENTATION_SAMPLE_RATE='0')
+        server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            self.wait_for(port, server)
+            return asyncio.run(self.measure(server.pid, port, cookie, paths,
+                                            options))
+        finally:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                # Open streams can hold up a graceful shutdown.
+                server.kill()
+                server.wait()
+
+    def wait_for(self, port, server):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError("The server exited with %d." % server.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.5).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError("The server did not start.")
+
+    async def measure(self, pid, port, cookie, paths, options):
+        # Warm up, then load the server while the idle streams are open.
+        await load(port, paths, cookie, 1, len(paths))
+        baseline = process_stats(pid)
+        streams = await asyncio.gather(*(
+            open_stream(port, cookie) for _ in range(options['idle'])))
+        idle = process_stats(pid)
+        result = await load(port, paths, cookie, options['concurrency'],
+                            options['requests'])
+        for writer, _ in streams:
+            writer.close()
+        result.update({
+            'streams_served': sum(served for _, served in streams),
+            'baseline': baseline,
+            'with_idle_streams': idle,
+        })
+        return result
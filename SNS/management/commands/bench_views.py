@@ -0,0 +1,94 @@
+import datetime
+import json
+import random
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from SNS.instrumentation import percentile
+from SNS.models import CustomUser, Post
+
+
+def summarize(timings, queries):
+    return {
+        'requests': len(timings),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'queries_p50': percentile(queries, 50),
+        'queries_max': max(queries),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Drive the SNS pages through the Django test client and report "
+            "latency percentiles and query counts per endpoint as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100,
+                            help="Requests per endpoint.")
+        parser.add_argument('--viewers', type=int, default=20,
+                            help="Number of users the requests are spread over.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        viewers = list(CustomUser.objects.annotate(
+            n=Count('followers')
+        ).order_by('-n').select_related('user')[:options['viewers']])
+        posts = list(Post.objects.order_by('-likeCount').values_list(
+            'pk', flat=True)[:options['viewers']])
+        if not viewers or not posts:
+            raise CommandError("Nothing to benchmark; run seed_sns first.")
+
+        endpoints = [
+            ('home', lambda v: reverse('home')),
+            ('user_post', lambda v: reverse(
+                'user_post', kwargs={'pk': rng.choice(viewers).pk})),
+            ('post_detail', lambda v: reverse(
+                'post_detail', kwargs={'pk': rng.choice(posts)})),
+            ('user_list', lambda v: reverse('user_list')),
+            ('my_like_list', lambda v: reverse('my_like_list')),
+        ]
+        clients = []
+        for v in viewers:
+            client = Client()
+            client.force_login(v.user)
+            clients.append((v, client))
+
+        report = {
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'users': CustomUser.objects.count(),
+            'posts': Post.objects.count(),
+            'endpoints': {},
+        }
+        with override_settings(ALLOWED_HOSTS=['testserver'], DEBUG=False):
+            for name, url in endpoints:
+                timings, queries = [], []
+                for i in range(options['requests']):
+                    v, client = clients[i % len(clients)]
+                    path = url(v)
+                    with CaptureQueriesContext(connection) as captured:
+                        start = time.perf_counter()
+                        response = client.get(path)
+                        timings.append((time.perf_counter() - start) * 1000)
+                    if response.status_code != 200:
+                        raise CommandError("%s returned %d" % (
+                            path, response.status_code))
+                    queries.append(len(captured))
+                report['endpoints'][name] = summarize(timings, queries)
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
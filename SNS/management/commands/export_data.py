@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from SNS import transfer
+from SNS.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = ("Write users' accounts, posts, reposts, likes and follows as "
+            "NDJSON, streamed in batches; see import_data.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', nargs='+', metavar='USERNAME',
+                            help="Export only these users' data; by default "
+                                 "everyone's.")
+        parser.add_argument('--output',
+                            help="Write to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        customuserIds = None
+        if options['users']:
+            found = dict(CustomUser.objects.filter(
+                user__username__in=options['users']
+            ).values_list('user__username', 'pk'))
+            unknown = sorted(set(options['users']) - set(found))
+            if unknown:
+                raise CommandError("No such user(s): %s." % ', '.join(unknown))
+            customuserIds = list(found.values())
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                for chunk in transfer.chunks(customuserIds):
+                    f.write(chunk)
+        else:
+            for chunk in transfer.chunks(customuserIds):
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,37 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from SNS import seed, transfer
+
+
+class Command(BaseCommand):
+    help = ("Load an NDJSON export of export_data with batched inserts, then "
+            "rebuild the timelines, counters and indexes.  Posts get new "
+            "ids; existing usernames are reused.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The export file, or - for stdin.")
+        parser.add_argument('--no-rebuild', action='store_true',
+                            help="Skip rebuilding the derived tables, e.g. "
+                                 "before importing more files.")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['path'] == '-':
+                    counts = transfer.import_records(sys.stdin)
+                else:
+                    with open(options['path'], encoding='utf-8') as f:
+                        counts = transfer.import_records(f)
+                if not options['no_rebuild']:
+                    seed.rebuild_derived()
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+        self.stdout.write(
+            "Imported %(user)d user(s), %(post)d post(s), %(repost)d "
+            "repost(s), %(like)d like(s) and %(follow)d follow(s); skipped "
+            "%(skipped)d record(s) that refer to missing users or posts and "
+            "left %(unlinked)d repl(ies) without the post they answer."
+            % counts)
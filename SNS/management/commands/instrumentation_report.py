@@ -0,0 +1,27 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from SNS import instrumentation
+
+
+class Command(BaseCommand):
+    help = ("Aggregate the JSON lines logged by the instrumentation "
+            "middleware into per-view latency and query statistics.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('logfiles', nargs='+')
+
+    def handle(self, *args, **options):
+        records = []
+        for path in options['logfiles']:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and 'wall_ms' in record:
+                        records.append(record)
+        self.stdout.write(json.dumps(instrumentation.summarize(records),
+                                     indent=2, sort_keys=True))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from SNS import counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the like, repost and reply counters of every post."
+
+    def handle(self, *args, **options):
+        fixed = counters.rebuild()
+        self.stdout.write("Fixed counters of %d post(s)." % fixed)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from SNS import search
+
+
+class Command(BaseCommand):
+    help = "Reindex every user and post in the full-text search tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=search.BATCH_SIZE,
+                            help="Posts tokenized and inserted per batch.")
+
+    def handle(self, *args, **options):
+        if not search.fts_enabled(search.POST_FTS):
+            self.stdout.write("Full-text search is not available on this "
+                              "database; nothing to rebuild.")
+            return
+        search.rebuild_user_index()
+        count = search.rebuild_post_index(options['batch'])
+        self.stdout.write("Indexed %d post(s)." % count)
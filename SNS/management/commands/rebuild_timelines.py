@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from SNS import caching, timeline
+from SNS.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialized home timelines from posts, reposts and follows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', type=int,
+                            help="Only rebuild these users' timelines.")
+
+    def handle(self, *args, **options):
+        ownerIds = options['user_ids']
+        if ownerIds:
+            for ownerId in ownerIds:
+                timeline.rebuild(ownerId)
+        else:
+            timeline.rebuild_all()
+            ownerIds = list(CustomUser.objects.values_list('pk', flat=True))
+        caching.bump_timelines(ownerIds)
+        self.stdout.write("Rebuilt %d timeline(s)." % len(ownerIds))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from SNS import stats
+
+
+class Command(BaseCommand):
+    help = ("Recompute the post, follow and like counts of every user; run "
+            "it periodically to repair drift.")
+
+    def handle(self, *args, **options):
+        fixed = stats.reconcile()
+        self.stdout.write("Fixed stats of %d user(s)." % fixed)
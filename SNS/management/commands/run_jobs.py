@@ -0,0 +1,64 @@
+import json
+import multiprocessing
+import time
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from SNS import jobs
+
+
+def _work(options):
+    return jobs.work(batch=options['batch'], poll=options['poll'],
+                     once=options['once'], maxJobs=options['max_jobs'])
+
+
+class Command(BaseCommand):
+    help = ("Run queued fan-out jobs (see SNS.jobs) in a pool of worker "
+            "processes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int,
+                            default=multiprocessing.cpu_count(),
+                            help="Worker processes; 1 runs the jobs in this "
+                                 "process.")
+        parser.add_argument('--batch', type=int, default=20,
+                            help="Jobs leased per claim.")
+        parser.add_argument('--poll', type=float, default=1.0,
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit when the queue is empty.")
+        parser.add_argument('--max-jobs', type=int,
+                            help="Exit after running this many jobs per process.")
+        parser.add_argument('--metrics', action='store_true',
+                            help="Only print queue metrics as JSON.")
+
+    def handle(self, *args, **options):
+        if options['metrics']:
+            self.stdout.write(json.dumps(jobs.metrics(), indent=2,
+                                         sort_keys=True))
+            return
+
+        params = {k: options[k] for k in ('batch', 'poll', 'once', 'max_jobs')}
+        start = time.perf_counter()
+        processes = max(1, options['processes'])
+        if processes == 1:
+            results = [_work(params)]
+        else:
+            # Children must not share the parent's database connection.
+            connections.close_all()
+            with multiprocessing.Pool(processes, initializer=django.setup) as pool:
+                results = pool.map(_work, [params] * processes)
+
+        seconds = time.perf_counter() - start
+        done = sum(r['done'] for r in results)
+        failed = sum(r['failed'] for r in results)
+        self.stdout.write(json.dumps({
+            'processes': processes,
+            'done': done,
+            'failed': failed,
+            'seconds': round(seconds, 3),
+            'jobs_per_second': round((done + failed) / seconds, 1)
+            if seconds else None,
+        }, sort_keys=True))
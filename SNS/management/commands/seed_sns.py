@@ -0,0 +1,41 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from SNS import seed
+
+
+class Command(BaseCommand):
+    help = ("Seed a synthetic social graph with a power-law follower "
+            "distribution, posts, replies, likes and reposts.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--posts', type=int, default=20000)
+        parser.add_argument('--follows', type=int, default=50,
+                            help="Average number of users each user follows.")
+        parser.add_argument('--likes', type=int, default=50000)
+        parser.add_argument('--reposts', type=int, default=10000)
+        parser.add_argument('--replies', type=float, default=0.2,
+                            help="Fraction of posts that are replies.")
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--alpha', type=float, default=1.0,
+                            help="Power-law exponent of user popularity.")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="Random seed, for reproducible data sets.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            userIds = seed.seed(users=options['users'],
+                                posts=options['posts'],
+                                follows=options['follows'],
+                                likes=options['likes'],
+                                reposts=options['reposts'],
+                                replies=options['replies'],
+                                days=options['days'],
+                                alpha=options['alpha'],
+                                rng=random.Random(options['seed']))
+            seed.rebuild_derived()
+        self.stdout.write("Seeded %d users (ids %d-%d)." % (
+            len(userIds), userIds[0], userIds[-1]))
@@ -0,0 +1,44 @@
+import heapq
+from operator import attrgetter
+
+# Building blocks for merging post and repost streams into a timeline.
+#
+# Both stages work on inputs that are already sorted newest first (as the
+# database returns them), so a whole timeline is assembled in one linear
+# pass instead of collecting everything and calling sorted().
+
+byKeyDate = attrgetter('keyDate')
+
+
+def group_reposts(reposts):
+    # reposts must be ordered by -pub_date.  Returns the reposted posts, each
+    # once, ordered by their latest repost.  Every post gets keyDate set to
+    # that latest repost date and reposter set to the list of reposters,
+    # newest first.
+    grouped = {}
+    for r in reposts:
+        p = grouped.get(r.post_id)
+        if p is None:
+            p = r.post
+            p.keyDate = r.pub_date
+            p.reposter = []
+            grouped[r.post_id] = p
+        p.reposter.append(r.repostedBy)
+    return list(grouped.values())
+
+
+def merge_timeline(posts, repostedPosts):
+    # posts must be ordered by -pub_date and repostedPosts must come from
+    # group_reposts().  Yields both streams merged by keyDate, newest first.
+    # A post present in both streams is only yielded once, at its repost
+    # position.
+    repostedIds = {p.id for p in repostedPosts}
+
+    def originals():
+        for p in posts:
+            if p.id not in repostedIds:
+                p.keyDate = p.pub_date
+                p.reposter = []
+                yield p
+
+    return heapq.merge(originals(), repostedPosts, key=byKeyDate, reverse=True)
@@ -0,0 +1,74 @@
+from asgiref.sync import (iscoroutinefunction, markcoroutinefunction,
+                          sync_to_async)
+import contextlib
+
+from django.db import connections
+
+from . import instrumentation
+
+
+# The recorder wraps every database alias: with a 'replica' alias
+# (SNS.database) most reads never touch 'default'.
+
+def _push_wrapper(recorder):
+    for connection in connections.all():
+        connection.execute_wrappers.append(recorder)
+
+
+def _pop_wrapper(recorder):
+    for connection in connections.all():
+        if recorder in connection.execute_wrappers:
+            connection.execute_wrappers.remove(recorder)
+
+
+class InstrumentationMiddleware:
+    # Records timing and query statistics for a sample of requests; see
+    # SNS.instrumentation.  Unsampled requests pay for one random() call.
+    #
+    # Under ASGI the recorder is installed on the connections of the thread
+    # that runs the request's sync_to_async calls, so queries made on other
+    # threads (viewer.gather) are not counted.
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not instrumentation.sampled():
+            return self.get_response(request)
+
+        recorder = instrumentation.Recorder()
+        request._snsRecorder = recorder
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        instrumentation.publish(recorder.record(request, response))
+        return response
+
+    async def __acall__(self, request):
+        if not instrumentation.sampled():
+            return await self.get_response(request)
+
+        recorder = instrumentation.Recorder()
+        request._snsRecorder = recorder
+        await sync_to_async(_push_wrapper)(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(_pop_wrapper)(recorder)
+        instrumentation.publish(recorder.record(request, response))
+        return response
+
+    def process_template_response(self, request, response):
+        recorder = getattr(request, '_snsRecorder', None)
+        if recorder is not None:
+            recorder.render_started()
+            response.add_post_render_callback(recorder.render_finished)
+        return response
@@ -0,0 +1,70 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_timelines(apps, schema_editor):
+    # The same INSERT ... SELECT as SNS.timeline.rebuild_all(): every user's
+    # own posts, their followees' posts and their followees' reposts, keyed
+    # by the latest repost or else the post date.
+    CustomUser = apps.get_model('SNS', 'CustomUser')
+    Post = apps.get_model('SNS', 'Post')
+    Repost = apps.get_model('SNS', 'Repost')
+    TimelineEntry = apps.get_model('SNS', 'TimelineEntry')
+    Follow = CustomUser._meta.get_field('followers').remote_field.through
+    qn = schema_editor.connection.ops.quote_name
+    schema_editor.execute("""
+        INSERT INTO %(entry)s (owner_id, post_id, %(keyDate)s)
+        SELECT owner, post,
+               COALESCE(MAX(CASE WHEN isRepost = 1 THEN d END), MAX(d))
+        FROM (
+            SELECT p.author_id AS owner, p.id AS post,
+                   p.pub_date AS d, 0 AS isRepost
+            FROM %(post)s p
+            UNION ALL
+            SELECT f.from_customuser_id, p.id, p.pub_date, 0
+            FROM %(post)s p
+            JOIN %(follow)s f ON f.to_customuser_id = p.author_id
+            UNION ALL
+            SELECT f.from_customuser_id, r.post_id, r.pub_date, 1
+            FROM %(repost)s r
+            JOIN %(follow)s f ON f.to_customuser_id = r.%(repostedBy)s
+        ) visible
+        GROUP BY owner, post
+    """ % {
+        'entry': qn(TimelineEntry._meta.db_table),
+        'post': qn(Post._meta.db_table),
+        'repost': qn(Repost._meta.db_table),
+        'follow': qn(Follow._meta.db_table),
+        'keyDate': qn('keyDate'),
+        'repostedBy': qn('repostedBy_id'),
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('keyDate', models.DateTimeField()),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline', to='SNS.CustomUser')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='SNS.Post')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='timelineentry',
+            index=models.Index(fields=['owner', '-keyDate', '-post'], name='SNS_timeline_owner_key_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='timelineentry',
+            unique_together={('owner', 'post')},
+        ),
+        migrations.RunPython(build_timelines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:22
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_existing(apps, schema_editor):
+    CustomUser = apps.get_model('SNS', 'CustomUser')
+    Post = apps.get_model('SNS', 'Post')
+    Repost = apps.get_model('SNS', 'Repost')
+    Like = CustomUser._meta.get_field('likes').remote_field.through
+
+    def count(model, column):
+        return Coalesce(Subquery(
+            model.objects.filter(
+                **{column: OuterRef('pk')}
+            ).order_by().values(column).annotate(n=Count('*')).values('n')
+        ), 0)
+
+    Post.objects.update(
+        likeCount=count(Like, 'post_id'),
+        repostCount=count(Repost, 'post_id'),
+        replyCount=count(Post, 'replyTo_id'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0002_timelineentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='likeCount',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='replyCount',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='repostCount',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:24
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_reposts(apps, schema_editor):
+    # Keep the most recent repost of each (repostedBy, post) pair.
+    Post = apps.get_model('SNS', 'Post')
+    Repost = apps.get_model('SNS', 'Repost')
+
+    duplicated = Repost.objects.values(
+        'repostedBy_id', 'post_id'
+    ).annotate(n=Count('id'), latest=Max('pub_date')).filter(n__gt=1)
+    for d in duplicated:
+        pairs = Repost.objects.filter(repostedBy_id=d['repostedBy_id'],
+                                      post_id=d['post_id'])
+        keep = pairs.filter(pub_date=d['latest']).order_by('-id').first()
+        pairs.exclude(id=keep.id).delete()
+        Post.objects.filter(id=d['post_id']).update(
+            repostCount=Repost.objects.filter(post_id=d['post_id']).count())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0003_post_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_reposts,
+                             migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['author', '-pub_date', '-id'], name='SNS_post_author_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='repost',
+            index=models.Index(fields=['repostedBy', '-pub_date', '-id'], name='SNS_repost_by_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='repost',
+            index=models.Index(fields=['post', 'repostedBy'], name='SNS_repost_post_by_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='repost',
+            constraint=models.UniqueConstraint(fields=('repostedBy', 'post'), name='SNS_repost_unique'),
+        ),
+    ]
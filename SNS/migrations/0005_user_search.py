@@ -0,0 +1,34 @@
+from django.db import OperationalError, migrations
+
+
+def create_user_fts(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE SNS_user_fts USING fts5(username, bio)")
+        except OperationalError:
+            # SQLite built without FTS5: search falls back to LIKE.
+            return
+        cursor.execute(
+            "INSERT INTO SNS_user_fts (rowid, username, bio) "
+            "SELECT c.user_id, u.username, c.bio "
+            "FROM SNS_customuser c JOIN auth_user u ON u.id = c.user_id")
+
+
+def drop_user_fts(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS SNS_user_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0004_timeline_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_user_fts, drop_user_fts),
+    ]
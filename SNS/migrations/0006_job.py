@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-17 22:42
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0005_user_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50)),
+                ('payload', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('runAt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('leasedBy', models.CharField(blank=True, max_length=64)),
+                ('leasedUntil', models.DateTimeField(null=True)),
+                ('lastError', models.TextField(blank=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'runAt'], name='SNS_job_status_run_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'finished'], name='SNS_job_status_done_idx'),
+        ),
+    ]
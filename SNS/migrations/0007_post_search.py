@@ -0,0 +1,75 @@
+import unicodedata
+
+from django.db import OperationalError, migrations
+
+# A frozen copy of SNS.search.index_text as of this migration, so that
+# later changes to the tokenizer do not change what this migration writes.
+
+CJK_RANGES = (
+    ('\u3040', '\u30ff'),  # Hiragana, Katakana
+    ('\u3400', '\u4dbf'),  # CJK Extension A
+    ('\u4e00', '\u9fff'),  # CJK Unified Ideographs
+    ('\uf900', '\ufaff'),  # CJK Compatibility Ideographs
+)
+
+
+def is_cjk(char):
+    return any(low <= char <= high for low, high in CJK_RANGES)
+
+
+def runs(text):
+    run, runCjk = '', False
+    for char in unicodedata.normalize('NFKC', text):
+        cjk = is_cjk(char)
+        if run and cjk != runCjk:
+            yield runCjk, run
+            run = ''
+        run += char
+        runCjk = cjk
+    if run:
+        yield runCjk, run
+
+
+def index_text(text):
+    parts = []
+    for cjk, run in runs(text):
+        if cjk:
+            parts.extend([run[i:i + 2] for i in range(len(run) - 1)]
+                         + [run[-1]])
+        else:
+            parts.append(run)
+    return ' '.join(parts)
+
+
+def create_post_fts(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE SNS_post_fts USING fts5(text)")
+        except OperationalError:
+            # SQLite built without FTS5: search falls back to LIKE.
+            return
+        Post = apps.get_model('SNS', 'Post')
+        cursor.executemany(
+            "INSERT INTO SNS_post_fts (rowid, text) VALUES (%s, %s)",
+            [(pk, index_text(text))
+             for pk, text in Post.objects.values_list('pk', 'text').iterator()])
+
+
+def drop_post_fts(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS SNS_post_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0006_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_post_fts, drop_post_fts),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.16 on 2026-10-17 23:16
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def count_existing(apps, schema_editor):
+    CustomUser = apps.get_model('SNS', 'CustomUser')
+    CustomUserStats = apps.get_model('SNS', 'CustomUserStats')
+    Post = apps.get_model('SNS', 'Post')
+    Follow = CustomUser._meta.get_field('followers').remote_field.through
+    Like = CustomUser._meta.get_field('likes').remote_field.through
+
+    def count(queryset, column):
+        return Coalesce(Subquery(
+            queryset.filter(
+                **{column: OuterRef('pk')}
+            ).order_by().values(column).annotate(n=Count('*')).values('n')
+        ), 0)
+
+    CustomUserStats.objects.bulk_create(
+        [CustomUserStats(customuser_id=pk)
+         for pk in CustomUser.objects.values_list('pk', flat=True)],
+        batch_size=500)
+    CustomUserStats.objects.update(
+        postCount=count(Post.objects.all(), 'author_id'),
+        followingCount=count(Follow.objects.all(), 'from_customuser_id'),
+        followerCount=count(Follow.objects.all(), 'to_customuser_id'),
+        likesReceived=count(Like.objects.all(), 'post__author_id'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0007_post_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomUserStats',
+            fields=[
+                ('customuser', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='SNS.customuser')),
+                ('postCount', models.PositiveIntegerField(default=0)),
+                ('followingCount', models.PositiveIntegerField(default=0)),
+                ('followerCount', models.PositiveIntegerField(default=0)),
+                ('likesReceived', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_existing, migrations.RunPython.noop),
+    ]
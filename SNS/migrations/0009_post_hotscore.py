@@ -0,0 +1,62 @@
+# Generated by Django 4.2.16 on 2026-10-17 23:19
+
+import datetime
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+
+# A frozen copy of SNS.ranking.score as of this migration, so that later
+# changes to the formula do not change what this migration writes.
+
+BATCH_SIZE = 500
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def score(pubDate, **counts):
+    weights = getattr(settings, 'SNS_HOT_WEIGHTS', {
+        'likeCount': 1.0,
+        'repostCount': 2.0,
+        'replyCount': 3.0,
+    })
+    halfLife = getattr(settings, 'SNS_HOT_HALF_LIFE', 24 * 3600)
+    engagement = sum(w * counts.get(field, 0)
+                     for field, w in weights.items())
+    age = (pubDate - EPOCH).total_seconds()
+    return math.log2(1 + max(engagement, 0)) + age / halfLife
+
+
+def score_existing(apps, schema_editor):
+    Post = apps.get_model('SNS', 'Post')
+    batch = []
+    for post in Post.objects.only('pub_date', 'likeCount', 'repostCount',
+                                  'replyCount').iterator():
+        post.hotScore = score(post.pub_date, likeCount=post.likeCount,
+                              repostCount=post.repostCount,
+                              replyCount=post.replyCount)
+        batch.append(post)
+        if len(batch) == BATCH_SIZE:
+            Post.objects.bulk_update(batch, ['hotScore'])
+            batch = []
+    Post.objects.bulk_update(batch, ['hotScore'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0008_customuserstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='hotScore',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-hotScore', '-id'], name='SNS_post_hot_idx'),
+        ),
+        migrations.RunPython(score_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.16 on 2026-10-17 23:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SNS', '0009_post_hotscore'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPost',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('replyTo_id', models.IntegerField(db_index=True, null=True)),
+                ('text', models.TextField(max_length=170)),
+                ('pub_date', models.DateTimeField()),
+                ('likeCount', models.PositiveIntegerField(default=0)),
+                ('repostCount', models.PositiveIntegerField(default=0)),
+                ('replyCount', models.PositiveIntegerField(default=0)),
+                ('archivedAt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archivedPosts', to='SNS.customuser')),
+            ],
+        ),
+    ]
@@ -18,6 +18,22 @@ class CustomUser(models.Model):
         return self.user.username
 
 
+class CustomUserStats(models.Model):
+    # Per-user counts kept current by SNS.stats; see "manage.py
+    # reconcile_stats".
+    customuser = models.OneToOneField(CustomUser,
+                                      on_delete=models.CASCADE,
+                                      primary_key=True,
+                                      related_name="stats")
+    postCount = models.PositiveIntegerField(default=0)
+    followingCount = models.PositiveIntegerField(default=0)
+    followerCount = models.PositiveIntegerField(default=0)
+    likesReceived = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.customuser_id)
+
+
 class Post(models.Model):
     author = models.ForeignKey("SNS.CustomUser",
                                on_delete=models.CASCADE,
@@ -27,6 +43,43 @@ class Post(models.Model):
                                 null=True)
     text = models.TextField(max_length=170)
     pub_date = models.DateTimeField(default=timezone.now)
+    likeCount = models.PositiveIntegerField(default=0, editable=False)
+    repostCount = models.PositiveIntegerField(default=0, editable=False)
+    replyCount = models.PositiveIntegerField(default=0, editable=False)
+    # Time-decayed engagement; see SNS.ranking.
+    hotScore = models.FloatField(default=0, editable=False)
+
+    archived = False
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["author", "-pub_date", "-id"],
+                         name="SNS_post_author_date_idx"),
+            models.Index(fields=["-hotScore", "-id"],
+                         name="SNS_post_hot_idx"),
+        ]
+
+    def __str__(self):
+        return str(self.author)
+
+
+class ArchivedPost(models.Model):
+    # An old post moved out of Post by SNS.retention.  It keeps its id and
+    # its counters as they were when it was archived.  Threads are archived
+    # whole, so replyTo_id refers to another ArchivedPost.
+    id = models.IntegerField(primary_key=True)
+    author = models.ForeignKey("SNS.CustomUser",
+                               on_delete=models.CASCADE,
+                               related_name="archivedPosts")
+    replyTo_id = models.IntegerField(null=True, db_index=True)
+    text = models.TextField(max_length=170)
+    pub_date = models.DateTimeField()
+    likeCount = models.PositiveIntegerField(default=0)
+    repostCount = models.PositiveIntegerField(default=0)
+    replyCount = models.PositiveIntegerField(default=0)
+    archivedAt = models.DateTimeField(default=timezone.now)
+
+    archived = True
 
     def __str__(self):
         return str(self.author)
@@ -39,5 +92,68 @@ class Repost(models.Model):
                             on_delete=models.CASCADE)
     pub_date = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["repostedBy", "-pub_date", "-id"],
+                         name="SNS_repost_by_date_idx"),
+            models.Index(fields=["post", "repostedBy"],
+                         name="SNS_repost_post_by_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["repostedBy", "post"],
+                                    name="SNS_repost_unique"),
+        ]
+
+    def __str__(self):
+        return str(self.post)
+
+
+class TimelineEntry(models.Model):
+    owner = models.ForeignKey(CustomUser,
+                              on_delete=models.CASCADE,
+                              related_name="timeline")
+    post = models.ForeignKey(Post,
+                             on_delete=models.CASCADE)
+    keyDate = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("owner", "post")
+        indexes = [
+            models.Index(fields=["owner", "-keyDate", "-post"],
+                         name="SNS_timeline_owner_key_idx"),
+        ]
+
     def __str__(self):
         return str(self.post)
+
+
+class Job(models.Model):
+    # A unit of deferred work run by "manage.py run_jobs"; see SNS.jobs.
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(s, s) for s in (PENDING, RUNNING, DONE, FAILED)]
+
+    kind = models.CharField(max_length=50)
+    payload = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUSES,
+                              default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    runAt = models.DateTimeField(default=timezone.now)
+    leasedBy = models.CharField(max_length=64, blank=True)
+    leasedUntil = models.DateTimeField(null=True)
+    lastError = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "runAt"],
+                         name="SNS_job_status_run_idx"),
+            models.Index(fields=["status", "finished"],
+                         name="SNS_job_status_done_idx"),
+        ]
+
+    def __str__(self):
+        return "%s #%d" % (self.kind, self.pk)
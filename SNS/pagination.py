@@ -0,0 +1,88 @@
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404
+
+# Keyset ("cursor") pagination.
+#
+# Pages are ordered by (date, id) descending and a cursor is the key of the
+# last item shown, so fetching the next page is a range scan that starts
+# where the previous page stopped instead of an OFFSET over everything
+# before it.  Ranked pages work the same way on (score, id).
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def page_size():
+    return getattr(settings, 'SNS_PAGE_SIZE', 20)
+
+
+def encode_cursor(date, pk):
+    delta = date - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return "%d_%d" % (micros, pk)
+
+
+def decode_cursor(cursor):
+    try:
+        micros, pk = cursor.split('_')
+        date = EPOCH + datetime.timedelta(microseconds=int(micros))
+        return date, int(pk)
+    except (ValueError, OverflowError):
+        raise Http404("Invalid cursor.")
+
+
+def encode_score_cursor(score, pk):
+    return '%r_%d' % (score, pk)
+
+
+def decode_score_cursor(cursor):
+    try:
+        score, pk = cursor.rsplit('_', 1)
+        return float(score), int(pk)
+    except ValueError:
+        raise Http404("Invalid cursor.")
+
+
+def keyset_page(queryset, cursor, dateField='pub_date', idField='id',
+                size=None, descending=True):
+    # Return (items, nextCursor) for the page of queryset that comes after
+    # `cursor`, newest first unless descending is False.  nextCursor is None
+    # on the last page.
+    size = size or page_size()
+    op, sign = ('__lt', '-') if descending else ('__gt', '')
+    if cursor:
+        date, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{dateField + op: date}) |
+            Q(**{dateField: date, idField + op: pk})
+        )
+    items = list(queryset.order_by(sign + dateField, sign + idField)[:size + 1])
+
+    nextCursor = None
+    if len(items) > size:
+        items = items[:size]
+        last = items[-1]
+        nextCursor = encode_cursor(getattr(last, dateField),
+                                   getattr(last, idField))
+    return items, nextCursor
+
+
+def score_page(queryset, cursor, scoreField, size=None):
+    # keyset_page() for queryset ranked by scoreField, highest first.
+    size = size or page_size()
+    if cursor:
+        score, pk = decode_score_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{scoreField + '__lt': score}) |
+            Q(**{scoreField: score, 'id__lt': pk})
+        )
+    items = list(queryset.order_by('-' + scoreField, '-id')[:size + 1])
+
+    nextCursor = None
+    if len(items) > size:
+        items = items[:size]
+        last = items[-1]
+        nextCursor = encode_score_cursor(getattr(last, scoreField), last.pk)
+    return items, nextCursor
@@ -0,0 +1,85 @@
+import datetime
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, FloatField, Value, When
+from django.utils import timezone
+
+from .models import Post
+from .pagination import EPOCH, score_page
+
+# Popular posts.
+#
+# A post's hotScore is log2(1 + weighted engagement) plus its publication
+# time in half-lives since EPOCH.  Ordering by it is the same as ordering by
+# (1 + engagement) * 2 ** (-age / half-life) at any moment, because the
+# current time shifts every score by the same amount, so scores never need
+# to be decayed: they only change when a post's counters change.  The
+# explore page is then a walk down the hotScore index.
+
+BATCH_SIZE = 500
+
+
+def weights():
+    return getattr(settings, 'SNS_HOT_WEIGHTS', {
+        'likeCount': 1.0,
+        'repostCount': 2.0,
+        'replyCount': 3.0,
+    })
+
+
+def half_life():
+    # Seconds after which a post needs twice the engagement to rank level
+    # with a new one.
+    return getattr(settings, 'SNS_HOT_HALF_LIFE', 24 * 3600)
+
+
+def window():
+    # Posts older than this many seconds are left off the explore page.
+    return getattr(settings, 'SNS_EXPLORE_WINDOW', 7 * 24 * 3600)
+
+
+def score(pubDate, **counts):
+    engagement = sum(w * counts.get(field, 0)
+                     for field, w in weights().items())
+    age = (pubDate - EPOCH).total_seconds()
+    return math.log2(1 + max(engagement, 0)) + age / half_life()
+
+
+def refresh(postIds):
+    # Recompute the scores of postIds from their counters, one UPDATE per
+    # batch.  The counters are read with their rows locked (SQLite, which
+    # has no row locks, ignores select_for_update; its transactions already
+    # hold the write lock), so no other writer changes them before the
+    # scores are written.
+    postIds = list(postIds)
+    fields = list(weights())
+    for i in range(0, len(postIds), BATCH_SIZE):
+        with transaction.atomic(savepoint=False):
+            rows = Post.objects.select_for_update().filter(
+                pk__in=postIds[i:i + BATCH_SIZE]
+            ).values_list('pk', 'pub_date', *fields)
+            scores = {pk: score(pubDate, **dict(zip(fields, counts)))
+                      for pk, pubDate, *counts in rows}
+            if scores:
+                Post.objects.filter(pk__in=scores).update(hotScore=Case(
+                    *[When(pk=pk, then=Value(s)) for pk, s in scores.items()],
+                    output_field=FloatField()))
+
+
+def rebuild():
+    # Recompute every score, e.g. after a bulk load; returns the number of
+    # posts.
+    postIds = list(Post.objects.values_list('pk', flat=True))
+    refresh(postIds)
+    return len(postIds)
+
+
+def explore_page(cursor=None, size=None):
+    # (posts, nextCursor) for a page of recent posts, most popular first.
+    since = timezone.now() - datetime.timedelta(seconds=window())
+    return score_page(
+        Post.objects.filter(pub_date__gte=since).select_related(
+            'replyTo', 'author__user'),
+        cursor, 'hotScore', size)
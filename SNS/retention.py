@@ -0,0 +1,263 @@
+import datetime
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import caching, jobs, search, stats
+from .models import ArchivedPost, CustomUser, Post, Repost, TimelineEntry
+
+# Retention for the hot tables.
+#
+# Archiving moves old conversations out of Post into ArchivedPost.  A
+# thread is archived whole, once its top-level post and every reply below
+# it are older than SNS_ARCHIVE_AFTER seconds, so each thread lives in one
+# table: timelines, the explore page and search only ever read Post, and
+# the detail page reads an archived thread from ArchivedPost with the same
+# query.  The archived posts' likes, reposts and timeline entries are
+# deleted with them; their counters keep the last values, and the users'
+# post and like counts still include them.  Each batch of threads moves in
+# a transaction of its own, so an interrupted run loses nothing and the
+# next run carries on.
+#
+# Deleting a post or an account runs as the jobs 'delete_posts' and
+# 'delete_account' instead of one cascade.  Each run deletes at most
+# DELETE_BATCH_SIZE rows, replies before the posts they answer, so that no
+# delete cascades any further than the rows of those posts.  With
+# SNS_ASYNC_FANOUT the run enqueues the next batch as a new job in the same
+# transaction, which makes the deletion resumable; otherwise the batches
+# run one after another, each in its own transaction.
+
+BATCH_SIZE = 200
+
+DELETE_BATCH_SIZE = 200
+
+Follow = CustomUser.followers.through
+Like = CustomUser.likes.through
+
+
+def archive_after():
+    return getattr(settings, 'SNS_ARCHIVE_AFTER', 365 * 24 * 3600)
+
+
+def _in(ids):
+    return ', '.join(['%s'] * len(ids))
+
+
+def _delete(model, column, ids):
+    # DELETE the rows whose column is in ids, without collecting them or
+    # sending signals.
+    qn = connection.ops.quote_name
+    ids = list(ids)
+    with connection.cursor() as cursor:
+        for i in range(0, len(ids), BATCH_SIZE):
+            chunk = ids[i:i + BATCH_SIZE]
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                qn(model._meta.db_table), qn(column), _in(chunk)), chunk)
+
+
+def _tree(model, rootIds, cutoff=None):
+    # (root id, post id, published before cutoff) for every post of the
+    # threads below rootIds in model's table.
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    replyTo = qn('replyTo_id')
+    sql = """
+        WITH RECURSIVE tree(root, id, parent, pub_date) AS (
+            SELECT id, id, %(replyTo)s, pub_date FROM %(table)s
+            WHERE id IN (%(roots)s)
+            UNION ALL
+            SELECT t.root, c.id, c.%(replyTo)s, c.pub_date
+            FROM %(table)s c JOIN tree t ON c.%(replyTo)s = t.id
+        )
+        SELECT root, id, parent, pub_date < %%s FROM tree
+    """ % {'table': table, 'replyTo': replyTo, 'roots': _in(rootIds)}
+    cutoff = connection.ops.adapt_datetimefield_value(
+        cutoff or timezone.now())
+    with connection.cursor() as cursor:
+        cursor.execute(sql, list(rootIds) + [cutoff])
+        return cursor.fetchall()
+
+
+def _archive(postIds):
+    fields = ('id', 'author_id', 'replyTo_id', 'text', 'pub_date',
+              'likeCount', 'repostCount', 'replyCount')
+    authors = set()
+    for i in range(0, len(postIds), BATCH_SIZE):
+        rows = list(Post.objects.filter(
+            pk__in=postIds[i:i + BATCH_SIZE]).values_list(*fields))
+        authors.update(row[1] for row in rows)
+        ArchivedPost.objects.bulk_create(
+            [ArchivedPost(**dict(zip(fields, row))) for row in rows],
+            ignore_conflicts=True)
+
+    owners, viewers = set(), set()
+    for i in range(0, len(postIds), BATCH_SIZE):
+        chunk = postIds[i:i + BATCH_SIZE]
+        owners.update(TimelineEntry.objects.filter(
+            post_id__in=chunk).values_list('owner_id', flat=True))
+        viewers.update(Like.objects.filter(
+            post_id__in=chunk).values_list('customuser_id', flat=True))
+        viewers.update(Repost.objects.filter(
+            post_id__in=chunk).values_list('repostedBy_id', flat=True))
+
+    # Replies and parents go in the same statement; the foreign keys are
+    # checked at commit.
+    for model, column in ((TimelineEntry, 'post_id'), (Like, 'post_id'),
+                          (Repost, 'post_id'), (Post, 'id')):
+        _delete(model, column, postIds)
+    search.unindex_posts(postIds)
+    caching.bump_posts(postIds)
+    caching.bump_timelines(owners)
+    caching.bump_viewers(viewers)
+    # The authors' profile pages list posts that are gone.
+    caching.bump_users(authors)
+
+
+def archive_batch(cutoff, after=0, size=BATCH_SIZE):
+    # Archive the threads, among the next `size` top-level posts after id
+    # `after` published before cutoff, that have no reply from cutoff or
+    # later.  Returns (posts archived, last top-level id examined), the
+    # latter None when there are no more.
+    rootIds = list(Post.objects.filter(
+        replyTo__isnull=True, pub_date__lt=cutoff, pk__gt=after
+    ).order_by('pk').values_list('pk', flat=True)[:size])
+    if not rootIds:
+        return 0, None
+    with transaction.atomic():
+        rows = _tree(Post, rootIds, cutoff)
+        young = {root for root, _, _, old in rows if not old}
+        postIds = [pk for root, pk, _, _ in rows if root not in young]
+        _archive(postIds)
+    return len(postIds), rootIds[-1]
+
+
+def archive(seconds=None, size=BATCH_SIZE):
+    # Archive every thread older than seconds (archive_after() by default)
+    # and return the number of posts archived.
+    cutoff = timezone.now() - datetime.timedelta(
+        seconds=archive_after() if seconds is None else seconds)
+    total, after = 0, 0
+    while after is not None:
+        count, after = archive_batch(cutoff, after, size)
+        total += count
+    return total
+
+
+def _delete_posts_batch(postIds):
+    # Delete up to DELETE_BATCH_SIZE posts of the threads below postIds,
+    # replies first; returns whether there was anything to delete.
+    for model in (Post, ArchivedPost):
+        rootIds = list(model.objects.filter(
+            pk__in=postIds).values_list('pk', flat=True))
+        if not rootIds:
+            continue
+        rows = _tree(model, rootIds)
+        parents = {parent for _, _, parent, _ in rows}
+        leaves = [pk for _, pk, _, _ in rows
+                  if pk not in parents][:DELETE_BATCH_SIZE]
+        if model is Post:
+            # The signal receivers keep counters, stats, timelines and the
+            # search index right.
+            Post.objects.filter(pk__in=leaves).delete()
+        else:
+            _delete_archived(leaves)
+        return True
+    return False
+
+
+def _delete_archived(postIds):
+    # Delete archived posts that have no replies, adjusting their parents'
+    # reply counts and their authors' stats.
+    posts = list(ArchivedPost.objects.filter(pk__in=postIds).values_list(
+        'author_id', 'replyTo_id', 'likeCount'))
+    ArchivedPost.objects.filter(pk__in=postIds).delete()
+
+    byCount = defaultdict(list)
+    for parent, n in Counter(replyTo for _, replyTo, _ in posts
+                             if replyTo is not None).items():
+        byCount[n].append(parent)
+    for n, parents in byCount.items():
+        ArchivedPost.objects.filter(pk__in=parents).update(
+            replyCount=F('replyCount') - n)
+        caching.bump_posts(parents)
+
+    postCounts, likeCounts = Counter(), Counter()
+    for author, _, likeCount in posts:
+        postCounts[author] -= 1
+        likeCounts[author] -= likeCount
+    stats.bump(postCounts, 'postCount')
+    stats.bump(likeCounts, 'likesReceived')
+
+
+def _delete_account_batch(customuserId):
+    # One batch of deleting an account: its posts with the replies below
+    # them, then its archived posts, likes, reposts, follows and timeline,
+    # and last the account itself.  Returns whether anything was deleted.
+    size = DELETE_BATCH_SIZE
+    for model in (Post, ArchivedPost):
+        postIds = list(model.objects.filter(
+            author_id=customuserId).values_list('pk', flat=True)[:size])
+        if postIds:
+            return _delete_posts_batch(postIds)
+
+    customuser = CustomUser.objects.filter(pk=customuserId).first()
+    if customuser is None:
+        return False
+    # The related managers send m2m_changed, so counters and stats follow.
+    likedIds = list(Like.objects.filter(
+        customuser_id=customuserId).values_list('post_id', flat=True)[:size])
+    if likedIds:
+        customuser.likes.remove(*likedIds)
+        return True
+    repostIds = list(Repost.objects.filter(
+        repostedBy_id=customuserId).values_list('pk', flat=True)[:size])
+    if repostIds:
+        Repost.objects.filter(pk__in=repostIds).delete()
+        return True
+    followingIds = list(Follow.objects.filter(
+        from_customuser_id=customuserId
+    ).values_list('to_customuser_id', flat=True)[:size])
+    if followingIds:
+        customuser.followers.remove(*followingIds)
+        return True
+    followerIds = list(Follow.objects.filter(
+        to_customuser_id=customuserId
+    ).values_list('from_customuser_id', flat=True)[:size])
+    if followerIds:
+        customuser.customuser_set.remove(*followerIds)
+        return True
+    entryIds = list(TimelineEntry.objects.filter(
+        owner_id=customuserId).values_list('pk', flat=True)[:size])
+    if entryIds:
+        TimelineEntry.objects.filter(pk__in=entryIds).delete()
+        return True
+    User.objects.filter(pk=customuserId).delete()
+    return True
+
+
+def _run_batches(kind, step, **payload):
+    # Call step(**payload) until it finds nothing to do; see the module
+    # comment.
+    if jobs.async_enabled():
+        if step(**payload):
+            jobs.enqueue(kind, **payload)
+        return
+    more = True
+    while more:
+        with transaction.atomic():
+            more = step(**payload)
+
+
+@jobs.handler('delete_posts')
+def delete_posts(postIds):
+    _run_batches('delete_posts', _delete_posts_batch, postIds=postIds)
+
+
+@jobs.handler('delete_account')
+def delete_account(customuserId):
+    _run_batches('delete_account', _delete_account_batch,
+                 customuserId=customuserId)
@@ -0,0 +1,261 @@
+import re
+import unicodedata
+
+from django.db import connection
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+
+from .models import CustomUser, Post
+from .pagination import (decode_score_cursor, encode_score_cursor,
+                         keyset_page, page_size)
+
+# User and post search.
+#
+# Username prefix search is a range scan over the unique index on
+# auth_user.username.  On SQLite builds with FTS5 the full-text mode
+# matches words of usernames and bios through the SNS_user_fts virtual
+# table, which the signal receivers keep in sync; other databases fall back
+# to substring matching.
+#
+# Posts are searched the same way through SNS_post_fts.  FTS5's unicode61
+# tokenizer splits on spaces and punctuation, which Japanese text has few
+# of, so post text is tokenized here before it is indexed: runs of kana and
+# kanji become overlapping bigrams (東京都 -> 東京 京都 都) and a query for
+# a run becomes the phrase of its bigrams, which matches the run anywhere
+# inside a longer one.  Results are ordered by BM25 rank and paged on
+# (rank, post id).
+
+USER_FTS = 'SNS_user_fts'
+POST_FTS = 'SNS_post_fts'
+
+BATCH_SIZE = 1000
+
+CJK_RANGES = (
+    ('\u3040', '\u30ff'),  # Hiragana, Katakana
+    ('\u3400', '\u4dbf'),  # CJK Extension A
+    ('\u4e00', '\u9fff'),  # CJK Unified Ideographs
+    ('\uf900', '\ufaff'),  # CJK Compatibility Ideographs
+)
+
+WORD = re.compile(r'\w+')
+
+# Sorts after every character, so [prefix, prefix + MAX_CHAR) is the range
+# of strings starting with prefix under binary collation.
+MAX_CHAR = '\U0010ffff'
+
+
+def fts_enabled(table=USER_FTS):
+    # Whether the FTS5 table exists; a positive answer is remembered on the
+    # connection.
+    if connection.vendor != 'sqlite':
+        return False
+    known = connection.__dict__.setdefault('_snsFts', set())
+    if table in known:
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+            [table])
+        if cursor.fetchone() is None:
+            return False
+    known.add(table)
+    return True
+
+
+def match_expression(query):
+    # An FTS5 query matching every word of query as a prefix, with all
+    # syntax characters quoted away.
+    words = query.split()
+    return ' '.join('"%s"*' % w.replace('"', '""') for w in words)
+
+
+def prefix_filter(queryset, prefix, field='user__username'):
+    return queryset.filter(**{
+        field + '__gte': prefix,
+        field + '__lt': prefix + MAX_CHAR,
+    })
+
+
+def search_users(queryset, query, fullText=False):
+    # Narrow a CustomUser queryset to the users matching query.
+    if not query:
+        return queryset
+    if not fullText:
+        return prefix_filter(queryset, query)
+    if fts_enabled():
+        return queryset.filter(pk__in=RawSQL(
+            'SELECT rowid FROM %s WHERE %s MATCH %%s' % (USER_FTS, USER_FTS),
+            [match_expression(query)]))
+    for word in query.split():
+        queryset = queryset.filter(Q(user__username__icontains=word) |
+                                   Q(bio__icontains=word))
+    return queryset
+
+
+def index_users(customusers):
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        for c in customusers:
+            cursor.execute("DELETE FROM %s WHERE rowid = %%s" % USER_FTS,
+                           [c.pk])
+            cursor.execute(
+                "INSERT INTO %s (rowid, username, bio) VALUES (%%s, %%s, %%s)"
+                % USER_FTS,
+                [c.pk, c.user.username, c.bio])
+
+
+def unindex_users(pks):
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        for pk in pks:
+            cursor.execute("DELETE FROM %s WHERE rowid = %%s" % USER_FTS,
+                           [pk])
+
+
+def rebuild_user_index():
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s" % USER_FTS)
+    index_users(CustomUser.objects.select_related('user').iterator())
+
+
+def is_cjk(char):
+    return any(low <= char <= high for low, high in CJK_RANGES)
+
+
+def _runs(text):
+    # (isCjk, run) pieces of text after NFKC normalization, which also
+    # turns full-width letters and half-width kana into their usual forms.
+    run, runCjk = '', False
+    for char in unicodedata.normalize('NFKC', text):
+        cjk = is_cjk(char)
+        if run and cjk != runCjk:
+            yield runCjk, run
+            run = ''
+        run += char
+        runCjk = cjk
+    if run:
+        yield runCjk, run
+
+
+def bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def index_text(text):
+    # The text stored in SNS_post_fts: other scripts are left to unicode61,
+    # each kana/kanji run becomes its bigrams plus its last character, so
+    # that every character starts some token.
+    parts = []
+    for cjk, run in _runs(text):
+        if cjk:
+            parts.extend(bigrams(run) + [run[-1]])
+        else:
+            parts.append(run)
+    return ' '.join(parts)
+
+
+def post_match_expression(query):
+    # An FTS5 query for the posts containing every word of query: other
+    # words match as prefixes, kana/kanji runs as the phrase of their
+    # bigrams, or as a prefix when they are a single character.
+    terms = []
+    for cjk, run in _runs(query):
+        if not cjk:
+            terms.extend('"%s"*' % w for w in WORD.findall(run))
+        elif len(run) == 1:
+            terms.append('"%s"*' % run)
+        else:
+            terms.append('"%s"' % ' '.join(bigrams(run)))
+    return ' '.join(terms)
+
+
+def search_posts(query, cursor=None, size=None):
+    # Return (posts, nextCursor) for the page of posts matching query after
+    # cursor, best match first.  nextCursor is None on the last page.
+    size = size or page_size()
+    posts = Post.objects.select_related('replyTo', 'author__user')
+    if not fts_enabled(POST_FTS):
+        for word in query.split():
+            posts = posts.filter(text__icontains=word)
+        return keyset_page(posts, cursor, size=size)
+
+    expression = post_match_expression(query)
+    if not expression:
+        return [], None
+    ranked = ("SELECT rowid, rank FROM (SELECT rowid, bm25(%s) AS rank "
+              "FROM %s WHERE %s MATCH %%s)" % (POST_FTS, POST_FTS, POST_FTS))
+    params = [expression]
+    if cursor:
+        rank, pk = decode_score_cursor(cursor)
+        ranked += " WHERE rank > %s OR (rank = %s AND rowid > %s)"
+        params += [rank, rank, pk]
+    ranked += " ORDER BY rank, rowid LIMIT %s"
+    params.append(size + 1)
+
+    # The subquery of the page's (rowid, rank) pairs does not refer to the
+    # outer query, so SQLite runs it once and each post's rank is looked up
+    # in its result; a bm25() per post would redo the match for every row.
+    qn = connection.ops.quote_name
+    pkColumn = '%s.%s' % (qn(Post._meta.db_table), qn(Post._meta.pk.column))
+    posts = posts.filter(
+        pk__in=RawSQL("SELECT rowid FROM (%s)" % ranked, params),
+    ).annotate(rank=RawSQL(
+        "SELECT rank FROM (%s) WHERE rowid = %s" % (ranked, pkColumn),
+        params, output_field=FloatField()))
+    items = list(posts.order_by('rank', 'pk'))
+
+    nextCursor = None
+    if len(items) > size:
+        items = items[:size]
+        nextCursor = encode_score_cursor(items[-1].rank, items[-1].pk)
+    return items, nextCursor
+
+
+def index_posts(posts):
+    if not fts_enabled(POST_FTS):
+        return
+    rows = [(p.pk, index_text(p.text)) for p in posts]
+    with connection.cursor() as cursor:
+        cursor.executemany("DELETE FROM %s WHERE rowid = %%s" % POST_FTS,
+                           [(pk,) for pk, _ in rows])
+        cursor.executemany(
+            "INSERT INTO %s (rowid, text) VALUES (%%s, %%s)" % POST_FTS, rows)
+
+
+def unindex_posts(pks):
+    if not fts_enabled(POST_FTS):
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany("DELETE FROM %s WHERE rowid = %%s" % POST_FTS,
+                           [(pk,) for pk in pks])
+
+
+def rebuild_post_index(batchSize=BATCH_SIZE):
+    # Reindex every post in batches and merge the index segments; returns
+    # the number of posts indexed.
+    if not fts_enabled(POST_FTS):
+        return 0
+    count = 0
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s" % POST_FTS)
+        rows = Post.objects.order_by('pk').values_list('pk', 'text')
+        batch = []
+        for pk, text in rows.iterator(chunk_size=batchSize):
+            batch.append((pk, index_text(text)))
+            if len(batch) == batchSize:
+                count += _insert_posts(cursor, batch)
+                batch = []
+        count += _insert_posts(cursor, batch)
+        cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')"
+                       % (POST_FTS, POST_FTS))
+    return count
+
+
+def _insert_posts(cursor, rows):
+    cursor.executemany(
+        "INSERT INTO %s (rowid, text) VALUES (%%s, %%s)" % POST_FTS, rows)
+    return len(rows)
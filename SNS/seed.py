@@ -0,0 +1,146 @@
+import datetime
+import random
+from itertools import accumulate
+
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+
+from . import counters, graph, ranking, search, stats, timeline
+from .models import CustomUser, Post, Repost
+
+# Synthetic data for benchmarks.
+#
+# Rows are written with bulk_create and explicit primary keys, so no signal
+# receivers run: call rebuild_derived() afterwards to fill the materialized
+# timelines and counters.  Explicit ids do not advance the id sequences of
+# PostgreSQL and Oracle, so seed() resets them past the new rows.
+#
+# Popularity follows a power law: the i-th user is followed, and their posts
+# are liked and reposted, with a weight proportional to 1 / i**alpha, so a
+# few accounts get most of the attention as on a real network.
+
+BATCH_SIZE = 500
+
+Follow = CustomUser.followers.through
+Like = CustomUser.likes.through
+
+
+def _next_id(model):
+    return (model.objects.aggregate(m=Max('pk'))['m'] or 0) + 1
+
+
+def _reset_sequences(models):
+    # No statements on SQLite and MySQL, whose counters follow the rows.
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+
+
+def _power_law(n, alpha):
+    return [1.0 / (i + 1) ** alpha for i in range(n)]
+
+
+def _sample_pairs(rng, count, limit, draw):
+    # `count` distinct pairs produced by draw(), or fewer if there are not
+    # that many (`limit` bounds the number of possible pairs).
+    pairs = set()
+    attempts = 0
+    target = min(count, limit)
+    while len(pairs) < target and attempts < target * 20:
+        pair = draw()
+        if pair is not None:
+            pairs.add(pair)
+        attempts += 1
+    return pairs
+
+
+def seed(users=100, posts=2000, follows=20, reposts=500, likes=2000,
+         replies=0.2, days=30, alpha=1.0, rng=None):
+    # Create `users` accounts following `follows` others on average, then
+    # `posts` posts of which a fraction `replies` answer an earlier post,
+    # and `likes` likes and `reposts` reposts of earlier posts, all spread
+    # over the last `days` days.  Returns the ids of the new users.
+    rng = rng or random.Random(0)
+    now = timezone.now()
+    start = now - datetime.timedelta(days=days)
+    span = (now - start).total_seconds()
+
+    firstUser = _next_id(User)
+    userIds = list(range(firstUser, firstUser + users))
+    popularity = _power_law(users, alpha)
+    userWeights = list(accumulate(popularity))
+    User.objects.bulk_create(
+        [User(id=pk, username="seed%d" % pk, password="!",
+              date_joined=start) for pk in userIds],
+        batch_size=BATCH_SIZE)
+    CustomUser.objects.bulk_create(
+        [CustomUser(user_id=pk, bio="seeded user %d" % pk) for pk in userIds],
+        batch_size=BATCH_SIZE)
+
+    def drawFollow():
+        a = rng.choice(userIds)
+        b = rng.choices(userIds, cum_weights=userWeights)[0]
+        return (a, b) if a != b else None
+
+    edges = _sample_pairs(rng, users * follows, users * (users - 1),
+                          drawFollow)
+    Follow.objects.bulk_create(
+        [Follow(from_customuser_id=a, to_customuser_id=b) for a, b in edges],
+        batch_size=BATCH_SIZE)
+
+    # Posts are numbered in publication order, so a reply always points to
+    # a smaller id and engagement always comes after the post.
+    firstPost = _next_id(Post)
+    postIds = list(range(firstPost, firstPost + posts))
+    offsets = sorted(rng.uniform(0, span) for _ in postIds)
+    pubDates = [start + datetime.timedelta(seconds=s) for s in offsets]
+    authors = rng.choices(userIds, cum_weights=userWeights, k=posts)
+
+    def later(i):
+        return pubDates[i] + datetime.timedelta(
+            seconds=rng.uniform(0, (now - pubDates[i]).total_seconds()))
+
+    newPosts = []
+    for i, pk in enumerate(postIds):
+        replyTo = None
+        if i and rng.random() < replies:
+            replyTo = postIds[rng.randrange(i)]
+        newPosts.append(Post(id=pk, author_id=authors[i], replyTo_id=replyTo,
+                             text="post %d" % pk, pub_date=pubDates[i]))
+    Post.objects.bulk_create(newPosts, batch_size=BATCH_SIZE)
+    _reset_sequences([User, Post])
+
+    # Engagement goes to popular authors' posts.
+    postWeights = list(accumulate(
+        popularity[authors[i] - firstUser] for i in range(posts)))
+
+    def drawEngagement():
+        return (rng.choice(userIds),
+                rng.choices(range(posts), cum_weights=postWeights)[0])
+
+    Like.objects.bulk_create(
+        [Like(customuser_id=u, post_id=postIds[i])
+         for u, i in _sample_pairs(rng, likes, users * posts,
+                                   drawEngagement)],
+        batch_size=BATCH_SIZE)
+    Repost.objects.bulk_create(
+        [Repost(repostedBy_id=u, post_id=postIds[i], pub_date=later(i))
+         for u, i in _sample_pairs(rng, reposts, users * posts,
+                                   drawEngagement)],
+        batch_size=BATCH_SIZE)
+
+    return userIds
+
+
+def rebuild_derived():
+    # Fill the tables that signal receivers normally maintain.
+    counters.rebuild()
+    ranking.rebuild()
+    stats.reconcile()
+    timeline.rebuild_all()
+    graph.reset()
+    search.rebuild_user_index()
+    search.rebuild_post_index()
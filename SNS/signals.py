@@ -0,0 +1,224 @@
+import threading
+
+from django.contrib.auth.models import User
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+from django.db.models import Q
+from django.dispatch import receiver
+
+from . import caching, counters, graph, jobs, ranking, search, stats
+from .models import CustomUser, Post, Repost, TimelineEntry
+
+# Posts currently being removed by a delete() cascade.  Their reposts are
+# deleted first, and refreshing timelines for them at that point would
+# recreate entries pointing at a row that is about to disappear.
+_deleting = threading.local()
+
+
+def _count(postIds, field, delta):
+    # Adjust a counter and invalidate the cached cards of those posts.
+    postIds = list(postIds)
+    counters.bump(postIds, field, delta)
+    caching.bump_posts(postIds)
+
+
+def _deleting_post_ids():
+    if not hasattr(_deleting, 'postIds'):
+        _deleting.postIds = set()
+    return _deleting.postIds
+
+
+@receiver(pre_save, sender=Post)
+def post_saving(sender, instance, **kwargs):
+    if instance._state.adding:
+        instance.hotScore = ranking.score(
+            instance.pub_date, likeCount=instance.likeCount,
+            repostCount=instance.repostCount, replyCount=instance.replyCount)
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, update_fields, **kwargs):
+    if created or not update_fields or 'text' in update_fields:
+        search.index_posts([instance])
+    if created:
+        jobs.enqueue('deliver_post', postId=instance.pk)
+        stats.bump({instance.author_id: 1}, 'postCount')
+        if instance.replyTo_id is not None:
+            _count([instance.replyTo_id], 'replyCount', 1)
+
+
+@receiver(pre_delete, sender=Post)
+def post_deleting(sender, instance, **kwargs):
+    _deleting_post_ids().add(instance.pk)
+    # The cascade deletes the post's likes without m2m_changed, and the
+    # instance's likeCount may be stale.
+    instance._likesLost = CustomUser.likes.through.objects.filter(
+        post_id=instance.pk).count()
+    caching.bump_timelines(TimelineEntry.objects.filter(
+        post_id=instance.pk
+    ).values_list('owner_id', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    _deleting_post_ids().discard(instance.pk)
+    search.unindex_posts([instance.pk])
+    stats.bump({instance.author_id: -1}, 'postCount')
+    stats.bump({instance.author_id: -instance.__dict__.pop('_likesLost', 0)},
+               'likesReceived')
+    if (instance.replyTo_id is not None and
+            instance.replyTo_id not in _deleting_post_ids()):
+        _count([instance.replyTo_id], 'replyCount', -1)
+
+
+@receiver(post_save, sender=Repost)
+def repost_saved(sender, instance, created, **kwargs):
+    if created:
+        jobs.enqueue('deliver_repost', repostedById=instance.repostedBy_id,
+                     postIds=[instance.post_id])
+        _count([instance.post_id], 'repostCount', 1)
+        caching.bump_viewers([instance.repostedBy_id])
+
+
+@receiver(post_delete, sender=Repost)
+def repost_deleted(sender, instance, **kwargs):
+    if instance.post_id not in _deleting_post_ids():
+        jobs.enqueue('deliver_repost', repostedById=instance.repostedBy_id,
+                     postIds=[instance.post_id])
+        _count([instance.post_id], 'repostCount', -1)
+        caching.bump_viewers([instance.repostedBy_id])
+
+
+@receiver(m2m_changed, sender=Repost)
+def reposts_added(sender, instance, action, reverse, pk_set, **kwargs):
+    # reposts.add() bulk-inserts Repost rows without post_save.  Removals go
+    # through QuerySet.delete() and are handled by repost_deleted.
+    if action != 'post_add':
+        return
+    if reverse:
+        for repostedById in pk_set:
+            jobs.enqueue('deliver_repost', repostedById=repostedById,
+                         postIds=[instance.pk])
+        _count([instance.pk], 'repostCount', len(pk_set))
+        caching.bump_viewers(pk_set)
+    else:
+        jobs.enqueue('deliver_repost', repostedById=instance.pk,
+                     postIds=sorted(pk_set))
+        _count(pk_set, 'repostCount', 1)
+        caching.bump_viewers([instance.pk])
+
+
+@receiver(m2m_changed, sender=CustomUser.likes.through)
+def likes_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # remove() reports every requested id, liked or not, so the likes that
+    # really go away are looked up before the rows are deleted.
+    if action in ('pre_remove', 'pre_clear'):
+        if reverse:
+            likes = sender.objects.filter(post_id=instance.pk)
+            column = 'customuser_id'
+        else:
+            likes = sender.objects.filter(customuser_id=instance.pk)
+            column = 'post_id'
+        if pk_set is not None:
+            likes = likes.filter(**{column + '__in': pk_set})
+        instance._removedLikeIds = list(likes.values_list(column, flat=True))
+        return
+    if action == 'post_add':
+        ids, delta = pk_set, 1
+    elif action in ('post_remove', 'post_clear'):
+        ids, delta = instance.__dict__.pop('_removedLikeIds', []), -1
+    else:
+        return
+
+    if reverse:
+        _count([instance.pk], 'likeCount', delta * len(ids))
+        stats.bump({instance.author_id: delta * len(ids)}, 'likesReceived')
+        caching.bump_viewers(ids)
+    else:
+        _count(ids, 'likeCount', delta)
+        stats.bump_likes(ids, delta)
+        caching.bump_viewers([instance.pk])
+
+
+@receiver(m2m_changed, sender=CustomUser.followers.through)
+def followers_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # As with likes, the follows that really go away are looked up first.
+    if action in ('pre_remove', 'pre_clear'):
+        if reverse:
+            follows = sender.objects.filter(to_customuser_id=instance.pk)
+            column = 'from_customuser_id'
+        else:
+            follows = sender.objects.filter(from_customuser_id=instance.pk)
+            column = 'to_customuser_id'
+        if pk_set is not None:
+            follows = follows.filter(**{column + '__in': pk_set})
+        instance._removedFollowIds = list(
+            follows.values_list(column, flat=True))
+        return
+    if action in ('post_remove', 'post_clear'):
+        pk_set = instance.__dict__.pop('_removedFollowIds', [])
+    elif action != 'post_add':
+        return
+    if not pk_set:
+        return
+
+    if reverse:
+        edges = [(pk, instance.pk) for pk in pk_set]
+    else:
+        edges = [(instance.pk, pk) for pk in pk_set]
+    graph.edges_changed(edges)
+    if action == 'post_add':
+        stats.bump_follows(edges, 1)
+    else:
+        stats.bump_follows(edges, -1)
+    caching.bump_viewers(a for a, _ in edges)
+
+    if reverse:
+        for pk in pk_set:
+            jobs.enqueue('follow_changed', ownerId=pk,
+                         followeeIds=[instance.pk])
+    else:
+        jobs.enqueue('follow_changed', ownerId=instance.pk,
+                     followeeIds=sorted(pk_set))
+
+
+@receiver(post_save, sender=CustomUser)
+def customuser_saved(sender, instance, created, **kwargs):
+    if created:
+        # The id may have belonged to a deleted user.
+        graph.changed([instance.pk])
+        stats.create([instance.pk])
+    search.index_users([instance])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields, **kwargs):
+    # Logins save last_login only; the index cares about username.
+    if created or (update_fields and 'username' not in update_fields):
+        return
+    search.index_users(CustomUser.objects.filter(
+        pk=instance.pk).select_related('user'))
+
+
+@receiver(pre_delete, sender=CustomUser)
+def customuser_deleting(sender, instance, **kwargs):
+    # The cascade deletes the user's follows and likes without m2m_changed;
+    # remember whose stats they counted towards.
+    Follow = CustomUser.followers.through
+    Like = CustomUser.likes.through
+    instance._statsEdges = list(Follow.objects.filter(
+        Q(from_customuser_id=instance.pk) | Q(to_customuser_id=instance.pk)
+    ).values_list('from_customuser_id', 'to_customuser_id'))
+    instance._statsLikedPosts = list(Like.objects.filter(
+        customuser_id=instance.pk).values_list('post_id', flat=True))
+
+
+@receiver(post_delete, sender=CustomUser)
+def customuser_deleted(sender, instance, **kwargs):
+    # The cascade deletes follow rows without m2m_changed.
+    edges = instance.__dict__.pop('_statsEdges', [])
+    graph.changed([instance.pk])
+    graph.edges_changed(edges)
+    stats.bump_follows(edges, -1)
+    stats.bump_likes(instance.__dict__.pop('_statsLikedPosts', []), -1)
+    search.unindex_users([instance.pk])
@@ -0,0 +1,118 @@
+from collections import Counter, defaultdict
+
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from . import caching
+from .models import ArchivedPost, CustomUser, CustomUserStats, Post
+
+# Denormalized per-user counts.
+#
+# Each user has one CustomUserStats row with their post, following,
+# follower and received-like counts, so a page of users shows its stats
+# through a join instead of a COUNT per user.  The signal receivers adjust
+# the rows with F() expressions as posts, follows and likes change, and
+# reconcile() recomputes them from the source tables when they drift, e.g.
+# after bulk loads, which skip the signals.  Every change bumps the users'
+# cache version, which validates their profile pages.  Archived posts still
+# count: their likes are gone, so their last likeCount stands in for them.
+
+Follow = CustomUser.followers.through
+Like = CustomUser.likes.through
+
+FIELDS = ('postCount', 'followingCount', 'followerCount', 'likesReceived')
+
+
+def of(customuser):
+    # customuser's stats row, or zeros if it has not been created yet.
+    try:
+        return customuser.stats
+    except CustomUserStats.DoesNotExist:
+        return CustomUserStats(customuser=customuser)
+
+
+def create(customuserIds):
+    CustomUserStats.objects.bulk_create(
+        [CustomUserStats(customuser_id=pk) for pk in customuserIds],
+        ignore_conflicts=True)
+
+
+def bump(deltas, field):
+    # Add deltas[customuserId] to field, with one UPDATE per distinct delta.
+    byDelta = defaultdict(list)
+    for pk, delta in deltas.items():
+        if delta:
+            byDelta[delta].append(pk)
+    for delta, pks in byDelta.items():
+        CustomUserStats.objects.filter(customuser_id__in=pks).update(
+            **{field: F(field) + delta})
+        caching.bump_users(pks)
+
+
+def bump_follows(edges, delta):
+    # edges are (follower, followee) pairs that were added or removed.
+    following = Counter(a for a, _ in edges)
+    followers = Counter(b for _, b in edges)
+    bump({pk: delta * n for pk, n in following.items()}, 'followingCount')
+    bump({pk: delta * n for pk, n in followers.items()}, 'followerCount')
+
+
+def bump_likes(postIds, delta):
+    # One like per post in postIds was added (delta 1) or removed (-1).
+    postIds = list(postIds)
+    if not postIds:
+        return
+    authors = dict(Post.objects.filter(
+        pk__in=postIds).values_list('pk', 'author_id'))
+    bump({author: delta * n for author, n in Counter(
+        authors[pk] for pk in postIds if pk in authors).items()},
+        'likesReceived')
+
+
+def _count(queryset, column):
+    return Coalesce(Subquery(
+        queryset.filter(
+            **{column: OuterRef('pk')}
+        ).order_by().values(column).annotate(n=Count('*')).values('n')
+    ), 0)
+
+
+def _sum(queryset, column, field):
+    return Coalesce(Subquery(
+        queryset.filter(
+            **{column: OuterRef('pk')}
+        ).order_by().values(column).annotate(n=Sum(field)).values('n')
+    ), 0)
+
+
+def expected_counts():
+    return {
+        'postCount': (_count(Post.objects.all(), 'author_id')
+                      + _count(ArchivedPost.objects.all(), 'author_id')),
+        'followingCount': _count(Follow.objects.all(), 'from_customuser_id'),
+        'followerCount': _count(Follow.objects.all(), 'to_customuser_id'),
+        'likesReceived': (
+            _count(Like.objects.all(), 'post__author_id')
+            + _sum(ArchivedPost.objects.all(), 'author_id', 'likeCount')),
+    }
+
+
+def reconcile():
+    # Create missing rows, recompute every count from the source tables and
+    # return the number of users whose stats were missing or had drifted.
+    missing = list(CustomUser.objects.filter(
+        stats__isnull=True).values_list('pk', flat=True))
+    create(missing)
+
+    expected = expected_counts()
+    drifted = list(CustomUserStats.objects.annotate(
+        **{'expected_' + f: expected[f] for f in FIELDS}
+    ).exclude(
+        **{f: F('expected_' + f) for f in FIELDS}
+    ).values_list('pk', flat=True))
+
+    for i in range(0, len(drifted), 500):
+        CustomUserStats.objects.filter(pk__in=drifted[i:i + 500]).update(
+            **expected_counts())
+    caching.bump_users(drifted)
+    return len(set(missing) | set(drifted))
@@ -0,0 +1,25 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from SNS import caching, cards
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def post_card(context, post):
+    # Render the card of post through the versioned card cache.
+    liked = post.pk in context.get('likedIds', ())
+    reposted = post.pk in context.get('repostedIds', ())
+    renderer = cards.for_request(context.get('request'))
+    return mark_safe(caching.post_card(
+        post, liked, reposted, lambda: renderer.card(post, liked, reposted)))
+
+
+@register.simple_tag(takes_context=True)
+def post_cards(context, posts, separator='<hr>'):
+    # Render the cards of a whole list of posts in one pass; see SNS.cards.
+    renderer = cards.for_request(context.get('request'))
+    return mark_safe(renderer.render(
+        posts, context.get('likedIds', ()), context.get('repostedIds', ()),
+        separator))
@@ -1,12 +1,33 @@
 import datetime
+import json
+import math
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.management import call_command
+from django.db import (IntegrityError, OperationalError, connection,
+                       connections, transaction)
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.urls import reverse
 
 from django.contrib.auth.models import User
 from django.contrib.auth import login
-from .models import CustomUser, Post, Repost
+from . import (auth, caching, cards, counters, database, feed, graph,
+               instrumentation, jobs, pagination, ranking, retention,
+               search, seed, stats, threads, timeline, transfer, viewer)
+from .middleware import InstrumentationMiddleware
+from .models import (ArchivedPost, CustomUser, CustomUserStats, Job, Post,
+                     Repost, TimelineEntry)
 
 def create_user(name):
     return User.objects.create(username=name, password="aaa")
@@ -53,7 +74,8 @@ class HomePostTests(TestCase):
         create_post(self.cuserA, "userA's post")
 
         response = self.client.get(reverse("home"))
-        self.assertQuerysetEqual(response.context["posts"], ["<Post: userA>"])
+        self.assertQuerySetEqual(response.context["posts"], ["<Post: userA>"],
+                                 transform=repr)
 
     # フォローしている他ユーザーのポストを表示する
     def test_show_if_I_follow(self):
@@ -65,7 +87,8 @@ class HomePostTests(TestCase):
         create_post(cuserB, "userB's post")
 
         response = self.client.get(reverse("home"))
-        self.assertQuerysetEqual(response.context["posts"], ["<Post: userB>"])
+        self.assertQuerySetEqual(response.context["posts"], ["<Post: userB>"],
+                                 transform=repr)
 
     # フォローしていない他ユーザーのポストを表示しない
     def test_not_show_if_not_I_follow(self):
@@ -74,7 +97,7 @@ class HomePostTests(TestCase):
         create_post(cuserB, "userB's post")
 
         response = self.client.get(reverse("home"))
-        self.assertQuerysetEqual(response.context["posts"], [])
+        self.assertQuerySetEqual(response.context["posts"], [])
 
     # フォローしている他ユーザーがリポストしたポストを表示する
     def test_show_if_my_followers_repost(self):
@@ -90,7 +113,8 @@ class HomePostTests(TestCase):
         cuserB.save()
 
         response = self.client.get(reverse("home"))
-        self.assertQuerysetEqual(response.context["posts"], ["<Post: userC>"])
+        self.assertQuerySetEqual(response.context["posts"], ["<Post: userC>"],
+                                 transform=repr)
 
     # フォローしていない他ユーザーがリポストしたポストを表示しない
     def test_not_show_if_none_of_my_followers_repost(self):
@@ -103,7 +127,7 @@ class HomePostTests(TestCase):
         cuserB.save()
 
         response = self.client.get(reverse("home"))
-        self.assertQuerysetEqual(response.context["posts"], [])
+        self.assertQuerySetEqual(response.context["posts"], [])
 
     # 複数のポストを新しく投稿されたものから表示する
     def test_show_multiple_posts_in_latest_first_order(self):
@@ -119,13 +143,13 @@ class HomePostTests(TestCase):
         self.cuserA.save()
 
         response = self.client.get(reverse("home"))
-        self.assertQuerysetEqual(response.context["posts"],
+        self.assertQuerySetEqual(response.context["posts"],
                                  ["<Post: userB>",
                                   "<Post: userA>",
                                   "<Post: userB>",
                                   "<Post: userB>",
                                   "<Post: userA>",
-                                  ])
+                                  ], transform=repr)
     # リポストされたポストはリポストの日付を並べ替えに使う
     def test_order_posts_with_post_pubdate_and_repost_pubdate(self):
         cuserB = create_customuser("userB")
@@ -140,10 +164,10 @@ class HomePostTests(TestCase):
         create_repost(cuserB,post,days=3)
 
         response = self.client.get(reverse("home"))
-        self.assertQuerysetEqual(response.context["posts"],
+        self.assertQuerySetEqual(response.context["posts"],
                                 ["<Post: userC>",
                                 "<Post: userA>",
-                                ])
+                                ], transform=repr)
     # 複数回リポストされたポストは最新のリポストの日付を並べ替えに使う
     # フォローしていない他ユーザーのリポスト日付は並べ替えに使わない
     def test_show_most_recently_reposted_post_first(self):
@@ -164,8 +188,1615 @@ class HomePostTests(TestCase):
         create_repost(cuserD,postB,days=8) # repost made by whom you don't follow
 
         response = self.client.get(reverse("home"))
-        self.assertQuerysetEqual(response.context["posts"],
+        self.assertQuerySetEqual(response.context["posts"],
                                 ["<Post: userC>",
                                 "<Post: userA>",
                                 "<Post: userB>",
-                                ])
+                                ], transform=repr)
+
+
+class TimelineEntryTests(TestCase):
+    def setUp(self):
+        self.cuserA = create_customuser("userA")
+        self.cuserB = create_customuser("userB")
+        self.cuserC = create_customuser("userC")
+
+    def entries(self, owner):
+        return list(TimelineEntry.objects.filter(owner=owner)
+                    .order_by('-keyDate').values_list('post_id', flat=True))
+
+    # 投稿するとフォロワーのタイムラインに配信される
+    def test_post_is_delivered_to_followers(self):
+        self.cuserA.followers.add(self.cuserB)
+        post = create_post(self.cuserB, "")
+
+        self.assertEqual(self.entries(self.cuserA), [post.id])
+        self.assertEqual(self.entries(self.cuserB), [post.id])
+        self.assertEqual(self.entries(self.cuserC), [])
+
+    # フォローすると過去のポストとリポストが補完される
+    def test_follow_backfills_and_unfollow_prunes(self):
+        postB = create_post(self.cuserB, "", days=1)
+        postC = create_post(self.cuserC, "", days=2)
+        create_repost(self.cuserB, postC, days=3)
+
+        self.cuserA.followers.add(self.cuserB)
+        self.assertEqual(self.entries(self.cuserA), [postC.id, postB.id])
+
+        self.cuserA.followers.remove(self.cuserB)
+        self.assertEqual(self.entries(self.cuserA), [])
+
+    # リポストを取り消すと投稿日時に戻る
+    def test_remove_repost_restores_pub_date(self):
+        post = create_post(self.cuserC, "", days=-1)
+        self.cuserA.followers.add(self.cuserB, self.cuserC)
+        self.cuserB.reposts.add(post)
+
+        entry = TimelineEntry.objects.get(owner=self.cuserA, post=post)
+        self.assertGreater(entry.keyDate, post.pub_date)
+
+        self.cuserB.reposts.remove(post)
+        entry.refresh_from_db()
+        self.assertEqual(entry.keyDate, post.pub_date)
+
+    # リポストされたポストを削除してもエラーにならない
+    def test_delete_reposted_post(self):
+        post = create_post(self.cuserC, "")
+        self.cuserA.followers.add(self.cuserB)
+        create_repost(self.cuserB, post)
+
+        post.delete()
+        self.assertEqual(self.entries(self.cuserA), [])
+
+    def test_rebuild_matches_incremental_entries(self):
+        postB = create_post(self.cuserB, "", days=1)
+        postC = create_post(self.cuserC, "", days=2)
+        self.cuserA.followers.add(self.cuserB)
+        create_repost(self.cuserB, postC, days=3)
+        expected = self.entries(self.cuserA)
+
+        TimelineEntry.objects.all().delete()
+        call_command("rebuild_timelines", stdout=StringIO())
+        self.assertEqual(self.entries(self.cuserA), expected)
+        self.assertEqual(expected, [postC.id, postB.id])
+
+
+@override_settings(SNS_PAGE_SIZE=2)
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+
+    def walk(self, url, key="object_list"):
+        pages = []
+        cursor = None
+        while True:
+            response = self.client.get(url, {"before": cursor} if cursor else {})
+            pages.append([p.text for p in response.context[key]])
+            cursor = response.context["nextCursor"]
+            if cursor is None:
+                return pages
+
+    # 同じ日時のポストもページをまたいで重複・欠落しない
+    def test_user_post_pages(self):
+        time = timezone.now()
+        for text in "abcde":
+            Post.objects.create(author=self.cuserA, text=text, pub_date=time)
+
+        pages = self.walk(reverse("user_post", kwargs={"pk": self.userA.id}))
+        self.assertEqual(pages, [["e", "d"], ["c", "b"], ["a"]])
+
+    # リポストの日付で並んだタイムラインもページ送りできる
+    def test_home_pages_follow_key_date(self):
+        cuserB = create_customuser("userB")
+        self.cuserA.followers.add(cuserB)
+        old = create_post(self.cuserA, "old", days=-3)
+        create_post(self.cuserA, "mid", days=-2)
+        create_post(cuserB, "new", days=-1)
+        create_repost(cuserB, old)
+
+        pages = self.walk(reverse("home"), "posts")
+        self.assertEqual(pages, [["old", "new"], ["mid"]])
+
+    def test_my_like_list_pages(self):
+        for days, text in enumerate("abc"):
+            self.cuserA.likes.add(create_post(self.cuserA, text, days=-days))
+
+        pages = self.walk(reverse("my_like_list"))
+        self.assertEqual(pages, [["a", "b"], ["c"]])
+
+    def test_invalid_cursor_returns_404(self):
+        response = self.client.get(reverse("home"), {"before": "x"})
+        self.assertEqual(response.status_code, 404)
+
+
+class TimelineMergeTests(TestCase):
+    # ソースのテーブルから直接組み立てたタイムラインと一致する
+    def test_build_matches_home_view_ordering(self):
+        cuserA = create_customuser("userA")
+        cuserB = create_customuser("userB")
+        cuserC = create_customuser("userC")
+        cuserD = create_customuser("userD")
+        cuserA.followers.add(cuserB, cuserC)
+
+        postB = create_post(cuserB, "", days=1)
+        postC = create_post(cuserC, "", days=2)
+        create_repost(cuserB, postC, days=4)
+        create_repost(cuserC, postB, days=5)
+        postA = create_post(cuserA, "", days=6)
+        create_repost(cuserC, postC, days=7)
+        create_repost(cuserD, postB, days=8)
+
+        built = list(timeline.build(cuserA.pk))
+        self.assertEqual([p.id for p in built], [postC.id, postA.id, postB.id])
+        self.assertEqual([str(u) for u in built[0].reposter],
+                         ["userC", "userB"])
+        self.assertEqual(built[1].reposter, [])
+
+        posts, _ = timeline.timeline_page(cuserA)
+        self.assertEqual([(p.id, p.keyDate) for p in posts],
+                         [(p.id, p.keyDate) for p in built])
+
+
+class ViewerStateTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+
+    # いいね・リポスト済みのポストには取り消しボタンを表示する
+    def test_buttons_reflect_likes_and_reposts(self):
+        liked = create_post(self.cuserA, "liked")
+        reposted = create_post(self.cuserA, "reposted")
+        self.cuserA.likes.add(liked)
+        self.cuserA.reposts.add(reposted)
+
+        response = self.client.get(reverse("home"))
+        self.assertEqual(response.context["likedIds"], {liked.id})
+        self.assertEqual(response.context["repostedIds"], {reposted.id})
+        self.assertContains(response, reverse("remove_like", kwargs={"pk": liked.id}))
+        self.assertContains(response, reverse("add_like", kwargs={"pk": reposted.id}))
+        self.assertContains(response, reverse("remove_repost", kwargs={"pk": reposted.id}))
+
+        response = self.client.get(reverse("post_detail", kwargs={"pk": liked.id}))
+        self.assertContains(response, reverse("remove_like", kwargs={"pk": liked.id}))
+
+    # フォロー中のユーザーは following と表示する
+    def test_user_list_follow_state(self):
+        cuserB = create_customuser("userB")
+        create_customuser("userC")
+        self.cuserA.followers.add(cuserB)
+
+        response = self.client.get(reverse("user_list"))
+        self.assertEqual(response.context["followingIds"], {cuserB.pk})
+        self.assertContains(response, reverse("unfollow", kwargs={"pk": cuserB.pk}))
+        self.assertContains(response, "NOT following", count=1)
+
+
+class ViewerSnapshotTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.cuserB = create_customuser("userB")
+        self.client.force_login(self.userA)
+        self.posts = [create_post(self.cuserB, "post%d" % i) for i in range(3)]
+
+    # ユーザーとCustomUserを一回のクエリで読み込む
+    def test_backend_loads_customuser_with_user(self):
+        with self.assertNumQueries(1):
+            user = auth.CustomUserBackend().get_user(self.userA.pk)
+            self.assertEqual(user.customuser.pk, self.cuserA.pk)
+
+    # キャッシュが温まればページのクエリは認証の一回と本文だけ
+    @override_settings(
+        SESSION_ENGINE="django.contrib.sessions.backends.cached_db")
+    def test_page_query_budget(self):
+        self.client.get(reverse("my_like_list"))
+        with self.assertNumQueries(2):
+            self.client.get(reverse("my_like_list"))
+
+    # 自分の操作でスナップショットが更新される
+    def test_snapshot_follows_viewer_writes(self):
+        self.assertEqual(viewer.snapshot(self.cuserA)["liked"], frozenset())
+        self.client.get(reverse("add_like", kwargs={"pk": self.posts[0].pk}))
+        self.client.get(reverse("follow", kwargs={"pk": self.cuserB.pk}))
+        state = viewer.snapshot(self.cuserA)
+        self.assertEqual(state["liked"], {self.posts[0].pk})
+        self.assertEqual(state["following"], {self.cuserB.pk})
+
+        response = self.client.get(reverse("user_post",
+                                           kwargs={"pk": self.cuserB.pk}))
+        self.assertEqual(response.context["likedIds"], {self.posts[0].pk})
+
+    # 上限を超えた集合はページ分だけ問い合わせる
+    @override_settings(SNS_VIEWER_SNAPSHOT_LIMIT=1)
+    def test_large_sets_are_read_per_page(self):
+        self.cuserA.likes.add(*self.posts[:2])
+        self.assertIsNone(viewer.snapshot(self.cuserA)["liked"])
+        self.assertEqual(
+            viewer.post_state(self.cuserA, self.posts)["likedIds"],
+            {self.posts[0].pk, self.posts[1].pk})
+
+
+class PostCounterTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+        self.post = create_post(self.cuserA, "")
+
+    def counts(self):
+        self.post.refresh_from_db()
+        return (self.post.likeCount, self.post.repostCount, self.post.replyCount)
+
+    # いいね・リポスト・返信でカウンターが増減する
+    def test_views_update_counters(self):
+        pk = self.post.pk
+        self.client.get(reverse("add_like", kwargs={"pk": pk}))
+        self.client.get(reverse("add_like", kwargs={"pk": pk}))
+        self.client.get(reverse("add_repost", kwargs={"pk": pk}))
+        self.client.post(reverse("reply_create", kwargs={"pk": pk}), {"text": "re"})
+        self.assertEqual(self.counts(), (1, 1, 1))
+
+        self.client.get(reverse("remove_like", kwargs={"pk": pk}))
+        self.client.get(reverse("remove_like", kwargs={"pk": pk}))
+        self.client.get(reverse("remove_repost", kwargs={"pk": pk}))
+        Post.objects.get(replyTo=self.post).delete()
+        self.assertEqual(self.counts(), (0, 0, 0))
+
+    def test_reverse_relations_update_counters(self):
+        cuserB = create_customuser("userB")
+        self.post.likes.add(self.cuserA, cuserB)
+        create_repost(cuserB, self.post)
+        self.assertEqual(self.counts(), (2, 1, 0))
+
+        self.post.likes.clear()
+        self.assertEqual(self.counts(), (0, 1, 0))
+
+    def test_rebuild_counters(self):
+        self.cuserA.likes.add(self.post)
+        Post.objects.filter(pk=self.post.pk).update(likeCount=5, repostCount=3)
+
+        out = StringIO()
+        call_command("rebuild_counters", stdout=out)
+        self.assertIn("1 post(s)", out.getvalue())
+        self.assertEqual(self.counts(), (1, 0, 0))
+
+
+class CachingTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+        caching.stats.clear()
+
+    # 変更がなければキャッシュから表示する
+    def test_second_request_hits_cache(self):
+        create_post(self.cuserA, "hello")
+        self.client.get(reverse("home"))
+        self.client.get(reverse("home"))
+
+        self.assertEqual(caching.stats["timeline_hits"], 1)
+        self.assertEqual(caching.stats["card_hits"], 1)
+
+    # 新しいポストでタイムラインのキャッシュが無効になる
+    def test_new_post_invalidates_timeline(self):
+        create_post(self.cuserA, "first")
+        self.client.get(reverse("home"))
+        create_post(self.cuserA, "second")
+
+        response = self.client.get(reverse("home"))
+        self.assertEqual([p.text for p in response.context["posts"]],
+                         ["second", "first"])
+
+    # いいねでカードのキャッシュが無効になる
+    def test_like_invalidates_card(self):
+        cuserB = create_customuser("userB")
+        post = create_post(self.cuserA, "hello")
+        self.client.get(reverse("home"))
+        post.likes.add(cuserB)
+
+        response = self.client.get(reverse("home"))
+        self.assertContains(response, "Likes: 1 ")
+        self.assertContains(response, reverse("add_like", kwargs={"pk": post.pk}))
+
+        self.client.get(reverse("add_like", kwargs={"pk": post.pk}))
+        response = self.client.get(reverse("home"))
+        self.assertContains(response, "Likes: 2 ")
+        self.assertContains(response, reverse("remove_like", kwargs={"pk": post.pk}))
+
+    # バージョンはカードのキャッシュとは別に保ち、追い出されない
+    def test_versions_outlive_the_card_cache(self):
+        post = create_post(self.cuserA, "hello")
+        caching.bump_posts([post.pk])
+        version = caching._version("post", post.pk)
+        self.assertGreater(version, 0)
+        caching.get_cache().clear()
+        self.assertEqual(caching._version("post", post.pk), version)
+
+    # 同時に上げたバージョンはどれも失われない
+    def test_concurrent_bumps_all_count(self):
+        post = create_post(self.cuserA, "hello")
+        version = caching._version("post", post.pk)
+
+        def bump():
+            for _ in range(50):
+                caching.bump_posts([post.pk])
+
+        threads = [threading.Thread(target=bump) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(caching._version("post", post.pk), version + 400)
+
+
+class RepostConstraintTests(TestCase):
+    # 同じユーザーが同じポストを二度リポストできない
+    def test_duplicate_repost_is_rejected(self):
+        cuserA = create_customuser("userA")
+        post = create_post(cuserA, "")
+        create_repost(cuserA, post)
+        cuserA.reposts.add(post)
+        self.assertEqual(Repost.objects.count(), 1)
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                create_repost(cuserA, post)
+
+
+class SeedTests(TestCase):
+    # 生成したデータから作ったタイムラインが逐次更新の結果と一致する
+    def test_rebuild_all_matches_incremental_rebuild(self):
+        userIds = seed.seed(users=20, posts=200, follows=5, likes=100,
+                            reposts=50)
+        seed.rebuild_derived()
+        bulk = set(TimelineEntry.objects.values_list("owner_id", "post_id", "keyDate"))
+
+        for pk in userIds:
+            timeline.rebuild(pk)
+        self.assertEqual(
+            set(TimelineEntry.objects.values_list("owner_id", "post_id", "keyDate")),
+            bulk)
+        self.assertEqual(counters.rebuild(), 0)
+
+    # 主キーを指定した一括作成の後でシーケンスを進める
+    def test_resets_sequences_past_seeded_ids(self):
+        with mock.patch.object(connection.ops, "sequence_reset_sql",
+                               return_value=[]) as reset:
+            seed.seed(users=3, posts=5, follows=1, likes=0, reposts=0)
+        reset.assert_called_once_with(mock.ANY, [User, Post])
+
+        user = User.objects.create(username="after")
+        self.assertEqual(User.objects.latest("pk"), user)
+
+    def test_bench_views_reports_percentiles(self):
+        call_command("seed_sns", users=10, posts=50, likes=20, reposts=10,
+                     follows=3, stdout=StringIO())
+        out = StringIO()
+        call_command("bench_views", requests=3, viewers=2, stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report["endpoints"]),
+                         {"home", "user_post", "post_detail", "user_list",
+                          "my_like_list"})
+        for stats in report["endpoints"].values():
+            self.assertLessEqual(stats["p50_ms"], stats["p99_ms"])
+            self.assertGreater(stats["queries_max"], 0)
+
+
+@override_settings(SNS_INSTRUMENTATION_SAMPLE_RATE=1.0)
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+        instrumentation.reset()
+
+    # パーセンタイルは最近順位法で求める
+    def test_percentile_is_nearest_rank(self):
+        self.assertEqual(instrumentation.percentile([1, 2], 50), 1)
+        self.assertEqual(instrumentation.percentile(range(1, 21), 95), 19)
+        self.assertEqual(instrumentation.percentile(range(1, 101), 99), 99)
+        self.assertEqual(instrumentation.percentile(range(1, 101), 100), 100)
+        self.assertEqual(instrumentation.percentile([5], 0), 5)
+
+    # リクエストごとに計測結果を JSON で記録する
+    def test_request_is_logged(self):
+        create_post(self.cuserA, "hello")
+        with self.assertLogs("SNS.instrumentation", "INFO") as logs:
+            response = self.client.get(reverse("home"))
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["view"], "home")
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["bytes"], len(response.content))
+        self.assertGreater(record["queries"], 0)
+        self.assertIsNotNone(record["render_ms"])
+        self.assertEqual(instrumentation.snapshot()["home"]["requests"], 1)
+
+    # 同じ SQL の繰り返し (N+1) を検出する
+    def test_duplicate_queries_are_flagged(self):
+        posts = [create_post(self.cuserA, str(i)) for i in range(3)]
+        recorder = instrumentation.Recorder()
+        with connection.execute_wrapper(recorder):
+            for p in posts:
+                Post.objects.get(pk=p.pk)
+
+        with self.assertLogs("SNS.instrumentation", "INFO"):
+            response = self.client.get(reverse("home"))
+        record = recorder.record(response.wsgi_request, response)
+        self.assertEqual(record["queries"], 3)
+        self.assertEqual(record["duplicates"][0]["count"], 3)
+
+    # レプリカでのクエリも同期・非同期の両方で数える
+    def test_replica_queries_are_counted(self):
+        def query():
+            with connections["replica"].cursor() as cursor:
+                cursor.execute("SELECT 1")
+
+        def view(request):
+            query()
+            return HttpResponse()
+
+        async def asyncView(request):
+            await sync_to_async(query)()
+            return HttpResponse()
+
+        request = RequestFactory().get("/")
+        replica = dict(connections.settings["default"])
+        with mock.patch.dict(connections.settings, {"replica": replica}):
+            try:
+                with self.assertLogs("SNS.instrumentation", "INFO") as logs:
+                    InstrumentationMiddleware(view)(request)
+                    async_to_sync(InstrumentationMiddleware(asyncView))(
+                        request)
+            finally:
+                connections["replica"].close()
+                del connections["replica"]
+        self.assertEqual(
+            [json.loads(r.getMessage())["queries"] for r in logs.records],
+            [1, 1])
+
+    def test_report_command_summarizes_log(self):
+        with self.assertLogs("SNS.instrumentation", "INFO") as logs:
+            self.client.get(reverse("home"))
+            self.client.get(reverse("home"))
+            self.client.get(reverse("user_list"))
+
+        with tempfile.NamedTemporaryFile("w", suffix=".log") as f:
+            f.write("\n".join(r.getMessage() for r in logs.records))
+            f.flush()
+            out = StringIO()
+            call_command("instrumentation_report", f.name, stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["home"]["requests"], 2)
+        self.assertEqual(report["user_list"]["requests"], 1)
+
+
+@override_settings(SNS_PAGE_SIZE=2)
+class UserListSearchTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+        for name, bio in [("alice", "likes tea"), ("alan", "coffee lover"),
+                          ("albert", "tea and cake"), ("bob", "tea")]:
+            CustomUser.objects.create(user=create_user(name), bio=bio)
+
+    def names(self, response):
+        return [str(c) for c in response.context["customuser_list"]]
+
+    # ユーザー名の前方一致で検索しページ送りできる
+    def test_prefix_search_pages(self):
+        response = self.client.get(reverse("user_list"), {"q": "al"})
+        self.assertEqual(self.names(response), ["alan", "albert"])
+
+        response = self.client.get(reverse("user_list"),
+                                   {"q": "al", "after": response.context["nextCursor"]})
+        self.assertEqual(self.names(response), ["alice"])
+        self.assertIsNone(response.context["nextCursor"])
+
+    # 自己紹介も全文検索できる
+    def test_full_text_search_matches_bio(self):
+        response = self.client.get(reverse("user_list"), {"q": "tea", "full": "1"})
+        self.assertEqual(self.names(response), ["albert", "alice"])
+
+    # 自己紹介の変更が検索結果に反映される
+    def test_bio_changes_are_indexed(self):
+        bob = CustomUser.objects.get(user__username="bob")
+        bob.bio = "coffee"
+        bob.save()
+
+        response = self.client.get(reverse("user_list"), {"q": "coffee", "full": "1"})
+        self.assertEqual(self.names(response), ["alan", "bob"])
+
+
+@override_settings(SNS_PAGE_SIZE=2)
+class PostSearchTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+
+    def texts(self, response):
+        return [p.text for p in response.context["post_list"]]
+
+    # 日本語はバイグラムで索引され、語の途中でも一致する
+    def test_japanese_text_matches_inside_words(self):
+        create_post(self.cuserA, "東京都に住んでいます")
+        create_post(self.cuserA, "京都へ旅行")
+        create_post(self.cuserA, "ｶﾀｶﾅのテスト")
+
+        response = self.client.get(reverse("post_search"), {"q": "京都"})
+        self.assertEqual(sorted(self.texts(response)),
+                         ["京都へ旅行", "東京都に住んでいます"])
+        response = self.client.get(reverse("post_search"), {"q": "東京"})
+        self.assertEqual(self.texts(response), ["東京都に住んでいます"])
+        response = self.client.get(reverse("post_search"), {"q": "行"})
+        self.assertEqual(self.texts(response), ["京都へ旅行"])
+        response = self.client.get(reverse("post_search"), {"q": "カタカナ"})
+        self.assertEqual(self.texts(response), ["ｶﾀｶﾅのテスト"])
+
+    # BM25の順位で並び、カーソルでページ送りできる
+    def test_results_are_ranked_and_paged(self):
+        create_post(self.cuserA, "tea")
+        create_post(self.cuserA, "tea tea tea")
+        create_post(self.cuserA, "tea and a long text about other things")
+        create_post(self.cuserA, "coffee")
+
+        response = self.client.get(reverse("post_search"), {"q": "tea"})
+        self.assertEqual(self.texts(response), ["tea tea tea", "tea"])
+        response = self.client.get(reverse("post_search"), {
+            "q": "tea", "after": response.context["nextCursor"]})
+        self.assertEqual(self.texts(response),
+                         ["tea and a long text about other things"])
+        self.assertIsNone(response.context["nextCursor"])
+
+    # 削除した投稿は検索結果から消え、再構築で索引が戻る
+    def test_deleted_posts_are_unindexed_and_rebuild_restores(self):
+        post = create_post(self.cuserA, "ramen")
+        create_post(self.cuserA, "ramen again")
+        post.delete()
+        self.assertEqual(
+            [p.text for p in search.search_posts("ramen")[0]], ["ramen again"])
+
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM SNS_post_fts")
+        self.assertEqual(search.search_posts("ramen")[0], [])
+        out = StringIO()
+        call_command("rebuild_search", stdout=out)
+        self.assertIn("Indexed 1 post(s).", out.getvalue())
+        self.assertEqual(
+            [p.text for p in search.search_posts("ramen")[0]], ["ramen again"])
+
+
+class ThreadTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+
+    def reply(self, post, text, minutes):
+        time = timezone.now() - datetime.timedelta(days=1) + \
+            datetime.timedelta(minutes=minutes)
+        return Post.objects.create(author=self.cuserA, text=text,
+                                   replyTo=post, pub_date=time)
+
+    def texts(self, nodes):
+        return [n.post.text for n in nodes]
+
+    # 祖先と返信ツリーを1クエリで読み込む
+    def test_loads_ancestors_and_replies_in_one_query(self):
+        root = create_post(self.cuserA, "root", -2)
+        middle = self.reply(root, "middle", 0)
+        post = self.reply(middle, "post", 1)
+        first = self.reply(post, "first", 2)
+        self.reply(post, "second", 3)
+        self.reply(first, "nested", 4)
+
+        with self.assertNumQueries(3):
+            thread = threads.load_thread(post.pk)
+            [p.author.user.username for p in thread.posts()]
+
+        self.assertEqual([p.text for p in thread.ancestors], ["root", "middle"])
+        self.assertEqual(thread.post, post)
+        self.assertEqual(self.texts(thread.root.children), ["first", "second"])
+        self.assertEqual(self.texts(thread.root.children[0].children), ["nested"])
+        self.assertIsNone(thread.root.moreCursor)
+
+    # 返信が多い場合は続きのカーソルを返す
+    @override_settings(SNS_THREAD_FAN_OUT=2, SNS_PAGE_SIZE=2)
+    def test_fan_out_is_bounded(self):
+        post = create_post(self.cuserA, "post", -2)
+        for i in range(5):
+            self.reply(post, "reply%d" % i, i)
+
+        thread = threads.load_thread(post.pk)
+        self.assertEqual(self.texts(thread.root.children), ["reply0", "reply1"])
+        self.assertEqual(thread.root.hiddenReplies, 3)
+
+        url = reverse("post_replies", kwargs={"pk": post.pk})
+        response = self.client.get(url, {"after": thread.root.moreCursor})
+        self.assertEqual([p.text for p in response.context["reply_list"]],
+                         ["reply2", "reply3"])
+        response = self.client.get(url, {"after": response.context["nextCursor"]})
+        self.assertEqual([p.text for p in response.context["reply_list"]],
+                         ["reply4"])
+        self.assertIsNone(response.context["nextCursor"])
+
+    # 深さの上限を超えた返信は読み込まない
+    @override_settings(SNS_THREAD_DEPTH=1)
+    def test_depth_is_bounded(self):
+        post = create_post(self.cuserA, "post", -2)
+        child = self.reply(post, "child", 0)
+        self.reply(child, "grandchild", 1)
+
+        thread = threads.load_thread(post.pk)
+        node = thread.root.children[0]
+        self.assertEqual(node.children, [])
+        self.assertEqual(node.hiddenReplies, 1)
+        self.assertEqual(node.moreCursor, "")
+
+    # 詳細ページにスレッドを表示する
+    def test_detail_view_shows_thread(self):
+        post = create_post(self.cuserA, "post", -2)
+        self.reply(post, "a reply", 0)
+
+        response = self.client.get(reverse("post_detail", kwargs={"pk": post.pk}))
+        self.assertContains(response, "a reply")
+        response = self.client.get(reverse("post_detail", kwargs={"pk": post.pk + 100}))
+        self.assertEqual(response.status_code, 404)
+
+
+class BulkActionTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+        self.cuserB = create_customuser("userB")
+        self.cuserC = create_customuser("userC")
+
+    def post(self, batch):
+        return self.client.post(reverse("bulk_actions"), json.dumps(batch),
+                                content_type="application/json")
+
+    # 複数の操作を1リクエストでまとめて適用する
+    def test_applies_batch(self):
+        postB = create_post(self.cuserB, "userB's post", -1)
+        postC = create_post(self.cuserC, "userC's post", -1)
+
+        response = self.post({"follow": [self.cuserB.pk, self.cuserC.pk],
+                              "like": [postB.pk, postC.pk, 9999],
+                              "repost": [postC.pk]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["like"],
+                         {"ok": [postB.pk, postC.pk], "missing": [9999]})
+        self.assertEqual(set(self.cuserA.followers.all()), {self.cuserB, self.cuserC})
+        self.assertEqual(set(self.cuserA.likes.all()), {postB, postC})
+        postC.refresh_from_db()
+        self.assertEqual((postC.likeCount, postC.repostCount), (1, 1))
+
+        response = self.client.get(reverse("home"))
+        self.assertEqual(set(response.context["posts"]), {postB, postC})
+
+    # 同じ操作を繰り返しても結果は変わらない
+    def test_is_idempotent(self):
+        postB = create_post(self.cuserB, "userB's post", -1)
+        for _ in range(2):
+            self.post({"like": [postB.pk], "repost": [postB.pk]})
+        postB.refresh_from_db()
+        self.assertEqual((postB.likeCount, postB.repostCount), (1, 1))
+
+        for _ in range(2):
+            self.post({"unlike": [postB.pk], "unrepost": [postB.pk]})
+        postB.refresh_from_db()
+        self.assertEqual((postB.likeCount, postB.repostCount), (0, 0))
+
+    # 不正なリクエストは何も変更せず400を返す
+    def test_rejects_invalid_batches(self):
+        for batch in [[1], {"poke": [1]}, {"like": "1"},
+                      {"follow": [self.cuserB.pk], "unfollow": [self.cuserB.pk]}]:
+            self.assertEqual(self.post(batch).status_code, 400)
+        response = self.client.post(reverse("bulk_actions"), "{",
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse("bulk_actions")).status_code, 405)
+        self.assertFalse(self.cuserA.followers.exists())
+
+    # ログインしていなければリダイレクトせずJSONで401を返す
+    def test_requires_authentication(self):
+        self.client.logout()
+        response = self.post({"follow": [self.cuserB.pk]})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {"error": "Authentication required."})
+        self.assertFalse(self.cuserA.followers.exists())
+
+
+@override_settings(SNS_ASYNC_FANOUT=True)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.cuserA = create_customuser("userA")
+        self.cuserB = create_customuser("userB")
+        self.cuserA.followers.add(self.cuserB)
+        jobs.work(once=True)
+
+    def timeline_of(self, customuser):
+        return set(TimelineEntry.objects.filter(
+            owner=customuser).values_list('post_id', flat=True))
+
+    # 投稿時は配信ジョブを登録するだけで、ワーカーが配信する
+    def test_post_is_delivered_by_worker(self):
+        post = create_post(self.cuserB, "userB's post", -1)
+        self.assertEqual(self.timeline_of(self.cuserA), set())
+        self.assertEqual(Job.objects.filter(status=Job.PENDING).count(), 1)
+
+        out = StringIO()
+        call_command("run_jobs", "--processes", "1", "--once", stdout=out)
+        self.assertEqual(json.loads(out.getvalue())["done"], 1)
+        self.assertEqual(self.timeline_of(self.cuserA), {post.pk})
+        self.assertEqual(jobs.metrics()["counts"]["done"], 2)
+
+    # 失敗したジョブは間隔を空けて再試行し、上限で失敗扱いにする
+    @override_settings(SNS_JOB_MAX_ATTEMPTS=2)
+    def test_failed_jobs_are_retried_with_backoff(self):
+        calls = []
+
+        def flaky(**payload):
+            calls.append(payload)
+            raise RuntimeError("boom")
+
+        jobs.HANDLERS["flaky"] = flaky
+        self.addCleanup(jobs.HANDLERS.pop, "flaky")
+        job = jobs.enqueue("flaky", n=1)
+
+        with self.assertLogs("SNS.jobs", "WARNING"):
+            self.assertEqual(jobs.work(once=True)["failed"], 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 1))
+        self.assertGreater(job.runAt, timezone.now())
+        self.assertIn("boom", job.lastError)
+        self.assertEqual(jobs.work(once=True)["failed"], 0)
+
+        Job.objects.filter(pk=job.pk).update(runAt=timezone.now())
+        with self.assertLogs("SNS.jobs", "WARNING"):
+            jobs.work(once=True)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertEqual(calls, [{"n": 1}, {"n": 1}])
+
+    # 投稿と配信ジョブは同じトランザクションで書く
+    def test_post_and_job_commit_together(self):
+        self.client.force_login(self.cuserB.user)
+        error = OperationalError("disk I/O error")
+        with mock.patch.object(Job.objects, "create", side_effect=error):
+            with self.assertRaises(OperationalError):
+                self.client.post(reverse("post_create"), {"text": "hello"})
+        self.assertFalse(Post.objects.filter(text="hello").exists())
+
+        self.client.post(reverse("post_create"), {"text": "hello"})
+        self.assertTrue(Post.objects.filter(text="hello").exists())
+        self.assertEqual(Job.objects.filter(status=Job.PENDING).count(), 1)
+
+    # リース中のジョブは他のワーカーに渡さず、期限切れなら再取得できる
+    def test_leases(self):
+        create_post(self.cuserB, "userB's post", -1)
+        self.assertEqual(len(jobs.claim("one", 10)), 1)
+        self.assertEqual(jobs.claim("two", 10), [])
+
+        Job.objects.update(leasedUntil=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(len(jobs.claim("two", 10)), 1)
+
+
+class FollowGraphTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.cuserB = create_customuser("userB")
+        self.cuserC = create_customuser("userC")
+        self.client.force_login(self.userA)
+
+    # フォローの追加と解除は読み込み済みの配列にその場で反映する
+    def test_applies_follow_changes_in_place(self):
+        a, b, c = self.cuserA.pk, self.cuserB.pk, self.cuserC.pk
+        d = create_customuser("userD").pk
+        ids = [a, b, c, d]
+        following = graph.get(following=ids, followers=ids).following[a]
+        self.cuserA.followers.add(self.cuserB, self.cuserC)
+        self.cuserB.customuser_set.add(self.cuserC)
+
+        # 変わった配列ごとに辺の有無を一回だけ確かめる
+        with self.assertNumQueries(4):
+            graph.get(following=ids, followers=ids)
+        with self.assertNumQueries(0):
+            follows = graph.get(following=ids, followers=ids)
+            self.assertIs(follows.following_of(a), following)
+            self.assertTrue(follows.follows(a, b))
+            self.assertFalse(follows.follows(b, a))
+            self.assertEqual(list(follows.following_of(a)), [b, c])
+            self.assertEqual(follows.follower_count(b), 2)
+            self.assertEqual(follows.mutuals(c), [])
+
+        self.cuserC.followers.add(self.cuserA)
+        self.assertEqual(graph.get(following=[a], followers=[a]).mutuals(a),
+                         [c])
+
+        self.cuserA.followers.clear()
+        self.assertEqual(graph.get(following=[a]).following_count(a), 0)
+        self.assertEqual(graph.get(followers=[b]).follower_count(b), 1)
+
+    # フォローの確認は片方向の配列だけを読み込む
+    def test_follows_loads_one_array(self):
+        self.cuserA.followers.add(self.cuserB)
+        graph.reset()
+        with self.assertNumQueries(1):
+            self.assertTrue(graph.follows(self.cuserA.pk, self.cuserB.pk))
+
+    # 削除されたユーザーの辺はグラフから消える
+    def test_forgets_deleted_users(self):
+        a = self.cuserA.pk
+        self.cuserA.followers.add(self.cuserB)
+        self.cuserB.followers.add(self.cuserA)
+        graph.get(following=[a], followers=[a])
+        self.cuserB.delete()
+
+        follows = graph.get(following=[a], followers=[a])
+        self.assertEqual(follows.following_count(a), 0)
+        self.assertEqual(follows.follower_count(a), 0)
+
+    # 他のプロセスの変更は差分から反映し、差分がなければ読み直す
+    def test_follows_changes_elsewhere(self):
+        a, b, c = self.cuserA.pk, self.cuserB.pk, self.cuserC.pk
+        graph.get(following=[a])
+        CustomUser.followers.through.objects.create(
+            from_customuser=self.cuserA, to_customuser=self.cuserB)
+        self.assertFalse(graph.get(following=[a]).follows(a, b))
+
+        graph.edges_changed([(a, b)])
+        with self.assertNumQueries(1):
+            self.assertTrue(graph.get(following=[a]).follows(a, b))
+
+        CustomUser.followers.through.objects.create(
+            from_customuser=self.cuserA, to_customuser=self.cuserC)
+        caching.bump_graph([a])
+        self.assertEqual(list(graph.get(following=[a]).following_of(a)),
+                         [b, c])
+
+    # 共有されたバージョンがなければデータベースで確かめる
+    @override_settings(SNS_VERSION_CACHE="default")
+    def test_asks_the_database_without_shared_versions(self):
+        a, b = self.cuserA.pk, self.cuserB.pk
+        graph.get(following=[a])
+        CustomUser.followers.through.objects.create(
+            from_customuser=self.cuserA, to_customuser=self.cuserB)
+        self.assertTrue(graph.follows(a, b))
+        self.assertEqual(graph.following_among(a, [b, self.cuserC.pk]), {b})
+
+    # ユーザーページにフォロー数を表示する
+    def test_user_page_shows_counts(self):
+        self.cuserB.followers.add(self.cuserA, self.cuserC)
+        response = self.client.get(reverse("user_post", kwargs={"pk": self.cuserB.pk}))
+        self.assertEqual((response.context["followingCount"],
+                          response.context["followerCount"]), (2, 0))
+        self.assertTrue(response.context["followsYou"])
+
+
+class TimelineFeedTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.cuserB = create_customuser("userB")
+        self.cuserA.followers.add(self.cuserB)
+        self.client.force_login(self.userA)
+
+    def poll(self, cursor, wait=0):
+        return self.client.get(reverse("timeline_poll"),
+                               {"after": cursor, "wait": wait}).json()
+
+    # カーソルより新しい項目だけを返す
+    def test_poll_returns_newer_items(self):
+        create_post(self.cuserB, "old", -2)
+        cursor = self.client.get(reverse("home")).context["latestCursor"]
+        self.assertEqual(self.poll(cursor)["items"], [])
+
+        self.assertEqual(self.client.get(reverse("timeline_poll")).json(),
+                         {"items": [], "cursor": cursor})
+
+        post = create_post(self.cuserB, "new", -1)
+        data = self.poll(cursor)
+        self.assertEqual([i["text"] for i in data["items"]], ["new"])
+        self.assertEqual(self.poll(data["cursor"])["items"], [])
+
+        # リポストで前に出てきた投稿も新しい項目になる
+        cuserC = create_customuser("userC")
+        older = create_post(cuserC, "reposted", -3)
+        create_repost(self.cuserB, older)
+        data = self.poll(data["cursor"])
+        self.assertEqual([i["id"] for i in data["items"]], [older.pk])
+
+    # 変更を待っている間に配信があれば起こされる
+    @override_settings(SNS_FEED_CHECK_INTERVAL=10)
+    def test_wait_wakes_on_change(self):
+        version = caching.timeline_version(self.cuserA.pk)
+        timer = threading.Timer(0.1, caching.bump_timelines, [[self.cuserA.pk]])
+        timer.start()
+        start = time.monotonic()
+        self.assertNotEqual(feed.wait(self.cuserA.pk, version, 5), version)
+        self.assertLess(time.monotonic() - start, 5)
+        timer.join()
+
+    # SSEで新しい項目を送る
+    @override_settings(SNS_STREAM_SECONDS=0)
+    def test_stream_sends_events(self):
+        post = create_post(self.cuserB, "new", -1)
+        response = self.client.get(reverse("timeline_stream"),
+                                   {"after": "0_0"})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join(response.streaming_content).decode()
+        self.assertIn('"id": %d' % post.pk, body)
+        self.assertIn("id: %s" % pagination.encode_cursor(post.pub_date, post.pk), body)
+
+        response = self.client.get(reverse("timeline_stream"), {"after": "bad"})
+        self.assertEqual(response.status_code, 404)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.cuserB = create_customuser("userB")
+        self.cuserA.followers.add(self.cuserB)
+        self.async_client.force_login(self.userA)
+
+    # ASGIでホームとSSEを返す
+    async def test_asgi_home_and_stream(self):
+        post = await sync_to_async(create_post)(self.cuserB, "userB's post", -1)
+        response = await self.async_client.get(reverse("home"))
+        self.assertEqual([p.pk for p in response.context["posts"]], [post.pk])
+
+        with self.settings(SNS_STREAM_SECONDS=0):
+            response = await self.async_client.get(reverse("timeline_stream"),
+                                                   {"after": "0_0"})
+            body = "".join([chunk.decode() async for chunk in
+                            response.streaming_content])
+        self.assertIn('"id": %d' % post.pk, body)
+
+    # 待機中のバージョン確認はイベントループの上で行わない
+    async def test_version_checks_stay_off_the_event_loop(self):
+        loopThread = threading.get_ident()
+        threads = []
+        original = caching.timeline_version
+
+        def recording(ownerId):
+            threads.append(threading.get_ident())
+            return original(ownerId)
+
+        with mock.patch("SNS.caching.timeline_version", recording):
+            version = await caching.atimeline_version(self.cuserA.pk)
+            await feed.await_change(self.cuserA.pk, version, 0.01)
+        self.assertGreaterEqual(len(threads), 2)
+        self.assertNotIn(loopThread, threads)
+
+    # 未ログインならログインページへリダイレクトする
+    async def test_async_views_require_login(self):
+        await sync_to_async(self.async_client.logout)()
+        for url in [reverse("user_post", kwargs={"pk": self.cuserB.pk}),
+                    reverse("timeline_poll")]:
+            response = await self.async_client.get(url)
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response.url.startswith(reverse("login")))
+
+    # 閲覧者の状態は別スレッドで並行して読む
+    def test_gather_reads_concurrently(self):
+        def read():
+            time.sleep(0.2)
+            return threading.get_ident()
+
+        with mock.patch.object(viewer, "concurrent_reads", return_value=True):
+            start = time.monotonic()
+            idents = async_to_sync(viewer.gather)(read, read, read)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(set(idents)), 3)
+
+
+class DatabaseTuningTests(SimpleTestCase):
+    def file_connection(self, path):
+        default = connections["default"]
+        wrapper = type(default)(dict(default.settings_dict, NAME=path),
+                                alias="tuning")
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    # ファイルのSQLite接続にはWALなどのプラグマが設定される
+    def test_file_connections_get_pragmas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = self.file_connection(directory + "/db.sqlite3")
+            values = database.pragma_values(
+                wrapper, ["journal_mode", "busy_timeout", "synchronous"])
+            wrapper.close()
+        self.assertEqual(values, {"journal_mode": "wal", "busy_timeout": 20000,
+                                  "synchronous": 1})
+
+    # トランザクションは開始時に書き込みロックを取る
+    def test_transactions_begin_immediate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = self.file_connection(directory + "/db.sqlite3")
+            second = self.file_connection(directory + "/db.sqlite3")
+            first.ensure_connection()
+            database.apply_pragmas(second, {"busy_timeout": 0})
+            first._start_transaction_under_autocommit()
+            with self.assertRaises(OperationalError):
+                second._start_transaction_under_autocommit()
+            first.cursor().execute("ROLLBACK")
+            first.close()
+            second.close()
+
+    # レプリカがあれば読み込みはレプリカへ、トランザクション中は既定DBへ
+    def test_router_sends_reads_to_replica(self):
+        router = database.ReadReplicaRouter()
+        with mock.patch.dict(settings.DATABASES,
+                             {"default": settings.DATABASES["default"]},
+                             clear=True):
+            self.assertIsNone(router.db_for_read(Post))
+        with mock.patch.dict(settings.DATABASES, {"replica": {}}):
+            self.assertEqual(router.db_for_read(Post), "replica")
+            self.assertEqual(router.db_for_write(Post), "default")
+            with mock.patch.object(connections["default"], "in_atomic_block",
+                                   True):
+                self.assertEqual(router.db_for_read(Post), "default")
+        self.assertFalse(router.allow_migrate("replica", "SNS"))
+
+
+class UserStatsTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.cuserB = create_customuser("userB")
+        self.cuserC = create_customuser("userC")
+        self.client.force_login(self.userA)
+
+    def counts(self, customuser):
+        row = CustomUserStats.objects.get(pk=customuser.pk)
+        return (row.postCount, row.followingCount, row.followerCount,
+                row.likesReceived)
+
+    # 投稿・フォロー・いいねの変更で統計が更新される
+    def test_writes_update_stats(self):
+        post = create_post(self.cuserB, "b1")
+        create_post(self.cuserB, "b2")
+        self.cuserA.followers.add(self.cuserB, self.cuserC)
+        self.cuserC.followers.add(self.cuserB)
+        self.cuserA.likes.add(post)
+        post.likes.add(self.cuserC)
+        self.assertEqual(self.counts(self.cuserB), (2, 0, 2, 2))
+        self.assertEqual(self.counts(self.cuserA), (0, 2, 0, 0))
+
+        # 存在しないフォローの解除は数えない
+        self.cuserA.followers.remove(self.cuserC, self.cuserA)
+        self.cuserC.likes.remove(post)
+        post.delete()
+        self.assertEqual(self.counts(self.cuserB), (1, 0, 2, 0))
+        self.assertEqual(self.counts(self.cuserA), (0, 1, 0, 0))
+        self.assertEqual(stats.reconcile(), 0)
+
+    # ユーザーを削除すると他のユーザーの統計から差し引かれる
+    def test_deleting_a_user_updates_others(self):
+        post = create_post(self.cuserB, "b1")
+        self.cuserC.followers.add(self.cuserB)
+        self.cuserB.followers.add(self.cuserA)
+        self.cuserC.likes.add(post)
+        self.cuserC.user.delete()
+        self.assertEqual(self.counts(self.cuserB), (1, 1, 0, 0))
+        self.assertEqual(stats.reconcile(), 0)
+
+    # 照合コマンドが欠けた行とずれた値を直す
+    def test_reconcile_repairs_drift(self):
+        create_post(self.cuserB, "b1")
+        CustomUserStats.objects.filter(pk=self.cuserB.pk).update(postCount=7)
+        CustomUserStats.objects.filter(pk=self.cuserC.pk).delete()
+
+        out = StringIO()
+        call_command("reconcile_stats", stdout=out)
+        self.assertIn("Fixed stats of 2 user(s).", out.getvalue())
+        self.assertEqual(self.counts(self.cuserB), (1, 0, 0, 0))
+        self.assertEqual(self.counts(self.cuserC), (0, 0, 0, 0))
+
+    # ユーザー一覧の統計はユーザー数によらず同じクエリ数で表示される
+    def test_user_list_reads_stats_with_the_page(self):
+        self.client.get(reverse("user_list"))
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(reverse("user_list"))
+        for i in range(5):
+            create_post(create_customuser("more%d" % i), "hi")
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.get(reverse("user_list"))
+        self.assertEqual(len(after), len(before))
+        self.assertContains(response, "<td>1</td>", count=5)
+
+        response = self.client.get(reverse("user_post",
+                                           kwargs={"pk": self.cuserB.pk}))
+        self.assertEqual(response.context["stats"].postCount, 0)
+
+
+@override_settings(SNS_PAGE_SIZE=2, SNS_HOT_HALF_LIFE=24 * 3600)
+class ExploreTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+        self.fans = [create_customuser("fan%d" % i) for i in range(7)]
+        self.now = timezone.now()
+
+    def post(self, text, days):
+        return Post.objects.create(
+            author=self.cuserA, text=text,
+            pub_date=self.now - datetime.timedelta(days=days))
+
+    def texts(self, response):
+        return [p.text for p in response.context["post_list"]]
+
+    # いいね・リポスト・返信でスコアが上がり、取り消すと戻る
+    def test_engagement_updates_score(self):
+        post = self.post("p", 0)
+        initial = Post.objects.get(pk=post.pk).hotScore
+        self.cuserA.likes.add(post)
+        self.fans[0].reposts.add(post)
+        Post.objects.create(author=self.fans[1], text="r", replyTo=post)
+        self.assertAlmostEqual(Post.objects.get(pk=post.pk).hotScore,
+                               initial + math.log2(1 + 1 + 2 + 3))
+
+        self.cuserA.likes.remove(post)
+        self.fans[0].reposts.remove(post)
+        Post.objects.get(text="r").delete()
+        self.assertAlmostEqual(Post.objects.get(pk=post.pk).hotScore, initial)
+
+    # カウンタの更新とスコアの再計算は同じトランザクションで行う
+    def test_counter_and_score_commit_together(self):
+        post = self.post("p", 0)
+        with mock.patch.object(ranking, "refresh",
+                               side_effect=OperationalError("locked")):
+            with self.assertRaises(OperationalError):
+                counters.bump([post.pk], "likeCount", 1)
+        self.assertEqual(Post.objects.get(pk=post.pk).likeCount, 0)
+
+    # 古い投稿は半減期ごとに倍の反応がないと新しい投稿に勝てない
+    def test_older_posts_need_more_engagement(self):
+        self.post("fresh", 0)
+        some = self.post("two days, one like", 2)
+        many = self.post("two days, seven likes", 2)
+        self.post("too old", 30).likes.add(*self.fans)
+        some.likes.add(self.fans[0])
+        many.likes.add(*self.fans)
+
+        response = self.client.get(reverse("explore"))
+        self.assertEqual(self.texts(response),
+                         ["two days, seven likes", "fresh"])
+        response = self.client.get(reverse("explore"), {
+            "before": response.context["nextCursor"]})
+        self.assertEqual(self.texts(response), ["two days, one like"])
+        self.assertIsNone(response.context["nextCursor"])
+
+    # 一括投入後はスコアを再計算できる
+    def test_rebuild_scores_bulk_created_posts(self):
+        Post.objects.bulk_create([
+            Post(author=self.cuserA, text="bulk", likeCount=3,
+                 pub_date=self.now)])
+        self.assertEqual(Post.objects.get(text="bulk").hotScore, 0)
+        ranking.rebuild()
+        self.assertAlmostEqual(
+            Post.objects.get(text="bulk").hotScore,
+            ranking.score(self.now, likeCount=3))
+
+
+class PostCardRenderTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+        caching.stats.clear()
+
+    def normalized(self, html):
+        return " ".join(html.split())
+
+    # テンプレートと同じマークアップを出力する
+    def test_renderer_matches_template(self):
+        parent = create_post(self.cuserA, "parent")
+        reply = create_post(self.cuserA, "<b>reply</b> & more")
+        reply.replyTo = parent
+        reply.likeCount = 1234
+        renderer = cards.CardRenderer()
+        for post in (parent, reply):
+            for liked, reposted in ((False, False), (True, True)):
+                expected = render_to_string("SNS/post_part.html", {
+                    "post": post,
+                    "likedIds": {post.pk} if liked else set(),
+                    "repostedIds": {post.pk} if reposted else set(),
+                })
+                self.assertEqual(
+                    self.normalized(renderer.card(post, liked, reposted)),
+                    self.normalized(expected))
+
+    # URLの逆引きは投稿の数によらずリクエストごとに一度だけ
+    def test_urls_reversed_once_per_request(self):
+        for i in range(5):
+            create_post(self.cuserA, "post%d" % i)
+        with mock.patch("SNS.cards.reverse", wraps=cards.reverse) as reverse_:
+            response = self.client.get(reverse("home"))
+        self.assertEqual(len(response.context["posts"]), 5)
+        self.assertEqual(reverse_.call_count, len(cards.ROUTES))
+
+    # 一覧のカードはまとめてキャッシュから読む
+    def test_cards_of_a_list_come_from_cache(self):
+        for i in range(3):
+            create_post(self.cuserA, "post%d" % i)
+        self.client.get(reverse("user_post", kwargs={"pk": self.cuserA.pk}))
+        self.assertEqual(caching.stats["card_misses"], 3)
+        response = self.client.get(
+            reverse("user_post", kwargs={"pk": self.cuserA.pk}))
+        self.assertEqual(caching.stats["card_hits"], 3)
+        self.assertContains(response, "post1")
+
+    # リポストした人の行はカードの前に出す
+    def test_reposters_line_precedes_card(self):
+        cuserB = create_customuser("userB")
+        self.cuserA.followers.add(cuserB)
+        post = create_post(create_customuser("userC"), "card text")
+        create_repost(cuserB, post)
+        response = self.client.get(reverse("home"))
+        content = response.content.decode()
+        self.assertIn("Your follower(s) who reposted this post:", content)
+        self.assertLess(content.index("userB"), content.index("card text"))
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        self.cuserA = create_customuser("userA")
+        self.cuserB = create_customuser("userB")
+        self.cuserA.followers.add(self.cuserB)
+        self.parent = create_post(self.cuserA, "parent")
+        self.reply = Post.objects.create(author=self.cuserB, text="reply",
+                                         replyTo=self.parent)
+        self.cuserB.likes.add(self.parent)
+        create_repost(self.cuserA, self.reply)
+
+    def export(self, customuserIds=None):
+        return "".join(transfer.chunks(customuserIds)).splitlines()
+
+    # 書き出したデータを空のデータベースに読み込むと元に戻る
+    def test_round_trip(self):
+        lines = self.export()
+        User.objects.all().delete()
+
+        out = StringIO()
+        with tempfile.NamedTemporaryFile("w", suffix=".ndjson",
+                                         encoding="utf-8") as f:
+            f.write("\n".join(lines))
+            f.flush()
+            call_command("import_data", f.name, stdout=out)
+        self.assertIn("2 user(s), 2 post(s), 1 repost(s), 1 like(s) and "
+                      "1 follow(s)", out.getvalue())
+
+        cuserA = CustomUser.objects.get(user__username="userA")
+        cuserB = CustomUser.objects.get(user__username="userB")
+        reply = Post.objects.get(text="reply")
+        self.assertEqual(reply.author, cuserB)
+        self.assertEqual(reply.replyTo.text, "parent")
+        self.assertEqual(list(cuserA.followers.all()), [cuserB])
+        self.assertEqual(list(cuserB.likes.all()), [reply.replyTo])
+        self.assertEqual(list(cuserA.reposts.all()), [reply])
+        self.assertEqual(reply.replyTo.likeCount, 1)
+        self.assertEqual(stats.of(cuserA).followingCount, 1)
+
+    # 読み込んだ行の主キーはデータベースが振り、書き出し元の番号と重ならない
+    def test_imported_rows_get_new_ids(self):
+        lines = self.export() + [json.dumps(
+            {"type": "user", "username": "userC", "bio": "",
+             "date_joined": self.parent.pub_date.isoformat()})]
+        before = set(Post.objects.values_list("pk", flat=True))
+
+        counts = transfer.import_records(lines)
+        self.assertEqual((counts["user"], counts["post"]), (1, 2))
+        imported = set(Post.objects.values_list("pk", flat=True)) - before
+        self.assertEqual(len(imported), 2)
+        self.assertGreater(min(imported), max(before))
+        cuserC = CustomUser.objects.get(user__username="userC")
+        self.assertEqual(cuserC.pk, cuserC.user.pk)
+        self.assertEqual(create_post(cuserC, "after").pk, max(imported) + 1)
+
+    # 返信が返信先より先に来ても二回目のパスでつなぐ
+    def test_reply_before_parent_is_linked(self):
+        records = [json.loads(line) for line in self.export()]
+        posts = [r for r in records if r["type"] == "post"]
+        posts.reverse()
+        lines = [json.dumps(r) for r in posts + [
+            {"type": "post", "id": 999, "author": "userA", "replyTo": 998,
+             "text": "orphan", "pub_date": posts[0]["pub_date"]},
+            {"type": "like", "user": "userB", "post": 997},
+            {"type": "follow", "from": "userA", "to": "nobody"},
+        ]]
+
+        counts = transfer.import_records(lines)
+        self.assertEqual((counts["post"], counts["skipped"],
+                          counts["unlinked"]), (3, 2, 1))
+        reply = Post.objects.filter(text="reply").latest("pk")
+        self.assertEqual(reply.replyTo,
+                         Post.objects.filter(text="parent").latest("pk"))
+        self.assertIsNone(Post.objects.get(text="orphan").replyTo)
+
+    # 不正な行はエラーになる
+    def test_malformed_line(self):
+        with self.assertRaisesMessage(ValueError, "Line 2"):
+            transfer.import_records(['{"type": "follow", "from": "userA", '
+                                     '"to": "userB"}', "not json"])
+        with self.assertRaisesMessage(ValueError, "no 'author'"):
+            transfer.import_records(['{"type": "post", "id": 1}'])
+
+    # ダウンロードはログイン中のユーザーのデータだけをストリームで返す
+    def test_export_view_streams_own_data(self):
+        self.client.force_login(self.cuserA.user)
+        response = self.client.get(reverse("export"))
+        self.assertTrue(response.streaming)
+        records = [json.loads(line) for line in b"".join(
+            response.streaming_content).decode().splitlines()]
+        self.assertEqual([r["type"] for r in records],
+                         ["user", "post", "repost", "follow"])
+        self.assertEqual(records[0]["username"], "userA")
+        self.assertEqual(records[2]["post"], self.reply.pk)
+        self.assertEqual(records[3], {"type": "follow", "from": "userA",
+                                      "to": "userB"})
+
+
+# 期限の切り替わりでETagが変わらないようにする
+@override_settings(SNS_ETAG_MAX_STALE=10 ** 9)
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.cuserB = create_customuser("userB")
+        self.cuserA.followers.add(self.cuserB)
+        self.post = create_post(self.cuserB, "hello")
+        self.client.force_login(self.userA)
+
+    def revalidate(self, url):
+        etag = self.client.get(url)["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        return response, [q["sql"] for q in queries]
+
+    # 変化がなければ304を返し、タイムラインのクエリを実行しない
+    def test_unchanged_pages_are_not_modified(self):
+        for url in (reverse("home"), reverse("my_like_list"),
+                    reverse("user_post", kwargs={"pk": self.cuserB.pk}),
+                    reverse("timeline_json")):
+            response, queries = self.revalidate(url)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertFalse([q for q in queries if "SNS_post" in q or
+                              "SNS_timelineentry" in q], url)
+
+    # 自分のいいねや新しい投稿でETagが変わる
+    def test_changes_invalidate_the_etag(self):
+        home = reverse("home")
+        profile = reverse("user_post", kwargs={"pk": self.cuserB.pk})
+        etags = {url: self.client.get(url)["ETag"] for url in (home, profile)}
+
+        self.cuserA.likes.add(self.post)
+        for url in (home, profile):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200, url)
+            etags[url] = response["ETag"]
+
+        create_post(self.cuserB, "again")
+        for url in (home, profile):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+    # CSRFクッキーが変わるとフォームのあるページのETagも変わる
+    def test_csrf_cookie_changes_the_etag(self):
+        profile = reverse("user_post", kwargs={"pk": self.cuserA.pk})
+        response = self.client.get(profile)
+        self.assertContains(response, "csrfmiddlewaretoken")
+        etag = response["ETag"]
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = "x" * 32
+        response = self.client.get(profile, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    # JSONのタイムラインは投稿とリポスト者、いいね状態を返す
+    def test_timeline_json(self):
+        self.cuserA.likes.add(self.post)
+        cuserC = create_customuser("userC")
+        self.cuserA.followers.add(cuserC)
+        cuserC.reposts.add(self.post)
+
+        data = self.client.get(reverse("timeline_json")).json()
+        self.assertIsNone(data["next"])
+        item, = data["items"]
+        self.assertEqual(
+            (item["id"], item["author"], item["reposters"], item["liked"],
+             item["reposted"], item["likes"], item["reposts"]),
+            (self.post.pk, "userB", ["userC"], True, False, 1, 1))
+
+
+def create_reply(author, post, text, days=None):
+    time = timezone.now() + datetime.timedelta(days=days or 0)
+    return Post.objects.create(author=author, text=text, replyTo=post,
+                               pub_date=time)
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.cuserB = create_customuser("userB")
+        self.cuserA.followers.add(self.cuserB)
+        self.client.force_login(self.userA)
+
+    def ids(self, model):
+        return set(model.objects.values_list("pk", flat=True))
+
+    # 返信も含めてすべて古いスレッドだけをアーカイブに移す
+    def test_archive_moves_whole_old_threads(self):
+        old = create_post(self.cuserB, "old thread", -400)
+        oldReply = create_reply(self.cuserA, old, "old reply", -399)
+        live = create_post(self.cuserB, "old but answered", -400)
+        liveReply = create_reply(self.cuserA, live, "recent reply", -1)
+        recent = create_post(self.cuserB, "recent post", -1)
+        self.cuserA.likes.add(old)
+        self.cuserA.reposts.add(old)
+
+        out = StringIO()
+        call_command("archive_posts", "--days", "365", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Archived 2 post(s).")
+        self.assertEqual(self.ids(ArchivedPost), {old.pk, oldReply.pk})
+        self.assertEqual(self.ids(Post), {live.pk, liveReply.pk, recent.pk})
+        self.assertFalse(self.cuserA.likes.exists())
+        self.assertFalse(Repost.objects.exists())
+        archived = ArchivedPost.objects.get(pk=old.pk)
+        self.assertEqual((archived.likeCount, archived.replyCount), (1, 1))
+
+        response = self.client.get(reverse("home"))
+        self.assertNotIn(old.pk, [p.pk for p in response.context["posts"]])
+        self.assertEqual(stats.reconcile(), 0)
+        self.assertEqual(retention.archive(365 * 24 * 3600), 0)
+
+    # アーカイブすると投稿者のプロフィールページのETagが変わる
+    def test_archive_changes_the_author_profile(self):
+        create_post(self.cuserB, "old thread", -400)
+        profile = reverse("user_post", kwargs={"pk": self.cuserB.pk})
+        etag = self.client.get(profile)["ETag"]
+        retention.archive(365 * 24 * 3600)
+        response = self.client.get(profile, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "old thread")
+
+    # アーカイブしたスレッドも詳細ページで読めるが、操作ボタンは出さない
+    def test_archived_thread_still_renders(self):
+        old = create_post(self.cuserB, "old thread", -400)
+        create_reply(self.cuserA, old, "old reply", -399)
+        retention.archive(365 * 24 * 3600)
+
+        response = self.client.get(reverse("post_detail", kwargs={"pk": old.pk}))
+        self.assertContains(response, "old thread")
+        self.assertContains(response, "old reply")
+        self.assertNotContains(response, reverse("add_like", kwargs={"pk": old.pk}))
+        response = self.client.get(reverse("post_replies", kwargs={"pk": old.pk}))
+        self.assertContains(response, "old reply")
+
+    # 投稿の削除は返信から順に少しずつ行い、集計を保つ
+    @mock.patch("SNS.retention.DELETE_BATCH_SIZE", 1)
+    def test_delete_post_removes_the_thread_in_batches(self):
+        post = create_post(self.cuserA, "thread")
+        reply = create_reply(self.cuserB, post, "reply")
+        create_reply(self.cuserA, reply, "reply to reply")
+        other = create_post(self.cuserA, "other")
+        self.cuserB.likes.add(post)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("post_delete", kwargs={"pk": post.pk}))
+        self.assertRedirects(
+            response, reverse("user_post", kwargs={"pk": self.cuserA.pk}),
+            fetch_redirect_response=False)
+        self.assertEqual(self.ids(Post), {other.pk})
+        self.assertEqual(
+            len([q for q in queries if q["sql"].startswith("DELETE FROM \"SNS_post\"")]), 3)
+        self.assertEqual(stats.of(self.cuserA).likesReceived, 0)
+        self.assertEqual(stats.reconcile(), 0)
+
+        # 他人の投稿は削除できない
+        response = self.client.post(
+            reverse("post_delete", kwargs={"pk": create_post(self.cuserB, "b").pk}))
+        self.assertEqual(response.status_code, 404)
+
+    # アーカイブした投稿も削除できる
+    def test_delete_archived_post(self):
+        old = create_post(self.cuserA, "old thread", -400)
+        create_reply(self.cuserB, old, "old reply", -399)
+        self.cuserB.likes.add(old)
+        retention.archive(365 * 24 * 3600)
+
+        self.client.post(reverse("post_delete", kwargs={"pk": old.pk}))
+        self.assertFalse(ArchivedPost.objects.exists())
+        self.assertEqual(
+            (stats.of(self.cuserA).postCount, stats.of(self.cuserA).likesReceived),
+            (0, 0))
+        self.assertEqual(stats.reconcile(), 0)
+
+    # ワーカーでは一回分ずつ削除し、続きを次のジョブに回す
+    @override_settings(SNS_ASYNC_FANOUT=True)
+    @mock.patch("SNS.retention.DELETE_BATCH_SIZE", 1)
+    def test_deletion_job_resumes_in_the_worker(self):
+        post = create_post(self.cuserA, "thread")
+        create_reply(self.cuserB, post, "reply")
+        jobs.work(once=True)
+
+        jobs.enqueue("delete_posts", postIds=[post.pk])
+        self.assertEqual(jobs.work(once=True, maxJobs=1)["done"], 1)
+        self.assertEqual(self.ids(Post), {post.pk})
+        self.assertEqual(jobs.work(once=True)["failed"], 0)
+        self.assertFalse(Post.objects.exists())
+
+    # アカウント削除はすぐにログアウトし、データを少しずつ消す
+    @mock.patch("SNS.retention.DELETE_BATCH_SIZE", 2)
+    def test_delete_account(self):
+        post = create_post(self.cuserA, "mine")
+        create_reply(self.cuserB, post, "reply to A")
+        postB = create_post(self.cuserB, "userB's post")
+        self.cuserA.likes.add(postB)
+        self.cuserA.reposts.add(postB)
+        self.cuserB.followers.add(self.cuserA)
+        create_post(self.cuserA, "old", -400)
+        retention.archive(365 * 24 * 3600)
+
+        response = self.client.post(reverse("account_delete"))
+        self.assertRedirects(response, reverse("home"),
+                             fetch_redirect_response=False)
+        self.assertFalse(User.objects.filter(pk=self.userA.pk).exists())
+        self.assertEqual(self.ids(Post), {postB.pk})
+        self.assertFalse(ArchivedPost.objects.exists())
+        self.assertFalse(TimelineEntry.objects.filter(
+            post__author=self.cuserA).exists())
+        postB.refresh_from_db()
+        self.assertEqual((postB.likeCount, postB.repostCount), (0, 0))
+        userStats = stats.of(self.cuserB)
+        self.assertEqual(
+            (userStats.postCount, userStats.followerCount,
+             userStats.followingCount, userStats.likesReceived), (1, 0, 0, 0))
+        self.assertEqual(stats.reconcile(), 0)
+        self.assertFalse(
+            self.client.get(reverse("home")).context["user"].is_authenticated)
+
+
+class DeletionTransactionTests(TransactionTestCase):
+    def setUp(self):
+        self.userA = User.objects.create(username="userA", password="aaa")
+        self.cuserA = CustomUser.objects.create(user=self.userA, bio="")
+        self.client.force_login(self.userA)
+
+    # 削除の各バッチはそれぞれ単独でコミットされ、途中で失敗しても再開できる
+    @mock.patch("SNS.retention.DELETE_BATCH_SIZE", 1)
+    def test_each_batch_commits_on_its_own(self):
+        post = create_post(self.cuserA, "thread")
+        create_reply(self.cuserA, post, "reply")
+        step = retention._delete_posts_batch
+        savepoints = []
+
+        def failing_step(postIds):
+            savepoints.append(list(connection.savepoint_ids))
+            if len(savepoints) == 2:
+                raise OperationalError("disk I/O error")
+            return step(postIds)
+
+        with mock.patch.object(retention, "_delete_posts_batch",
+                               failing_step):
+            with self.assertRaises(OperationalError):
+                self.client.post(
+                    reverse("post_delete", kwargs={"pk": post.pk}))
+        self.assertEqual(savepoints, [[], []])
+        self.assertEqual(list(Post.objects.values_list("pk", flat=True)),
+                         [post.pk])
+
+        self.client.post(reverse("post_delete", kwargs={"pk": post.pk}))
+        self.assertFalse(Post.objects.exists())
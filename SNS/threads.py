@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import prefetch_related_objects
+
+from .models import ArchivedPost, Post
+from .pagination import encode_cursor
+
+# Conversation threads.
+#
+# A thread is the chain of posts a post replies to, the post itself and the
+# tree of replies below it.  Both directions are walked by one recursive
+# CTE over Post.replyTo, bounded in depth and in the number of replies
+# loaded per post, and the tree is assembled from the flat rows in a single
+# pass.  Posts with more replies than were loaded get a cursor for the
+# post_replies page.  The same query reads archived threads from the
+# ArchivedPost table.
+
+
+def max_ancestors():
+    return getattr(settings, 'SNS_THREAD_ANCESTORS', 20)
+
+
+def max_depth():
+    return getattr(settings, 'SNS_THREAD_DEPTH', 5)
+
+
+def max_fan_out():
+    return getattr(settings, 'SNS_THREAD_FAN_OUT', 10)
+
+
+class ThreadNode:
+    def __init__(self, post):
+        self.post = post
+        self.children = []
+
+    @property
+    def hiddenReplies(self):
+        # Replies that exist but were not loaded, according to replyCount.
+        return max(0, self.post.replyCount - len(self.children))
+
+    @property
+    def moreCursor(self):
+        # Cursor of the post_replies page that continues after the loaded
+        # children, or None if every reply is shown.
+        if not self.hiddenReplies:
+            return None
+        if not self.children:
+            return ''
+        last = self.children[-1].post
+        return encode_cursor(last.pub_date, last.pk)
+
+
+class Thread:
+    def __init__(self, ancestors, root):
+        self.ancestors = ancestors
+        self.root = root
+
+    @property
+    def post(self):
+        return self.root.post
+
+    def posts(self):
+        posts = list(self.ancestors)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            posts.append(node.post)
+            stack.extend(node.children)
+        return posts
+
+
+def _thread_sql(model):
+    qn = connection.ops.quote_name
+    names = {
+        'post': qn(model._meta.db_table),
+        'replyTo': qn('replyTo_id'),
+    }
+    return """
+        WITH RECURSIVE
+        ancestors(id, depth) AS (
+            SELECT %(replyTo)s, 1 FROM %(post)s
+            WHERE id = %%s AND %(replyTo)s IS NOT NULL
+            UNION ALL
+            SELECT p.%(replyTo)s, a.depth + 1
+            FROM %(post)s p JOIN ancestors a ON p.id = a.id
+            WHERE p.%(replyTo)s IS NOT NULL AND a.depth < %%s
+        ),
+        descendants(id, depth) AS (
+            SELECT id, 0 FROM %(post)s WHERE id = %%s
+            UNION ALL
+            SELECT c.id, d.depth + 1
+            FROM descendants d JOIN %(post)s c ON c.%(replyTo)s = d.id
+            WHERE d.depth < %%s AND c.id IN (
+                SELECT s.id FROM %(post)s s
+                WHERE s.%(replyTo)s = d.id
+                ORDER BY s.pub_date, s.id
+                LIMIT %%s
+            )
+        )
+        SELECT p.*, t.depth AS threadDepth
+        FROM (
+            SELECT id, -depth AS depth FROM ancestors
+            UNION ALL
+            SELECT id, depth FROM descendants
+        ) t JOIN %(post)s p ON p.id = t.id
+        ORDER BY t.depth, p.pub_date, p.id
+    """ % names
+
+
+def _load_posts(model, postId):
+    return list(model.objects.raw(_thread_sql(model), [
+        postId, max_ancestors(), postId, max_depth(), max_fan_out(),
+    ]))
+
+
+def load_thread(postId):
+    # The Thread around postId, or None if there is no such post.  Threads
+    # are archived whole (see SNS.retention), so one that is not among the
+    # posts is read from the archive.
+    posts = (_load_posts(Post, postId) or
+             _load_posts(ArchivedPost, postId))
+    prefetch_related_objects(posts, 'author__user')
+
+    ancestors = []
+    nodes = {}
+    root = None
+    for p in posts:
+        if p.threadDepth < 0:
+            ancestors.append(p)
+            continue
+        node = nodes[p.pk] = ThreadNode(p)
+        if p.threadDepth == 0:
+            root = node
+        else:
+            nodes[p.replyTo_id].children.append(node)
+    if root is None:
+        return None
+    return Thread(ancestors, root)
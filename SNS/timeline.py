@@ -0,0 +1,275 @@
+from collections import defaultdict
+
+from django.db import connection, transaction
+
+from . import caching, merge
+from .models import CustomUser, Post, Repost, TimelineEntry
+from .pagination import keyset_page
+
+# Materialized home timelines.
+#
+# Every user owns one TimelineEntry per post visible on their home page:
+# their own posts, posts of the users they follow, and posts reposted by the
+# users they follow.  keyDate is the date of the latest repost made by a
+# followed user, or the post's pub_date if none of them reposted it.
+# Entries are written when content or follow edges change so that home_view
+# only has to read one index range of SNS_timelineentry.
+
+Follow = CustomUser.followers.through
+
+BATCH_SIZE = 500
+
+
+def _chunks(ids, size=BATCH_SIZE):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def follower_ids(customuserId):
+    # ids of the users who follow customuserId
+    return list(Follow.objects.filter(
+        to_customuser_id=customuserId
+    ).values_list('from_customuser_id', flat=True))
+
+
+def deliver_post(post):
+    # A brand-new post has no reposts yet, so it simply lands on the
+    # timelines of its author and of everyone following the author.
+    owners = set(follower_ids(post.author_id))
+    owners.add(post.author_id)
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(owner_id=o, post_id=post.id, keyDate=post.pub_date)
+         for o in owners],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True)
+    return owners
+
+
+def deliver_repost(repostedById, postIds):
+    # Called when repostedById reposts or unreposts the posts postIds.
+    return refresh(follower_ids(repostedById), postIds)
+
+
+def follow_changed(ownerId, followeeIds):
+    # Called when ownerId starts or stops following followeeIds: every post
+    # written or reposted by them may enter or leave the timeline.
+    followeeIds = list(followeeIds)
+    postIds = set(Post.objects.filter(
+        author_id__in=followeeIds
+    ).values_list('id', flat=True))
+    postIds.update(Repost.objects.filter(
+        repostedBy_id__in=followeeIds
+    ).values_list('post_id', flat=True))
+    return refresh([ownerId], postIds)
+
+
+def build(ownerId):
+    # Compute ownerId's timeline straight from the source tables, newest
+    # keyDate first, with keyDate and reposter set on every post.
+    followeeIds = list(Follow.objects.filter(
+        from_customuser_id=ownerId
+    ).values_list('to_customuser_id', flat=True))
+
+    reposts = Repost.objects.filter(
+        repostedBy_id__in=followeeIds
+    ).select_related(
+        'post__replyTo',
+        'post__author__user',
+        'repostedBy__user'
+    ).order_by('-pub_date', '-id')
+    posts = Post.objects.filter(
+        author_id__in=followeeIds + [ownerId]
+    ).select_related(
+        'replyTo',
+        'author__user'
+    ).order_by('-pub_date', '-id')
+
+    return merge.merge_timeline(posts.iterator(),
+                                merge.group_reposts(reposts.iterator()))
+
+
+def rebuild(ownerId):
+    # Recompute ownerId's whole timeline from the source tables.
+    wanted = {(ownerId, p.id): p.keyDate for p in build(ownerId)}
+    stale = [
+        pk for pk, postId in TimelineEntry.objects.filter(
+            owner_id=ownerId
+        ).values_list('id', 'post_id')
+        if (ownerId, postId) not in wanted
+    ]
+    for chunk in _chunks(stale):
+        TimelineEntry.objects.filter(id__in=chunk).delete()
+    for chunk in _chunks(wanted):
+        _apply([ownerId], [postId for _, postId in chunk],
+               {key: wanted[key] for key in chunk})
+    return {ownerId}
+
+
+def rebuild_all():
+    # Recompute every timeline with one set-based INSERT ... SELECT, which is
+    # much faster than rebuilding owner by owner after a bulk load.
+    qn = connection.ops.quote_name
+    names = {
+        'entry': qn(TimelineEntry._meta.db_table),
+        'post': qn(Post._meta.db_table),
+        'repost': qn(Repost._meta.db_table),
+        'follow': qn(Follow._meta.db_table),
+        'keyDate': qn('keyDate'),
+        'repostedBy': qn('repostedBy_id'),
+    }
+    with transaction.atomic():
+        TimelineEntry.objects.all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO %(entry)s (owner_id, post_id, %(keyDate)s)
+                SELECT owner, post,
+                       COALESCE(MAX(CASE WHEN isRepost = 1 THEN d END),
+                                MAX(d))
+                FROM (
+                    SELECT p.author_id AS owner, p.id AS post,
+                           p.pub_date AS d, 0 AS isRepost
+                    FROM %(post)s p
+                    UNION ALL
+                    SELECT f.from_customuser_id, p.id, p.pub_date, 0
+                    FROM %(post)s p
+                    JOIN %(follow)s f ON f.to_customuser_id = p.author_id
+                    UNION ALL
+                    SELECT f.from_customuser_id, r.post_id, r.pub_date, 1
+                    FROM %(repost)s r
+                    JOIN %(follow)s f ON f.to_customuser_id = r.%(repostedBy)s
+                ) visible
+                GROUP BY owner, post
+            """ % names)
+
+
+def refresh(ownerIds, postIds):
+    # Bring the entries of the given owners for the given posts in line with
+    # the Post, Repost and follow tables.  Returns the ids of the owners
+    # whose timeline changed.
+    ownerIds = set(ownerIds)
+    postIds = set(postIds)
+    changedOwners = set()
+    for ownerChunk in _chunks(ownerIds):
+        for postChunk in _chunks(postIds):
+            changedOwners |= _refresh_chunk(ownerChunk, postChunk)
+    return changedOwners
+
+
+def _refresh_chunk(ownerIds, postIds):
+    posts = {
+        pk: (authorId, pubDate)
+        for pk, authorId, pubDate in Post.objects.filter(
+            id__in=postIds
+        ).values_list('id', 'author_id', 'pub_date')
+    }
+    reposts = list(Repost.objects.filter(
+        post_id__in=list(posts)
+    ).values_list('post_id', 'repostedBy_id', 'pub_date'))
+
+    actorIds = {authorId for authorId, _ in posts.values()}
+    actorIds.update(repostedById for _, repostedById, _ in reposts)
+    followersOf = defaultdict(set)
+    for ownerId, followeeId in Follow.objects.filter(
+        from_customuser_id__in=ownerIds,
+        to_customuser_id__in=actorIds
+    ).values_list('from_customuser_id', 'to_customuser_id'):
+        followersOf[followeeId].add(ownerId)
+
+    wanted = {}
+    for postId, repostedById, pubDate in reposts:
+        for ownerId in followersOf[repostedById]:
+            key = (ownerId, postId)
+            if key not in wanted or wanted[key] < pubDate:
+                wanted[key] = pubDate
+    for postId, (authorId, pubDate) in posts.items():
+        owners = set(followersOf[authorId])
+        if authorId in ownerIds:
+            owners.add(authorId)
+        for ownerId in owners:
+            wanted.setdefault((ownerId, postId), pubDate)
+
+    return _apply(ownerIds, postIds, wanted)
+
+
+def _apply(ownerIds, postIds, wanted):
+    # Make the entries for ownerIds x postIds match wanted, a dict mapping
+    # (ownerId, postId) to keyDate.  Returns the ids of the owners whose
+    # entries changed.
+    existing = {
+        (e.owner_id, e.post_id): e
+        for e in TimelineEntry.objects.filter(owner_id__in=ownerIds,
+                                              post_id__in=postIds)
+    }
+
+    stale = [e.id for key, e in existing.items() if key not in wanted]
+    if stale:
+        TimelineEntry.objects.filter(id__in=stale).delete()
+
+    changed = []
+    for key, e in existing.items():
+        if key in wanted and e.keyDate != wanted[key]:
+            e.keyDate = wanted[key]
+            changed.append(e)
+    if changed:
+        TimelineEntry.objects.bulk_update(changed, ['keyDate'],
+                                          batch_size=BATCH_SIZE)
+
+    created = [
+        TimelineEntry(owner_id=ownerId, post_id=postId, keyDate=keyDate)
+        for (ownerId, postId), keyDate in wanted.items()
+        if (ownerId, postId) not in existing
+    ]
+    TimelineEntry.objects.bulk_create(created,
+                                      batch_size=BATCH_SIZE,
+                                      ignore_conflicts=True)
+
+    changedOwners = {ownerId for ownerId, postId in existing
+                     if (ownerId, postId) not in wanted}
+    changedOwners.update(e.owner_id for e in changed)
+    changedOwners.update(e.owner_id for e in created)
+    return changedOwners
+
+
+def _page_keys(ownerId, before):
+    entries, nextCursor = keyset_page(
+        TimelineEntry.objects.filter(owner_id=ownerId).only('post', 'keyDate'),
+        before,
+        dateField='keyDate',
+        idField='post_id')
+    return [(e.post_id, e.keyDate) for e in entries], nextCursor
+
+
+def timeline_page(customuser, before=None):
+    # One page of customuser's home timeline, newest keyDate first, each post
+    # annotated with keyDate and the list of followed users who reposted it.
+    # Returns (posts, nextCursor).
+    keys, nextCursor = caching.timeline_keys(
+        customuser, before, lambda: _page_keys(customuser.pk, before))
+    postsById = Post.objects.select_related(
+        'replyTo',
+        'author__user'
+    ).in_bulk([postId for postId, _ in keys])
+
+    posts = []
+    for postId, keyDate in keys:
+        p = postsById.get(postId)
+        if p is None:
+            continue
+        p.keyDate = keyDate
+        p.reposter = []
+        posts.append(p)
+    attach_reposters(customuser, posts)
+    return posts, nextCursor
+
+
+def attach_reposters(customuser, posts):
+    byId = {p.id: p for p in posts}
+    if not byId:
+        return
+    reposts = Repost.objects.filter(
+        post_id__in=list(byId),
+        repostedBy__customuser=customuser
+    ).select_related('repostedBy__user').order_by('-pub_date')
+    for r in reposts:
+        byId[r.post_id].reposter.append(r.repostedBy)
@@ -0,0 +1,238 @@
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db.models import Case, IntegerField, Value, When
+from django.utils.dateparse import parse_datetime
+
+from .models import ArchivedPost, CustomUser, Post, Repost
+
+# Export and import of users' data as NDJSON.
+#
+# An export is one JSON object per line, in the order the importer needs
+# them: users, then posts in id order, live ones before archived ones, then
+# reposts, likes and follows.
+# Users are referred to by username and posts by their id in the exporting
+# database, e.g.
+#
+#   {"type": "user", "username": "alice", "bio": "", "date_joined": "..."}
+#   {"type": "post", "id": 7, "author": "alice", "replyTo": null, ...}
+#   {"type": "like", "user": "bob", "post": 7}
+#
+# The rows are read with .iterator(), which uses server-side cursors on
+# PostgreSQL and fetches BATCH_SIZE rows at a time elsewhere, so memory
+# stays flat however many rows a user has.
+#
+# import_records() loads an export with batched bulk_create and gives posts
+# new ids, keeping a map from exported to new ids to resolve replies, likes
+# and reposts.  No id is written explicitly, so the database's sequences
+# stay ahead of the rows; the new post ids are the ones bulk_create returns
+# (PostgreSQL, SQLite 3.35+, MariaDB 10.5+), and users' are read back by
+# username.  A reply that comes before the post it answers is linked in
+# a second pass at the end.  Usernames that already exist are reused rather
+# than created.  Like seed.seed(), the import skips the signal receivers:
+# run seed.rebuild_derived() afterwards.
+
+BATCH_SIZE = 1000
+
+TYPES = ('user', 'post', 'repost', 'like', 'follow')
+
+Follow = CustomUser.followers.through
+Like = CustomUser.likes.through
+
+
+def _rows(queryset, customuserIds, field):
+    if customuserIds is not None:
+        queryset = queryset.filter(**{field + '__in': customuserIds})
+    return queryset.order_by('pk').iterator(chunk_size=BATCH_SIZE)
+
+
+def records(customuserIds=None):
+    # The export records of customuserIds' data, or of everyone's.
+    for username, bio, dateJoined in _rows(
+            CustomUser.objects.values_list(
+                'user__username', 'bio', 'user__date_joined'),
+            customuserIds, 'pk'):
+        yield {'type': 'user', 'username': username, 'bio': bio,
+               'date_joined': dateJoined.isoformat()}
+    for model in (Post, ArchivedPost):
+        for pk, author, replyTo, text, pubDate in _rows(
+                model.objects.values_list(
+                    'pk', 'author__user__username', 'replyTo_id', 'text',
+                    'pub_date'),
+                customuserIds, 'author_id'):
+            yield {'type': 'post', 'id': pk, 'author': author,
+                   'replyTo': replyTo, 'text': text,
+                   'pub_date': pubDate.isoformat()}
+    for username, postId, pubDate in _rows(
+            Repost.objects.values_list(
+                'repostedBy__user__username', 'post_id', 'pub_date'),
+            customuserIds, 'repostedBy_id'):
+        yield {'type': 'repost', 'user': username, 'post': postId,
+               'pub_date': pubDate.isoformat()}
+    for username, postId in _rows(
+            Like.objects.values_list('customuser__user__username', 'post_id'),
+            customuserIds, 'customuser_id'):
+        yield {'type': 'like', 'user': username, 'post': postId}
+    for a, b in _rows(
+            Follow.objects.values_list('from_customuser__user__username',
+                                       'to_customuser__user__username'),
+            customuserIds, 'from_customuser_id'):
+        yield {'type': 'follow', 'from': a, 'to': b}
+
+
+def chunks(customuserIds=None):
+    # records() as NDJSON, BATCH_SIZE lines per string.
+    lines = (json.dumps(r, ensure_ascii=False) + '\n'
+             for r in records(customuserIds))
+    while True:
+        chunk = ''.join(islice(lines, BATCH_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def achunks(customuserIds=None):
+    # chunks() as an async iterator.  Every chunk is read on the same
+    # thread, so the cursors stay on one connection.
+    iterator = chunks(customuserIds)
+    while True:
+        chunk = await sync_to_async(next)(iterator, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+class _Importer:
+    def __init__(self):
+        self.customuserIds = {}
+        self.postIds = {}
+        self.pendingReplies = []
+        self.counts = dict.fromkeys(TYPES, 0)
+        self.counts['skipped'] = 0
+        self.counts['unlinked'] = 0
+
+    def resolve(self, usernames):
+        missing = set(usernames) - set(self.customuserIds)
+        self.customuserIds.update(dict.fromkeys(missing))
+        self.customuserIds.update(CustomUser.objects.filter(
+            user__username__in=missing).values_list('user__username', 'pk'))
+
+    def load(self, kind, batch):
+        if not batch:
+            return
+        try:
+            getattr(self, 'load_' + kind)(batch)
+        except KeyError as e:
+            raise ValueError("A %s record has no %s." % (kind, e))
+
+    def keep(self, kind, objs, batch):
+        self.counts[kind] += len(objs)
+        self.counts['skipped'] += len(batch) - len(objs)
+
+    def load_user(self, batch):
+        names = {r['username']: r for r in batch}
+        self.resolve(names)
+        new = [User(username=name, password='!',
+                    date_joined=parse_datetime(r['date_joined']))
+               for name, r in names.items()
+               if self.customuserIds[name] is None]
+        User.objects.bulk_create(new)
+        userIds = dict(User.objects.filter(
+            username__in=[u.username for u in new]).values_list(
+                'username', 'pk'))
+        CustomUser.objects.bulk_create(
+            [CustomUser(user_id=userIds[u.username],
+                        bio=names[u.username]['bio'])
+             for u in new])
+        for u in new:
+            self.customuserIds[u.username] = userIds[u.username]
+        self.keep('user', new, batch)
+
+    def load_post(self, batch):
+        self.resolve(r['author'] for r in batch)
+        kept, objs = [], []
+        for r in batch:
+            author = self.customuserIds[r['author']]
+            if author is None:
+                continue
+            kept.append(r)
+            objs.append(Post(author_id=author, text=r['text'],
+                             pub_date=parse_datetime(r['pub_date']),
+                             replyTo_id=self.postIds.get(r['replyTo'])))
+        Post.objects.bulk_create(objs)
+        for r, post in zip(kept, objs):
+            self.postIds[r['id']] = post.pk
+            if r['replyTo'] is not None and post.replyTo_id is None:
+                self.pendingReplies.append((post.pk, r['replyTo']))
+        self.keep('post', objs, batch)
+
+    def load_repost(self, batch):
+        self.resolve(r['user'] for r in batch)
+        objs = [Repost(repostedBy_id=self.customuserIds[r['user']],
+                       post_id=self.postIds[r['post']],
+                       pub_date=parse_datetime(r['pub_date']))
+                for r in batch
+                if self.customuserIds[r['user']] and r['post'] in self.postIds]
+        Repost.objects.bulk_create(objs, ignore_conflicts=True)
+        self.keep('repost', objs, batch)
+
+    def load_like(self, batch):
+        self.resolve(r['user'] for r in batch)
+        objs = [Like(customuser_id=self.customuserIds[r['user']],
+                     post_id=self.postIds[r['post']])
+                for r in batch
+                if self.customuserIds[r['user']] and r['post'] in self.postIds]
+        Like.objects.bulk_create(objs, ignore_conflicts=True)
+        self.keep('like', objs, batch)
+
+    def load_follow(self, batch):
+        self.resolve([r['from'] for r in batch] + [r['to'] for r in batch])
+        objs = [Follow(from_customuser_id=self.customuserIds[r['from']],
+                       to_customuser_id=self.customuserIds[r['to']])
+                for r in batch
+                if self.customuserIds[r['from']] and self.customuserIds[r['to']]]
+        Follow.objects.bulk_create(objs, ignore_conflicts=True)
+        self.keep('follow', objs, batch)
+
+    def link_replies(self):
+        # Second pass: replies imported before the post they answer.  Those
+        # whose post is not in the export stay top-level posts.
+        links = {pk: self.postIds[parent]
+                 for pk, parent in self.pendingReplies
+                 if parent in self.postIds}
+        self.counts['unlinked'] = len(self.pendingReplies) - len(links)
+        pks = list(links)
+        for i in range(0, len(pks), BATCH_SIZE):
+            batch = pks[i:i + BATCH_SIZE]
+            Post.objects.filter(pk__in=batch).update(replyTo_id=Case(
+                *[When(pk=pk, then=Value(links[pk])) for pk in batch],
+                output_field=IntegerField()))
+
+
+def import_records(lines):
+    # Load the NDJSON lines of an export and return the number of users,
+    # posts, reposts, likes and follows created, of records skipped because
+    # they refer to users or posts that are not there, and of replies left
+    # unlinked.  Raises ValueError on a malformed line.
+    importer = _Importer()
+    kind, batch = None, []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            recordType = record['type']
+        except (ValueError, TypeError, KeyError):
+            raise ValueError("Line %d is not an export record." % number)
+        if recordType not in TYPES:
+            raise ValueError("Line %d has unknown type %r." % (
+                number, recordType))
+        if recordType != kind or len(batch) == BATCH_SIZE:
+            importer.load(kind, batch)
+            kind, batch = recordType, []
+        batch.append(record)
+    importer.load(kind, batch)
+    importer.link_replies()
+    return importer.counts
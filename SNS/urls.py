@@ -1,5 +1,6 @@
 from django.urls import path
 from . import views
+from .conditional import conditional
 
 urlpatterns = [
     path('', views.home_view, name='home'),
@@ -7,12 +8,27 @@ urlpatterns = [
     path('userlist', views.UserListView.as_view(), name='user_list'),
     path('follow/<int:pk>', views.add_follower, name='follow'),
     path('unfollow/<int:pk>', views.delete_follower, name='unfollow'),
-    path('user/<int:pk>',views.UserPostView.as_view(),name='user_post'),
+    path('user/<int:pk>',
+         conditional(views.user_post_etag)(views.UserPostView.as_view()),
+         name='user_post'),
     path('like/<int:pk>',views.add_like,name='add_like'),
-    path('likes',views.MyLikeListView.as_view(),name='my_like_list'),
+    path('likes',
+         conditional(views.likes_etag)(views.MyLikeListView.as_view()),
+         name='my_like_list'),
+    path('search', views.PostSearchView.as_view(), name='post_search'),
+    path('explore', views.ExploreView.as_view(), name='explore'),
     path('unlike/<int:pk>',views.remove_like,name='remove_like'),
     path('repost/<int:pk>',views.add_repost,name='add_repost'),
     path('unrepost/<int:pk>',views.remove_repost,name='remove_repost'),
     path('reply/create/<int:pk>', views.ReplyCreateView.as_view(), name='reply_create'),
     path('post/detail/<int:pk>',views.PostDetailView.as_view(),name='post_detail'),
+    path('post/detail/<int:pk>/replies', views.ReplyListView.as_view(), name='post_replies'),
+    path('post/delete/<int:pk>', views.delete_post, name='post_delete'),
+    path('account/delete', views.delete_account, name='account_delete'),
+    path('timeline/stream', views.timeline_stream, name='timeline_stream'),
+    path('timeline/poll', views.timeline_poll, name='timeline_poll'),
+    path('timeline.json', views.timeline_json, name='timeline_json'),
+    path('actions', views.bulk_actions_view, name='bulk_actions'),
+    path('export.ndjson', views.export_view, name='export'),
+    path('instrumentation', views.instrumentation_view, name='instrumentation'),
 ]
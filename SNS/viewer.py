@@ -0,0 +1,146 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from . import caching, graph
+from .models import CustomUser, Repost
+
+# Per-viewer state needed to render a page.
+#
+# Templates test membership against these sets of primary keys instead of
+# scanning model querysets, and each set is limited to the objects actually
+# shown on the page.
+#
+# The sets come from a snapshot of all the ids the viewer follows, liked
+# and reposted, cached under their viewer version (see caching), so a page
+# costs no queries for them until the viewer's next like, repost or follow.
+# A set larger than SNS_VIEWER_SNAPSHOT_LIMIT is left out of the snapshot
+# and read for the page's objects only.  Async views read those
+# concurrently, each on its own thread and database connection.
+
+Follow = CustomUser.followers.through
+Like = CustomUser.likes.through
+
+
+def snapshot_limit():
+    return getattr(settings, 'SNS_VIEWER_SNAPSHOT_LIMIT', 5000)
+
+
+def _ids(queryset, column):
+    limit = snapshot_limit()
+    ids = list(queryset.values_list(column, flat=True)[:limit + 1])
+    return frozenset(ids) if len(ids) <= limit else None
+
+
+def _load_snapshot(customuser):
+    return {
+        'following': _ids(Follow.objects.filter(
+            from_customuser_id=customuser.pk), 'to_customuser_id'),
+        'liked': _ids(Like.objects.filter(
+            customuser_id=customuser.pk), 'post_id'),
+        'reposted': _ids(Repost.objects.filter(
+            repostedBy_id=customuser.pk), 'post_id'),
+    }
+
+
+def snapshot(customuser):
+    # {'following', 'liked', 'reposted'}: frozensets of the ids customuser
+    # follows, liked and reposted, or None for a set over snapshot_limit().
+    return caching.viewer_snapshot(customuser,
+                                   lambda: _load_snapshot(customuser))
+
+
+def liked_ids(customuser, ids, state=None):
+    liked = (state or snapshot(customuser))['liked']
+    if liked is not None:
+        return liked.intersection(ids)
+    return set(Like.objects.filter(
+        customuser_id=customuser.pk,
+        post_id__in=ids
+    ).values_list('post_id', flat=True))
+
+
+def reposted_ids(customuser, ids, state=None):
+    reposted = (state or snapshot(customuser))['reposted']
+    if reposted is not None:
+        return reposted.intersection(ids)
+    return set(Repost.objects.filter(
+        repostedBy_id=customuser.pk,
+        post_id__in=ids
+    ).values_list('post_id', flat=True))
+
+
+def post_state(customuser, posts):
+    # Context with the ids of the posts among `posts` that customuser liked
+    # and reposted.
+    ids = [p.pk for p in posts]
+    state = snapshot(customuser)
+    return {
+        'likedIds': liked_ids(customuser, ids, state),
+        'repostedIds': reposted_ids(customuser, ids, state),
+    }
+
+
+def following_ids(customuser, customusers):
+    # The ids of the users among `customusers` that customuser follows.
+    ids = [c.pk for c in customusers]
+    following = snapshot(customuser)['following']
+    if following is not None:
+        return following.intersection(ids)
+    return graph.following_among(customuser.pk, ids)
+
+
+def concurrent_reads():
+    # Whether blocking reads may run on other threads.  Other connections
+    # cannot see an in-memory SQLite database (such as the test database)
+    # the way the request's own connection does.
+    if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+        return False
+    return getattr(settings, 'SNS_CONCURRENT_READS', True)
+
+
+def _own_connection(func):
+    def read():
+        try:
+            return func()
+        finally:
+            close_old_connections()
+    return read
+
+
+async def read(func, *args):
+    # Call the blocking function func on a pool thread with its own database
+    # connection.  Unlike a thread-sensitive sync_to_async call this does not
+    # tie a thread to the request, which matters for long-lived streams.
+    if not concurrent_reads():
+        return await sync_to_async(func)(*args)
+    return await sync_to_async(_own_connection(lambda: func(*args)),
+                               thread_sensitive=False)()
+
+
+async def gather(*funcs):
+    # Call the blocking functions funcs and return their results in order;
+    # concurrently on pool threads if concurrent_reads() allows it.
+    if concurrent_reads():
+        return await asyncio.gather(*(
+            sync_to_async(_own_connection(f), thread_sensitive=False)()
+            for f in funcs))
+    return [await sync_to_async(f)() for f in funcs]
+
+
+async def apost_state(customuser, posts, *extra):
+    # post_state for async views.  The functions in extra are read alongside
+    # and their results returned after the context.
+    ids = [p.pk for p in posts]
+    state = await sync_to_async(snapshot)(customuser)
+    if state['liked'] is not None and state['reposted'] is not None:
+        return ({'likedIds': liked_ids(customuser, ids, state),
+                 'repostedIds': reposted_ids(customuser, ids, state)},
+                list(await gather(*extra)))
+    liked, reposted, *results = await gather(
+        lambda: liked_ids(customuser, ids, state),
+        lambda: reposted_ids(customuser, ids, state),
+        *extra)
+    return {'likedIds': liked, 'repostedIds': reposted}, results
@@ -1,69 +1,90 @@
+import functools
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
+from django.core.handlers.asgi import ASGIRequest
 from django.utils.decorators import method_decorator
-from django.shortcuts import render, get_object_or_404, redirect
+from django.shortcuts import get_object_or_404, redirect
 from django.views.generic.edit import CreateView
 from django.views.generic import ListView, DetailView
-from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
-from django.contrib.auth import login, authenticate
+from django.contrib.auth import login, logout, authenticate
 from django.urls import reverse_lazy
-from django.db.models import Q, F
+from django.template.response import TemplateResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.http import require_POST
+from django.db import transaction
 
-from .models import CustomUser, Post, Repost
-from .forms import RegisterForm
-from datetime import datetime
+from .models import ArchivedPost, CustomUser, Post
+from .conditional import conditional
+from .pagination import decode_cursor, keyset_page, page_size
+from . import actions, caching, feed, graph, instrumentation, jobs, ranking, search, stats, threads, timeline, transfer, viewer
 
 
-def home_view(request):
+def _viewer(request):
+    # The viewer's CustomUser, or None for anonymous requests.  This may load
+    # the session and the user, so async views call it via sync_to_async.
     user = request.user
+    return user.customuser if user.is_authenticated else None
+
+
+def async_login_required(view):
+    # login_required for async views; afterwards request.user is loaded.
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if await sync_to_async(_viewer)(request) is None:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def _home_etag(request, customuser):
+    # The home page changes with the viewer's timeline and their own likes
+    # and reposts.
+    return caching.page_etag('home', request.get_full_path(), customuser,
+                             timelines=[customuser.pk],
+                             viewers=[customuser.pk])
+
+
+# The class-based views are wrapped with conditional() in urls.py:
+# method_decorator does not keep an async get() async on Django 4.2.
+
+def likes_etag(request, customuser):
+    return caching.page_etag('likes', request.get_full_path(), customuser,
+                             viewers=[customuser.pk])
 
-    if not user.is_authenticated:
-        return render(request, 'SNS/home.html', {'posts': []})
-
-    myFollowers = user.customuser.followers.all()
-
-    reposts = Repost.objects.filter(
-        Q(repostedBy__in=myFollowers)
-    ).select_related(
-        'post__replyTo',
-        'post__author__user',
-        'repostedBy__user'
-    ).order_by('-pub_date')
-
-    uniqueRepostedPosts = []
-    for r in reposts:
-        p = r.post
-        if p in uniqueRepostedPosts:
-            existingPost = uniqueRepostedPosts[uniqueRepostedPosts.index(p)]
-            existingPost.reposter.append(r.repostedBy)
-        else:
-            p.keyDate = r.pub_date
-            p.reposter = [r.repostedBy]
-            uniqueRepostedPosts.append(p)
-
-    postsNotReposted = Post.objects.filter(
-        Q(author__in=myFollowers) |
-        Q(author=user.customuser)
-    ).exclude(
-        Q(repost__repostedBy__in=myFollowers)
-    ).select_related(
-        'replyTo',
-        'author__user'
-    ).annotate(
-        keyDate=F('pub_date')
-    )
-
-    postsList = list(postsNotReposted) + list(uniqueRepostedPosts)
-
-    contextPosts = sorted(postsList, key=lambda x: x.keyDate, reverse=True)
-
-    return render(request,
-                  'SNS/home.html',
-                  {
-                      'posts': contextPosts,
-                      'postsLiked': user.customuser.likes.all(),
-                      'postsReposted': user.customuser.reposts.all(),
-                  })
+
+def user_post_etag(request, customuser, pk):
+    # The profile owner's user version covers their posts, counts and
+    # follows.
+    return caching.page_etag('user_post', request.get_full_path(), customuser,
+                             viewers=[customuser.pk], users=[pk])
+
+
+@conditional(_home_etag)
+async def home_view(request):
+    customuser = await sync_to_async(_viewer)(request)
+
+    if customuser is None:
+        return TemplateResponse(request, 'SNS/home.html', {'posts': []})
+
+    before = request.GET.get('before')
+    contextPosts, nextCursor = await sync_to_async(timeline.timeline_page)(
+        customuser, before)
+
+    context = {
+        'posts': contextPosts,
+        'nextCursor': nextCursor,
+        'latestCursor': (None if before
+                         else feed.latest_cursor(contextPosts)),
+    }
+    state, _ = await viewer.apost_state(customuser, contextPosts)
+    context.update(state)
+    return TemplateResponse(request, 'SNS/home.html', context)
 
 
 @method_decorator(login_required, name="dispatch")
@@ -72,11 +93,32 @@ class UserListView(ListView):
     context_object_name = "customuser_list"
 
     def get_queryset(self):
-        return CustomUser.objects.all().select_related('user')
+        # Users are paged in username order; ?after=<username> continues
+        # after the last user shown.
+        self.query = self.request.GET.get('q', '').strip()
+        self.fullText = bool(self.request.GET.get('full'))
+        users = search.search_users(
+            CustomUser.objects.select_related('user', 'stats'),
+            self.query, self.fullText)
+        after = self.request.GET.get('after')
+        if after:
+            users = users.filter(user__username__gt=after)
+
+        size = page_size()
+        users = list(users.order_by('user__username')[:size + 1])
+        self.nextCursor = None
+        if len(users) > size:
+            users = users[:size]
+            self.nextCursor = users[-1].user.username
+        return users
 
     def get_context_data(self):
         context = super().get_context_data()
-        context["followers"] = self.request.user.customuser.likes.all()
+        context["followingIds"] = viewer.following_ids(
+            self.request.user.customuser, context["object_list"])
+        context["q"] = self.query
+        context["full"] = self.fullText
+        context["nextCursor"] = self.nextCursor
         return context
 
 @method_decorator(login_required, name="dispatch")
@@ -85,27 +127,148 @@ class MyLikeListView(ListView):
     context_object_name = "my_like_list"
 
     def get_queryset(self):
-        return self.request.user.customuser.likes.all()
+        posts, self.nextCursor = keyset_page(
+            self.request.user.customuser.likes.select_related(
+                'replyTo',
+                'author__user'
+            ),
+            self.request.GET.get('before'))
+        return posts
+
+    def get_context_data(self):
+        context = super().get_context_data()
+        context["nextCursor"] = self.nextCursor
+        context.update(viewer.post_state(self.request.user.customuser,
+                                         context["object_list"]))
+        return context
 
 
 @method_decorator(login_required, name="dispatch")
-class UserPostView(ListView):
-    template_name = "SNS/user_post.html"
+class ExploreView(ListView):
+    template_name = "SNS/explore.html"
     context_object_name = "post_list"
 
     def get_queryset(self):
-        self.customuser = get_object_or_404(CustomUser, pk=self.kwargs['pk'])
-        return Post.objects.filter(author=self.customuser
-                                   ).select_related('replyTo',
-                                                    'author__user'
-                                                    ).order_by('-pub_date')
+        posts, self.nextCursor = ranking.explore_page(
+            self.request.GET.get('before'))
+        return posts
+
+    def get_context_data(self):
+        context = super().get_context_data()
+        context["nextCursor"] = self.nextCursor
+        context.update(viewer.post_state(self.request.user.customuser,
+                                         context["object_list"]))
+        return context
 
 
 @method_decorator(login_required, name="dispatch")
+class PostSearchView(ListView):
+    template_name = "SNS/post_search.html"
+    context_object_name = "post_list"
+
+    def get_queryset(self):
+        # Best matches first; ?after=<cursor> continues after the last post
+        # shown.
+        self.query = self.request.GET.get('q', '').strip()
+        self.nextCursor = None
+        if not self.query:
+            return []
+        posts, self.nextCursor = search.search_posts(
+            self.query, self.request.GET.get('after'))
+        return posts
+
+    def get_context_data(self):
+        context = super().get_context_data()
+        context["q"] = self.query
+        context["nextCursor"] = self.nextCursor
+        context.update(viewer.post_state(self.request.user.customuser,
+                                         context["object_list"]))
+        return context
+
+
+@method_decorator(async_login_required, name="dispatch")
+class UserPostView(ListView):
+    template_name = "SNS/user_post.html"
+    context_object_name = "post_list"
+
+    def get_queryset(self):
+        self.customuser = get_object_or_404(
+            CustomUser.objects.select_related('user', 'stats'),
+            pk=self.kwargs['pk'])
+        posts, self.nextCursor = keyset_page(
+            Post.objects.filter(author=self.customuser
+                                ).select_related('replyTo',
+                                                 'author__user'),
+            self.request.GET.get('before'))
+        return posts
+
+    async def get(self, request, *args, **kwargs):
+        me = request.user.customuser
+        self.object_list = await sync_to_async(self.get_queryset)()
+        context = self.get_context_data()
+        state, (followsYou,) = await viewer.apost_state(
+            me, self.object_list,
+            lambda: graph.follows(self.customuser.pk, me.pk))
+        context.update(state)
+        context["customuser"] = self.customuser
+        context["stats"] = userStats = stats.of(self.customuser)
+        context["followingCount"] = userStats.followingCount
+        context["followerCount"] = userStats.followerCount
+        context["followsYou"] = followsYou
+        context["nextCursor"] = self.nextCursor
+        return self.render_to_response(context)
+
+
+@method_decorator(async_login_required, name="dispatch")
 class PostDetailView(DetailView):
     model = Post
     template_name = "SNS/post_detail.html"
 
+    def get_object(self):
+        self.thread = threads.load_thread(self.kwargs['pk'])
+        if self.thread is None:
+            raise Http404("No post found.")
+        return self.thread.post
+
+    async def get(self, request, *args, **kwargs):
+        self.object = await sync_to_async(self.get_object)()
+        context = self.get_context_data(object=self.object)
+        context["thread"] = self.thread
+        state, _ = await viewer.apost_state(request.user.customuser,
+                                            self.thread.posts())
+        context.update(state)
+        return self.render_to_response(context)
+
+
+@method_decorator(login_required, name="dispatch")
+class ReplyListView(ListView):
+    # The replies to a post, oldest first; continues a thread whose replies
+    # were not all loaded by PostDetailView.
+    template_name = "SNS/reply_list.html"
+    context_object_name = "reply_list"
+
+    def get_queryset(self):
+        # An archived thread is read from the archive, like PostDetailView.
+        model = Post
+        self.post = Post.objects.filter(pk=self.kwargs['pk']).first()
+        if self.post is None:
+            model = ArchivedPost
+            self.post = get_object_or_404(ArchivedPost, pk=self.kwargs['pk'])
+        posts, self.nextCursor = keyset_page(
+            model.objects.filter(replyTo_id=self.post.pk
+                                 ).select_related('author__user'),
+            self.request.GET.get('after'),
+            descending=False)
+        return posts
+
+    def get_context_data(self):
+        context = super().get_context_data()
+        context["post"] = self.post
+        context["nextCursor"] = self.nextCursor
+        context.update(viewer.post_state(self.request.user.customuser,
+                                         context["object_list"]))
+        return context
+
 
 class RegisterView(CreateView):
     form_class = UserCreationForm
@@ -129,6 +292,8 @@ class PostCreateView(CreateView):
     fields = ["text"]
     success_url = reverse_lazy("home")
 
+    # The post and the jobs its signal receivers enqueue commit together.
+    @method_decorator(transaction.atomic)
     def form_valid(self, form):
         form.instance.author = self.request.user.customuser
         return super().form_valid(form)
@@ -145,8 +310,11 @@ class ReplyCreateView(CreateView):
         self.replyTo = get_object_or_404(Post, pk=self.kwargs['pk'])
         context = super().get_context_data()
         context["post"] = self.replyTo
+        context.update(viewer.post_state(self.request.user.customuser,
+                                         [self.replyTo]))
         return context
 
+    @method_decorator(transaction.atomic)
     def form_valid(self, form):
         form.instance.author = self.request.user.customuser
         form.instance.replyTo = Post.objects.get(pk=self.kwargs['pk'])
@@ -155,53 +323,187 @@ class ReplyCreateView(CreateView):
 
 @login_required
 def add_follower(request, pk):
-    user = get_object_or_404(User, pk=pk)
-    userInfo = request.user
-    userInfo.customuser.followers.add(user.customuser)
-    userInfo.save()
+    customuser = get_object_or_404(CustomUser, pk=pk)
+    request.user.customuser.followers.add(customuser)
     return redirect('user_list')
 
 
 @login_required
 def delete_follower(request, pk):
-    user = get_object_or_404(User, pk=pk)
-    userInfo = request.user
-    userInfo.customuser.followers.remove(user.customuser)
-    userInfo.save()
+    customuser = get_object_or_404(CustomUser, pk=pk)
+    request.user.customuser.followers.remove(customuser)
     return redirect('user_list')
 
 
 @login_required
 def add_like(request, pk):
     post = get_object_or_404(Post, pk=pk)
-    userInfo = request.user
-    userInfo.customuser.likes.add(post)
-    userInfo.save()
+    request.user.customuser.likes.add(post)
     return redirect("home")
 
 
 @login_required
 def remove_like(request, pk):
     post = get_object_or_404(Post, pk=pk)
-    userInfo = request.user
-    userInfo.customuser.likes.remove(post)
-    userInfo.save()
+    request.user.customuser.likes.remove(post)
     return redirect("home")
 
 
 @login_required
 def add_repost(request, pk):
     post = get_object_or_404(Post, pk=pk)
-    userInfo = request.user
-    userInfo.customuser.reposts.add(post)
-    userInfo.save()
+    request.user.customuser.reposts.add(post)
     return redirect("home")
 
 
 @login_required
 def remove_repost(request, pk):
     post = get_object_or_404(Post, pk=pk)
-    userInfo = request.user
-    userInfo.customuser.reposts.remove(post)
-    userInfo.save()
+    request.user.customuser.reposts.remove(post)
     return redirect("home")
+
+
+async def timeline_stream(request):
+    # Server-sent events with the home timeline items after ?after= (or the
+    # Last-Event-ID a reconnecting EventSource sends).  The stream ends after
+    # SNS_STREAM_SECONDS and the browser reconnects from the last event id.
+    # All reads go through viewer.read so that an idle stream holds no
+    # thread under ASGI.
+    customuser = await viewer.read(_viewer, request)
+    if customuser is None:
+        return redirect_to_login(request.get_full_path())
+    ownerId = customuser.pk
+    cursor = (request.META.get('HTTP_LAST_EVENT_ID') or
+              request.GET.get('after'))
+    if cursor:
+        # Reject a malformed cursor before the response starts.
+        decode_cursor(cursor)
+
+    # Under WSGI an async iterator would be buffered to the end.
+    if isinstance(request, ASGIRequest):
+        events = feed.aevents(ownerId, cursor)
+    else:
+        events = feed.events(ownerId, cursor)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@async_login_required
+async def timeline_poll(request):
+    # Polling fallback for timeline_stream: the items after ?after=, waiting
+    # up to ?wait= seconds (at most SNS_POLL_WAIT) for some to arrive.
+    ownerId = request.user.customuser.pk
+    cursor = request.GET.get('after')
+    try:
+        waitSeconds = min(float(request.GET.get('wait', 0)),
+                          getattr(settings, 'SNS_POLL_WAIT', 25))
+    except ValueError:
+        return JsonResponse({'error': "wait must be a number."}, status=400)
+
+    version = await caching.atimeline_version(ownerId)
+    items, cursor = await sync_to_async(feed.newer)(ownerId, cursor)
+    if not items and waitSeconds > 0:
+        if await feed.await_change(ownerId, version, waitSeconds) != version:
+            items, cursor = await sync_to_async(feed.newer)(ownerId, cursor)
+    return JsonResponse({
+        'items': [feed.item(post) for post in items],
+        'cursor': cursor,
+    })
+
+
+def _timeline_json_etag(request, customuser):
+    return caching.page_etag('timeline_json', request.get_full_path(),
+                             customuser, timelines=[customuser.pk],
+                             viewers=[customuser.pk])
+
+
+@async_login_required
+@conditional(_timeline_json_etag)
+async def timeline_json(request):
+    # A page of the home timeline as compact JSON, for clients that render
+    # it themselves; ?before= pages back like the home page.
+    customuser = request.user.customuser
+    posts, nextCursor = await sync_to_async(timeline.timeline_page)(
+        customuser, request.GET.get('before'))
+    state, _ = await viewer.apost_state(customuser, posts)
+    return JsonResponse({
+        'items': [dict(feed.item(post),
+                       reposters=[r.user.username for r in post.reposter],
+                       liked=post.pk in state['likedIds'],
+                       reposted=post.pk in state['repostedIds'],
+                       likes=post.likeCount,
+                       reposts=post.repostCount,
+                       replies=post.replyCount)
+                  for post in posts],
+        'next': nextCursor,
+    })
+
+
+@login_required
+def export_view(request):
+    # The signed-in user's account, posts, reposts, likes and follows as
+    # NDJSON (see SNS.transfer), streamed as it is read.
+    customuserIds = [request.user.customuser.pk]
+    # Under ASGI a sync iterator would be read to the end first.
+    if isinstance(request, ASGIRequest):
+        content = transfer.achunks(customuserIds)
+    else:
+        content = transfer.chunks(customuserIds)
+    response = StreamingHttpResponse(
+        content, content_type='application/x-ndjson; charset=utf-8')
+    response['Content-Disposition'] = (
+        'attachment; filename="%s.ndjson"' % request.user.username)
+    return response
+
+
+@login_required
+@require_POST
+def delete_post(request, pk):
+    # Delete one of the signed-in user's posts, live or archived, and the
+    # replies below it, in batches (see SNS.retention).  Not atomic: each
+    # batch commits on its own.
+    customuser = request.user.customuser
+    if not (Post.objects.filter(pk=pk, author=customuser).exists() or
+            ArchivedPost.objects.filter(pk=pk, author=customuser).exists()):
+        raise Http404("No post found.")
+    jobs.enqueue('delete_posts', postIds=[pk])
+    return redirect('user_post', pk=customuser.pk)
+
+
+@login_required
+@require_POST
+def delete_account(request):
+    # Deactivate the signed-in user's account at once and delete it and all
+    # of its data in batches (see SNS.retention).  Not atomic: each batch
+    # commits on its own.
+    user = request.user
+    user.is_active = False
+    user.save(update_fields=['is_active'])
+    jobs.enqueue('delete_account', customuserId=user.customuser.pk)
+    logout(request)
+    return redirect('home')
+
+
+@require_POST
+def bulk_actions_view(request):
+    # Apply a batch of follow/like/repost actions posted as JSON; see
+    # SNS.actions for the format.  API clients get a JSON error instead of
+    # the login page.
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': "Authentication required."}, status=401)
+    try:
+        batch = actions.parse(json.loads(request.body.decode('utf-8')))
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(actions.apply(request.user.customuser, batch))
+
+
+@staff_member_required
+def instrumentation_view(request):
+    return JsonResponse({
+        'views': instrumentation.snapshot(),
+        'cache': dict(caching.stats),
+        'jobs': jobs.metrics(),
+    })
@@ -4,10 +4,10 @@ Django settings for mysite project.
 Generated by 'django-admin startproject' using Django 2.2.17.
 
 For more information on this file, see
-https://docs.djangoproject.com/en/2.2/topics/settings/
+https://docs.djangoproject.com/en/4.2/topics/settings/
 
 For the full list of settings and their values, see
-https://docs.djangoproject.com/en/2.2/ref/settings/
+https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 import os
@@ -17,13 +17,13 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 # Quick-start development settings - unsuitable for production
-# See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
+# See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = 'z+*rjpn)lg14k3sxa$6)emec$7(xw61y9jqv%fg91f_@ih5#qc'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.environ.get('DJANGO_DEBUG', '1') == '1'
 
 ALLOWED_HOSTS =  ['127.0.0.1', '.pythonanywhere.com']
 
@@ -38,11 +38,10 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'debug_toolbar',
 ]
 
 MIDDLEWARE = [
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'SNS.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,14 +51,36 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# The debug toolbar's middleware is sync-only: under ASGI it would make
+# Django adapt the whole middleware chain and hold a thread for every
+# request, long polls and streams included.  Like its URLs (mysite/urls.py),
+# it is only installed with DEBUG on.
+
+if DEBUG:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.insert(0, 'debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'mysite.urls'
 
+# Outside DEBUG, templates are parsed once per process and kept by the
+# cached loader; with DEBUG on they are read again on every render, so edits
+# show up without a restart.
+
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
+if not DEBUG:
+    TEMPLATE_LOADERS = [('django.template.loaders.cached.Loader',
+                         TEMPLATE_LOADERS)]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': TEMPLATE_LOADERS,
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -74,18 +95,178 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 
 
 # Database
-# https://docs.djangoproject.com/en/2.2/ref/settings/#databases
+# https://docs.djangoproject.com/en/4.2/ref/settings/#databases
+#
+# SNS_DB_PROFILE picks the database setup:
+#
+#   (unset)     SQLite at BASE_DIR/db.sqlite3, one connection per request.
+#   production  The same file in WAL mode (see SNS_SQLITE_PRAGMAS) with
+#               persistent connections, reads routed to a read-only
+#               'replica' connection of the same file.
+#   postgresql  PostgreSQL from the POSTGRES_* variables below; needs
+#               psycopg2 (or psycopg) installed.
+#
+# SNS_CONN_MAX_AGE overrides how many seconds a connection is reused.
+
+SNS_DB_PROFILE = os.environ.get('SNS_DB_PROFILE', '')
+
+SQLITE_PATH = os.environ.get('SNS_SQLITE_PATH',
+                             os.path.join(BASE_DIR, 'db.sqlite3'))
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # django.db.backends.sqlite3 with Django 5.1's transaction_mode.
+        'ENGINE': 'SNS.backends.sqlite3',
+        'NAME': SQLITE_PATH,
+        'OPTIONS': {
+            # Seconds a connection waits for another writer's lock.
+            'timeout': 20,
+            # Atomic blocks take the write lock up front (BEGIN IMMEDIATE).
+            'transaction_mode': 'IMMEDIATE',
+        },
+    }
+}
+
+DATABASE_ROUTERS = ['SNS.database.ReadReplicaRouter']
+
+if SNS_DB_PROFILE == 'production':
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+    DATABASES['replica'] = dict(
+        DATABASES['default'],
+        NAME='file:%s?mode=ro' % SQLITE_PATH,
+        OPTIONS={'timeout': 20},
+        TEST={'MIRROR': 'default'},
+    )
+elif SNS_DB_PROFILE == 'postgresql':
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'sns'),
+        'USER': os.environ.get('POSTGRES_USER', 'sns'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        # Django 4.2 has no pool of its own: keep connections open per
+        # worker thread, or put PgBouncer in front (POSTGRES_POOLER=pgbouncer)
+        # and let it pool them.  Transaction pooling cannot keep server-side
+        # cursors open across transactions.
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'DISABLE_SERVER_SIDE_CURSORS':
+            os.environ.get('POSTGRES_POOLER') == 'pgbouncer',
     }
+    if os.environ.get('POSTGRES_REPLICA_HOST'):
+        DATABASES['replica'] = dict(
+            DATABASES['default'],
+            HOST=os.environ['POSTGRES_REPLICA_HOST'],
+            TEST={'MIRROR': 'default'},
+        )
+
+if 'SNS_CONN_MAX_AGE' in os.environ:
+    for database in DATABASES.values():
+        database['CONN_MAX_AGE'] = int(os.environ['SNS_CONN_MAX_AGE'])
+
+# Applied to every new SQLite connection (SNS.database).  WAL lets readers
+# run while a write is in progress; synchronous=NORMAL is durable in WAL
+# mode except for the last transactions on power loss; cache_size is in KiB
+# when negative; busy_timeout is in milliseconds.
+
+SNS_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -20000,
+    'mmap_size': 268435456,
+    'temp_store': 'memory',
+    'busy_timeout': 20000,
 }
 
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+#
+# 'default' holds the cached cards, timeline pages and viewer snapshots and
+# 'versions' the version numbers their keys are built from (SNS.caching).
+# A version must never be lost: one that is starts again from 0 and makes
+# stale entries reachable again.  Every process must also see the same
+# versions, and two processes bumping one at the same time must both count.
+# So the versions are always kept in files under SNS_CACHE_DIR by
+# SNS.backends.filecache, which increments under a file lock and never
+# evicts.  Deployments (the production and postgresql profiles, or
+# SNS_ASYNC_FANOUT) run several processes and keep 'default' in files there
+# too; only a development setup keeps it in process memory.  Django's own
+# FileBasedCache does not increment atomically and must not hold versions;
+# with several hosts, use a shared Redis or Memcached for both.
+
+# Timeline fan-out runs in "manage.py run_jobs" workers instead of inside
+# the request when this is set.
+
+SNS_ASYNC_FANOUT = os.environ.get('SNS_ASYNC_FANOUT') == '1'
+
+SNS_SHARED_CACHE = bool(SNS_DB_PROFILE) or SNS_ASYNC_FANOUT
+
+SNS_CACHE_DIR = os.environ.get('SNS_CACHE_DIR',
+                               os.path.join(BASE_DIR, 'cache'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sns',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    'versions': {
+        'BACKEND': 'SNS.backends.filecache.VersionFileCache',
+        'LOCATION': os.path.join(SNS_CACHE_DIR, 'versions'),
+        'TIMEOUT': None,
+    },
+}
+
+if SNS_SHARED_CACHE:
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(SNS_CACHE_DIR, 'default'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }
+
+SNS_CACHE = 'default'
+
+SNS_VERSION_CACHE = 'versions'
+
+SNS_CACHE_TIMEOUT = 300
+
+
+# Authentication and sessions
+#
+# The first backend loads the signed-in user's CustomUser together with the
+# User.  ModelBackend stays listed so that sessions signed in before it was
+# added, which name ModelBackend, remain valid.  Sessions live in the
+# database; with a cache shared by all worker processes (see above) they
+# are read from the cache and only fall back to the database on a miss.
+
+AUTHENTICATION_BACKENDS = [
+    'SNS.auth.CustomUserBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
+if SNS_SHARED_CACHE:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# A viewer's followed, liked and reposted ids are cached as one snapshot
+# (SNS.viewer) when each set has at most this many ids.
+
+SNS_VIEWER_SNAPSHOT_LIMIT = 5000
+
+# "manage.py archive_posts" moves threads whose posts are all older than
+# this many seconds out of the hot tables (SNS.retention).
+
+SNS_ARCHIVE_AFTER = 365 * 24 * 3600
+
 
 # Password validation
-# https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
+# https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -104,7 +285,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 
 # Internationalization
-# https://docs.djangoproject.com/en/2.2/topics/i18n/
+# https://docs.djangoproject.com/en/4.2/topics/i18n/
 
 LANGUAGE_CODE = 'ja'
 
@@ -112,13 +293,11 @@ TIME_ZONE = 'Asia/Tokyo'
 
 USE_I18N = True
 
-USE_L10N = True
-
 USE_TZ = True
 
 
 # Static files (CSS, JavaScript, Images)
-# https://docs.djangoproject.com/en/2.2/howto/static-files/
+# https://docs.djangoproject.com/en/4.2/howto/static-files/
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
@@ -126,3 +305,35 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 LOGIN_REDIRECT_URL = '/'
 
 INTERNAL_IPS = ['127.0.0.1']
+
+
+# Request instrumentation
+# Fraction of requests whose timings and query counts are logged as JSON on
+# the SNS.instrumentation logger; summarize the log with
+# "manage.py instrumentation_report".
+
+SNS_INSTRUMENTATION_SAMPLE_RATE = float(
+    os.environ.get('SNS_INSTRUMENTATION_SAMPLE_RATE', '0'))
+
+SNS_INSTRUMENTATION_DUPLICATE_THRESHOLD = 3
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'instrumentation': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'SNS.instrumentation': {
+            'handlers': ['instrumentation'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}